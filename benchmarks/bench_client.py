@@ -0,0 +1,192 @@
+"""Load test of the client against the local stand-in server (`capabilities.standin`).
+
+Each scenario drives one call path at the given concurrency and reports the throughput,
+the client CPU time per call and the latency percentiles. The server runs in a separate process,
+so the CPU time is the client's own. Passing `--max-cpu-ms-per-call` and/or `--min-rps` turns the
+run into a regression gate that exits with status 1 if a scenario misses them.
+
+usage: python benchmarks/bench_client.py [--n-calls 2000] [--concurrency 32] [--latency 0.01]
+    [--latency-sigma 0.5] [--error-rate 0.0] [--throttle-rate 0.0] [--document-chars 2000]
+    [--scenarios capability,aifunction,async_capability,async_aifunction,stream]
+    [--max-cpu-ms-per-call 2.0] [--min-rps 500]
+"""
+
+import asyncio
+import multiprocessing
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence, Union
+
+import fire
+
+from capabilities import CapabilitiesClient, Capability, llm
+from capabilities.batch import amap_calls, map_calls
+from capabilities.instrumentation import Histogram
+from capabilities.retry import RetryPolicy
+from capabilities.standin import StandInServer, lognormal
+
+
+@dataclass
+class Row:
+    text: str
+    score: float
+
+
+def serve(port_queue, latency: float, latency_sigma: float, error_rate: float, throttle_rate: float):
+    server = StandInServer(
+        latency=lognormal(latency, latency_sigma) if latency > 0 and latency_sigma > 0 else latency,
+        error_rate=error_rate,
+        throttle_rate=throttle_rate,
+        retry_after=0.01,
+        stream_chunks=8,
+        record=False,
+        seed=0,
+    ).start()
+    port_queue.put(server.port)
+    threading.Event().wait()
+
+
+def timed(fn: Callable, latencies: Histogram) -> Callable:
+    lock = threading.Lock()
+
+    def call(*args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            with lock:
+                latencies.add(time.perf_counter() - start)
+
+    return call
+
+
+def atimed(fn: Callable, latencies: Histogram) -> Callable:
+    async def call(*args):
+        start = time.perf_counter()
+        try:
+            return await fn(*args)
+        finally:
+            latencies.add(time.perf_counter() - start)
+
+    return call
+
+
+def make_scenarios(client: CapabilitiesClient, concurrency: int) -> Dict[str, Callable]:
+    """Scenarios by name, each running the calls of a list of documents and recording their latencies."""
+    summarize = Capability("blazon/summarize", client=client)
+
+    @llm(client=client)
+    def extract(text: str) -> Row:
+        """Extracts the row described by the text."""
+        ...
+
+    def stream(document: str):
+        s = summarize.stream(document)
+        for _ in s:
+            pass
+        return s.result
+
+    def sync(fn):
+        return lambda documents, latencies: list(
+            map_calls(timed(fn, latencies), documents, concurrency=concurrency)
+        )
+
+    def run_async(fn):
+        async def main(documents, latencies):
+            results = []
+            async for r in amap_calls(atimed(fn, latencies), documents, concurrency=concurrency):
+                results.append(r)
+            await client.aclose()
+            return results
+
+        return lambda documents, latencies: asyncio.run(main(documents, latencies))
+
+    return {
+        "capability": sync(summarize),
+        "aifunction": sync(extract),
+        "async_capability": run_async(summarize.run_async),
+        "async_aifunction": run_async(extract.run_async),
+        "stream": sync(stream),
+    }
+
+
+def main(
+    n_calls: int = 2000,
+    concurrency: int = 32,
+    latency: float = 0.01,
+    latency_sigma: float = 0.5,
+    error_rate: float = 0.0,
+    throttle_rate: float = 0.0,
+    document_chars: int = 2000,
+    scenarios: Optional[Union[str, Sequence[str]]] = None,
+    max_cpu_ms_per_call: Optional[float] = None,
+    min_rps: Optional[float] = None,
+):
+    ctx = multiprocessing.get_context("spawn")
+    port_queue = ctx.Queue()
+    server = ctx.Process(
+        target=serve,
+        args=(port_queue, latency, latency_sigma, error_rate, throttle_rate),
+        daemon=True,
+    )
+    server.start()
+    port = port_queue.get()
+    client = CapabilitiesClient(
+        f"http://127.0.0.1:{port}",
+        api_key="bench",
+        retry=RetryPolicy(initial_delay=0.01, max_delay=0.1),
+        limit=max(100, concurrency),
+        pool_maxsize=max(100, concurrency),
+    )
+    all_scenarios = make_scenarios(client, concurrency)
+    if scenarios is None:
+        names: List[str] = list(all_scenarios)
+    elif isinstance(scenarios, str):
+        names = scenarios.split(",")
+    else:
+        names = list(scenarios)
+    filler = "lorem ipsum dolor sit amet " * (document_chars // 27 + 1)
+    print(
+        f"{n_calls} calls at concurrency {concurrency}, server latency {latency * 1e3:g} ms"
+        f" (sigma {latency_sigma:g}), {error_rate:.0%} errors, {throttle_rate:.0%} 429s"
+    )
+    failures = []
+    try:
+        for name in names:
+            run = all_scenarios[name]
+            # distinct documents per scenario, so that no call is coalesced or cached.
+            documents = [f"{name} {i} {filler}"[:document_chars] for i in range(n_calls)]
+            # warm up the connection pools before measuring.
+            run([f"warm up {d}" for d in documents[:concurrency]], Histogram())
+            latencies = Histogram()
+            retries = client.retry.stats.retries
+            cpu, wall = time.process_time(), time.perf_counter()
+            results = run(documents, latencies)
+            cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+            rps = n_calls / wall
+            cpu_ms = cpu / n_calls * 1e3
+            percentiles = "   ".join(
+                f"p{q * 100:g} {latencies.quantile(q) * 1e3:7.1f} ms" for q in (0.5, 0.95, 0.99)
+            )
+            print(
+                f"{name:<18} {rps:9.1f} req/s   cpu {cpu_ms:6.3f} ms/call   {percentiles}"
+                f"   retries {client.retry.stats.retries - retries}"
+                f"   errors {sum(not r.ok for r in results)}"
+            )
+            if max_cpu_ms_per_call is not None and cpu_ms > max_cpu_ms_per_call:
+                failures.append(f"{name}: {cpu_ms:.3f} ms of cpu per call > {max_cpu_ms_per_call}")
+            if min_rps is not None and rps < min_rps:
+                failures.append(f"{name}: {rps:.1f} req/s < {min_rps}")
+    finally:
+        client.close()
+        server.terminate()
+    for f in failures:
+        print(f"FAILED {f}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,83 @@
+"""Import time of the package, measured in fresh interpreters.
+
+Each statement is timed in its own subprocess (the best of `repeat` runs, excluding the interpreter's
+startup) and checked against its budget and the list of heavy modules it must not load.
+Exits with status 1 if a budget is exceeded; `tests/test_import_time.py` runs it as a test.
+
+usage: python benchmarks/bench_import.py [--repeat 5] [--scale 1.0]
+"""
+
+import json
+import os
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+import fire
+
+HEAVY = ["aiohttp", "requests", "pydantic", "dacite", "tiktoken", "openai", "fire", "diskcache"]
+
+BUDGETS: Dict[str, Tuple[float, List[str]]] = {
+    # statement: (budget in ms, modules it must not load)
+    "import capabilities": (50, HEAVY + ["capabilities.config"]),
+    "from capabilities import CapabilitiesClient": (
+        600,
+        ["aiohttp", "pydantic", "tiktoken", "openai", "diskcache", "capabilities.config"],
+    ),
+    "from capabilities import Capability, llm": (
+        1000,
+        ["aiohttp", "tiktoken", "openai", "diskcache", "capabilities.config"],
+    ),
+    "import capabilities.util": (600, ["aiohttp", "tiktoken", "openai", "fire"]),
+}
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+exec(sys.argv[1])
+print(json.dumps([time.perf_counter() - start, sorted(sys.modules)]))
+"""
+
+
+def measure(statement: str, repeat: int) -> Tuple[float, List[str]]:
+    """Best import time in seconds of `statement` in a fresh interpreter, and the modules it loaded."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join([root, os.environ.get("PYTHONPATH", "")])}
+    best, modules = float("inf"), []
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, "-c", PROBE, statement],
+            capture_output=True,
+            text=True,
+            check=True,
+            env=env,
+        ).stdout
+        seconds, modules = json.loads(out.splitlines()[-1])
+        best = min(best, seconds)
+    return best, modules
+
+
+def check(repeat: int = 5, scale: float = 1.0) -> List[str]:
+    """Measures every statement and returns the budget violations. `scale` multiplies the time budgets."""
+    failures = []
+    for statement, (budget_ms, forbidden) in BUDGETS.items():
+        seconds, modules = measure(statement, repeat)
+        loaded = [m for m in forbidden if m in modules]
+        print(f"{statement:<48} {seconds * 1e3:8.1f} ms   budget {budget_ms * scale:6.0f} ms")
+        if seconds * 1e3 > budget_ms * scale:
+            failures.append(f"{statement!r} took {seconds * 1e3:.1f} ms > {budget_ms * scale:.0f} ms")
+        if loaded:
+            failures.append(f"{statement!r} loaded {', '.join(loaded)}")
+    return failures
+
+
+def main(repeat: int = 5, scale: float = 1.0):
+    failures = check(repeat, scale)
+    for f in failures:
+        print(f"FAILED {f}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
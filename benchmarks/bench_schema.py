@@ -0,0 +1,95 @@
+"""Microbenchmark of the compiled schema encoders/decoders against the reference implementations.
+
+usage: python benchmarks/bench_schema.py [--n-items 1000] [--repeat 5]
+"""
+
+from dataclasses import dataclass
+import timeit
+
+import fire
+from pydantic import BaseModel
+
+from capabilities.core import (
+    _flatten_model,
+    _of_dict,
+    _to_dict,
+    flatten_model,
+    of_dict,
+    to_dict,
+)
+
+
+@dataclass
+class Cell:
+    content: str
+    score: float
+    flags: list[bool]
+
+
+@dataclass
+class Row:
+    index: int
+    cells: list[Cell]
+
+
+@dataclass
+class Table:
+    title: str
+    rows: list[Row]
+
+
+class PCell(BaseModel):
+    content: str
+    score: float
+    flags: list[bool]
+
+
+class PRow(BaseModel):
+    index: int
+    cells: list[PCell]
+
+
+class PTable(BaseModel):
+    title: str
+    rows: list[PRow]
+
+
+def make_table(n_items: int) -> dict:
+    return {
+        "title": "t",
+        "rows": [
+            {
+                "index": i,
+                "cells": [
+                    {"content": f"{i}:{j}", "score": j / 3, "flags": [True, False]}
+                    for j in range(8)
+                ],
+            }
+            for i in range(n_items)
+        ],
+    }
+
+
+def bench(name, reference, compiled, number, repeat):
+    ref = min(timeit.repeat(reference, number=number, repeat=repeat)) / number
+    new = min(timeit.repeat(compiled, number=number, repeat=repeat)) / number
+    print(
+        f"{name:<28} reference {ref * 1e3:9.3f} ms   compiled {new * 1e3:9.3f} ms   speedup {ref / new:6.1f}x"
+    )
+
+
+def main(n_items: int = 1000, repeat: int = 5):
+    d = make_table(n_items)
+    table = of_dict(Table, d)
+    ptable = of_dict(PTable, d)
+    bench("flatten_model(Table)", lambda: _flatten_model(Table), lambda: flatten_model(Table), 1000, repeat)
+    bench("flatten_model(PTable)", lambda: _flatten_model(PTable), lambda: flatten_model(PTable), 1000, repeat)
+    bench("of_dict(Table)", lambda: _of_dict(Table, d), lambda: of_dict(Table, d), 3, repeat)
+    bench("of_dict(list[Table])", lambda: _of_dict(list[Table], [d] * 2), lambda: of_dict(list[Table], [d] * 2), 3, repeat)
+    bench("of_dict(PTable)", lambda: _of_dict(PTable, d), lambda: of_dict(PTable, d), 3, repeat)
+    bench("to_dict(Table)", lambda: _to_dict(table), lambda: to_dict(table), 3, repeat)
+    bench("to_dict(list[PTable])", lambda: _to_dict([ptable] * 2), lambda: to_dict([ptable] * 2), 3, repeat)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
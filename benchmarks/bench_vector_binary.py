@@ -0,0 +1,75 @@
+"""Memory, latency and recall of `BinaryVectorIndex` for a range of oversampling factors.
+
+Compares the sign-bit first stage against the exact float32 `QuantizedVectorIndex` scan, on clustered
+synthetic embeddings queried with perturbed rows. Recall@limit is the fraction of the exact top `limit`
+results that the binary index finds. With `--on-disk` the full precision rows are kept in a temporary file.
+
+usage: python benchmarks/bench_vector_binary.py [--n-rows 200_000] [--dim 384] [--n-queries 256]
+    [--batch-size 16] [--limit 10] [--oversample 1,2,5,10,20] [--on-disk]
+"""
+
+import os
+import tempfile
+import time
+from typing import Sequence, Tuple, Union
+
+import fire
+import numpy as np
+
+from capabilities.search import BinaryVectorIndex, QuantizedVectorIndex
+from capabilities.search.types import VectorIndex
+
+
+def embeddings(rng: np.random.Generator, n_rows: int, dim: int, n_clusters: int) -> np.ndarray:
+    centers = rng.normal(size=(n_clusters, dim))
+    rows = centers[rng.integers(n_clusters, size=n_rows)] + rng.normal(scale=0.5, size=(n_rows, dim))
+    return rows.astype(np.float32)
+
+
+def timed_search(index: VectorIndex, queries: np.ndarray, batch_size: int, limit: int) -> Tuple[np.ndarray, float]:
+    """The result ids of every query and the mean latency of a batch of queries in seconds."""
+    ids = []
+    start = time.perf_counter()
+    for i in range(0, len(queries), batch_size):
+        ids.append(index.search(queries[i : i + batch_size], limit)[1])
+    return np.concatenate(ids), (time.perf_counter() - start) / -(-len(queries) // batch_size)
+
+
+def main(
+    n_rows: int = 200_000,
+    dim: int = 384,
+    n_queries: int = 256,
+    batch_size: int = 16,
+    limit: int = 10,
+    oversample: Union[int, Sequence[int]] = (1, 2, 5, 10, 20),
+    on_disk: bool = False,
+    n_clusters: int = 1000,
+    seed: int = 0,
+):
+    rng = np.random.default_rng(seed)
+    rows = embeddings(rng, n_rows, dim, n_clusters)
+    queries = rows[rng.integers(n_rows, size=n_queries)] + rng.normal(scale=0.5, size=(n_queries, dim))
+    exact = QuantizedVectorIndex("float32")
+    exact.add(rows)
+    exact_ids, exact_latency = timed_search(exact, queries, batch_size, limit)
+    print(f"{n_rows:,} rows of dim {dim}, batches of {batch_size} queries, recall@{limit}")
+    print(f"{'float32 exact':<22} {exact.nbytes / 2**20:8.1f} MiB {exact_latency * 1e3:8.2f} ms   recall 1.000")
+    oversample = [oversample] if isinstance(oversample, int) else oversample
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "rows.f32") if on_disk else None
+        index = BinaryVectorIndex(path=path)
+        index.add(rows)
+        first_stage = index.rows.nbytes / 2**20
+        for factor in oversample:
+            index.oversample = factor
+            ids, latency = timed_search(index, queries, batch_size, limit)
+            recall = np.mean([len(np.intersect1d(a, b)) / limit for a, b in zip(ids, exact_ids)])
+            name = f"binary x{factor}"
+            print(
+                f"{name:<22} {first_stage:8.1f} MiB {latency * 1e3:8.2f} ms   recall {recall:.3f}"
+                f"   (in memory with full rows {index.nbytes / 2**20:.1f} MiB)"
+            )
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,87 @@
+"""Incremental ingest into `SimpleVectorIndex`, in many small batches.
+
+Adds `n_rows` vectors in batches of `batch_size` rows and reports the ingest rate over each tenth
+of the run: with the capacity-doubling buffer the rate stays flat as the index grows (linear-time ingest),
+while the previous `np.concatenate` per batch, run on the first `baseline_rows`, slows down as it grows.
+
+Also reports the peak memory of each run (traced numpy allocations) relative to the size of the rows.
+The doubling buffer doesn't lower it: concatenating holds the old and new copies of the rows, 2 times
+the rows, while growing the buffer holds the old buffer and one of twice its capacity, up to 3 times the
+rows, and the buffer keeps up to 2 times the rows afterwards, until `compact` is called.
+
+usage: python benchmarks/bench_vector_ingest.py [--n-rows 1_000_000] [--batch-size 1000] [--dim 384]
+    [--baseline-rows 100_000]
+"""
+
+import time
+import tracemalloc
+from typing import List
+
+import fire
+import numpy as np
+
+from capabilities.search import SimpleVectorIndex
+
+
+class ConcatVectorIndex(SimpleVectorIndex):
+    """The previous `SimpleVectorIndex.add`, copying all the rows on every call."""
+
+    def add(self, arr):
+        arr = arr / np.linalg.norm(arr, axis=1)[:, np.newaxis]
+        self._buffer = arr if len(self) == 0 else np.concatenate([self.rows, arr])
+        self._size = len(self._buffer)
+
+
+def ingest(index: SimpleVectorIndex, n_rows: int, batches: List[np.ndarray]) -> List[float]:
+    """Adds `n_rows` rows, cycling through `batches`, and returns the rate in rows/s of each tenth of the run."""
+    tracemalloc.start()
+    checkpoints = [n_rows * (i + 1) // 10 for i in range(10)]
+    rates = []
+    start = last = time.perf_counter()
+    added = mark = 0
+    i = 0
+    while added < n_rows:
+        index.add(batches[i % len(batches)])
+        i += 1
+        added += len(batches[0])
+        if added >= checkpoints[len(rates)]:
+            now = time.perf_counter()
+            rates.append((added - mark) / (now - last))
+            last, mark = now, added
+    total = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    data = index.rows.nbytes
+    print(
+        f"{type(index).__name__:<20} {added:>11,} rows in {total:7.2f} s   "
+        f"rate per tenth (k rows/s): {' '.join(f'{r / 1e3:.0f}' for r in rates)}\n"
+        f"{'':<20} rows {data / 2**20:,.0f} MiB, memory peak {peak / data:.2f}x, after {current / data:.2f}x"
+    )
+    return rates
+
+
+def main(
+    n_rows: int = 1_000_000,
+    batch_size: int = 1000,
+    dim: int = 384,
+    baseline_rows: int = 100_000,
+    seed: int = 0,
+):
+    rng = np.random.default_rng(seed)
+    batches = [rng.normal(size=(batch_size, dim)).astype(np.float32) for _ in range(64)]
+    print(f"{batch_size}-row batches of {dim}-d float32 vectors")
+    if baseline_rows:
+        ingest(ConcatVectorIndex(), baseline_rows, batches)
+        ingest(SimpleVectorIndex(), baseline_rows, batches)
+    index = SimpleVectorIndex()
+    rates = ingest(index, n_rows, batches)
+    print(
+        f"last/first tenth rate ratio {rates[-1] / rates[0]:.2f}, "
+        f"buffer {index.capacity:,} rows ({index._buffer.nbytes / 2**20:.0f} MiB)"
+    )
+    index.compact()
+    print(f"compacted buffer {index.capacity:,} rows ({index._buffer.nbytes / 2**20:.0f} MiB)")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
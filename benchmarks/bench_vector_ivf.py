@@ -0,0 +1,79 @@
+"""Latency and recall of `IVFVectorIndex` for a range of `nprobe`, against the exact `SimpleVectorIndex`.
+
+The rows are clustered synthetic embeddings, added in batches so that the clusters are fitted and refitted
+as the index grows, and queried with perturbed rows. Recall@limit is the fraction of the exact top `limit`
+results that the IVF index finds.
+
+usage: python benchmarks/bench_vector_ivf.py [--n-rows 1_000_000] [--dim 128] [--n-queries 256]
+    [--batch-size 16] [--limit 10] [--nprobe 1,4,16,64]
+"""
+
+import time
+from typing import Sequence, Tuple, Union
+
+import fire
+import numpy as np
+
+from capabilities.search import IVFVectorIndex, SimpleVectorIndex
+from capabilities.search.types import VectorIndex
+
+
+def embeddings(rng: np.random.Generator, n_rows: int, dim: int, n_clusters: int) -> np.ndarray:
+    centers = rng.normal(size=(n_clusters, dim))
+    rows = centers[rng.integers(n_clusters, size=n_rows)]
+    rows += rng.normal(scale=0.7, size=(n_rows, dim))
+    return rows.astype(np.float32)
+
+
+def timed_search(
+    index: VectorIndex, queries: np.ndarray, batch_size: int, limit: int
+) -> Tuple[np.ndarray, float]:
+    """The result ids of every query and the mean latency of a batch of queries in seconds."""
+    ids = []
+    start = time.perf_counter()
+    for i in range(0, len(queries), batch_size):
+        ids.append(index.search(queries[i : i + batch_size], limit)[1])
+    return np.concatenate(ids), (time.perf_counter() - start) / -(-len(queries) // batch_size)
+
+
+def main(
+    n_rows: int = 1_000_000,
+    dim: int = 128,
+    n_queries: int = 256,
+    batch_size: int = 16,
+    limit: int = 10,
+    nprobe: Union[int, Sequence[int]] = (1, 4, 16, 64),
+    add_batch_size: int = 50_000,
+    n_clusters: int = 2000,
+    seed: int = 0,
+):
+    rng = np.random.default_rng(seed)
+    rows = embeddings(rng, n_rows, dim, n_clusters)
+    queries = rows[rng.integers(n_rows, size=n_queries)]
+    queries += rng.normal(scale=0.7, size=queries.shape).astype(np.float32)
+
+    exact = SimpleVectorIndex()
+    exact.add(rows.copy())
+    exact_ids, exact_latency = timed_search(exact, queries, batch_size, limit)
+    del exact
+
+    index = IVFVectorIndex(seed=seed)
+    start = time.perf_counter()
+    for i in range(0, n_rows, add_batch_size):
+        index.add(rows[i : i + add_batch_size])
+    added = time.perf_counter() - start
+    index.wait()
+    print(
+        f"{n_rows:,} rows of dim {dim} added in {added:.1f} s, {len(index.lists)} lists"
+        f" fitted in {time.perf_counter() - start:.1f} s; batches of {batch_size} queries, recall@{limit}"
+    )
+    print(f"{'exact':<12} {exact_latency * 1e3:8.2f} ms   recall 1.000")
+    for n in [nprobe] if isinstance(nprobe, int) else nprobe:
+        index.nprobe = n
+        ids, latency = timed_search(index, queries, batch_size, limit)
+        recall = np.mean([len(np.intersect1d(a, b)) / limit for a, b in zip(ids, exact_ids)])
+        print(f"{f'nprobe {n}':<12} {latency * 1e3:8.2f} ms   recall {recall:.3f}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,57 @@
+"""Time to open a persisted `MemmapVectorIndex` and query it, against unpickling a `SimpleVectorIndex`.
+
+Both indexes hold the same rows. The pickled index must be read and copied in full before its first query,
+while the memory-mapped index only reads its manifest: its first query faults the pages in from the
+page cache (or the disk, if the cache was dropped), and later processes opening it share those pages.
+
+usage: python benchmarks/bench_vector_memmap.py [--n-rows 500_000] [--dim 384] [--batch-size 10_000]
+"""
+
+import os
+import pickle
+import tempfile
+import time
+
+import fire
+import numpy as np
+
+from capabilities.search import MemmapVectorIndex, SimpleVectorIndex
+
+
+def main(n_rows: int = 500_000, dim: int = 384, batch_size: int = 10_000, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    queries = rng.normal(size=(16, dim)).astype(np.float32)
+    with tempfile.TemporaryDirectory() as directory:
+        simple = SimpleVectorIndex()
+        memmap = MemmapVectorIndex(os.path.join(directory, "index"))
+        start = time.perf_counter()
+        for i in range(0, n_rows, batch_size):
+            batch = rng.normal(size=(min(batch_size, n_rows - i), dim)).astype(np.float32)
+            simple.add(batch)
+            memmap.add(batch)
+        print(f"{n_rows:,} rows of dim {dim} ({n_rows * dim * 4 / 2**20:.0f} MiB), built in {time.perf_counter() - start:.1f} s")
+        path = os.path.join(directory, "simple.pkl")
+        with open(path, "wb") as f:
+            pickle.dump(simple, f)
+        del simple, memmap
+
+        for name, load in [
+            ("pickled SimpleVectorIndex", lambda: pickle.load(open(path, "rb"))),
+            ("MemmapVectorIndex", lambda: MemmapVectorIndex(os.path.join(directory, "index"), readonly=True)),
+        ]:
+            start = time.perf_counter()
+            index = load()
+            opened = time.perf_counter()
+            index.search(queries, 10)
+            first = time.perf_counter()
+            index.search(queries, 10)
+            second = time.perf_counter()
+            print(
+                f"{name:<26} open {(opened - start) * 1e3:9.2f} ms   first query {(first - opened) * 1e3:8.1f} ms"
+                f"   next query {(second - first) * 1e3:8.1f} ms"
+            )
+            del index
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,64 @@
+"""Memory, search latency and recall of `QuantizedVectorIndex` against the exact float64 `SimpleVectorIndex`.
+
+The rows are clustered synthetic embeddings, the queries are perturbed rows. Recall@limit is the
+fraction of the exact index's top `limit` results found by the quantized index.
+
+usage: python benchmarks/bench_vector_quantized.py [--n-rows 100_000] [--dim 384] [--n-queries 256]
+    [--batch-size 16] [--limit 10] [--rescore 4]
+"""
+
+import time
+from typing import Tuple
+
+import fire
+import numpy as np
+
+from capabilities.search import QuantizedVectorIndex, SimpleVectorIndex
+from capabilities.search.types import VectorIndex
+
+
+def embeddings(rng: np.random.Generator, n_rows: int, dim: int, n_clusters: int) -> np.ndarray:
+    centers = rng.normal(size=(n_clusters, dim))
+    return centers[rng.integers(n_clusters, size=n_rows)] + rng.normal(scale=0.5, size=(n_rows, dim))
+
+
+def timed_search(index: VectorIndex, queries: np.ndarray, batch_size: int, limit: int) -> Tuple[np.ndarray, float]:
+    """The result ids of every query and the mean latency of a batch of queries in seconds."""
+    ids = []
+    start = time.perf_counter()
+    for i in range(0, len(queries), batch_size):
+        ids.append(index.search(queries[i : i + batch_size], limit)[1])
+    return np.concatenate(ids), (time.perf_counter() - start) / -(-len(queries) // batch_size)
+
+
+def main(
+    n_rows: int = 100_000,
+    dim: int = 384,
+    n_queries: int = 256,
+    batch_size: int = 16,
+    limit: int = 10,
+    rescore: int = 4,
+    n_clusters: int = 1000,
+    seed: int = 0,
+):
+    rng = np.random.default_rng(seed)
+    rows = embeddings(rng, n_rows, dim, n_clusters)
+    queries = rows[rng.integers(n_rows, size=n_queries)] + rng.normal(scale=0.5, size=(n_queries, dim))
+    exact = SimpleVectorIndex()
+    exact.add(rows.copy())
+    exact_ids, exact_latency = timed_search(exact, queries, batch_size, limit)
+    print(f"{n_rows:,} rows of dim {dim}, batches of {batch_size} queries, recall@{limit}")
+    print(f"{'float64 exact':<22} {exact.rows.nbytes / 2**20:8.1f} MiB {exact_latency * 1e3:8.2f} ms   recall 1.000")
+    for precision in ["float32", "float16", "int8"]:
+        for r in [0, rescore] if rescore else [0]:
+            index = QuantizedVectorIndex(precision, rescore=r)
+            index.add(rows)
+            ids, latency = timed_search(index, queries, batch_size, limit)
+            recall = np.mean([len(np.intersect1d(a, b)) / limit for a, b in zip(ids, exact_ids)])
+            name = precision + (f" rescore x{r}" if r else "")
+            print(f"{name:<22} {index.nbytes / 2**20:8.1f} MiB {latency * 1e3:8.2f} ms   recall {recall:.3f}")
+            del index
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
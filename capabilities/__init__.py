@@ -1,2 +1,68 @@
-from .core import Capability
-from .dec import llm, AiFunction
\ No newline at end of file
+"""Blazon Capabilities client.
+
+The public names are imported lazily on first access, so that `import capabilities` is cheap:
+`requests`, `aiohttp`, `pydantic` and the configuration are only loaded once a capability is used.
+"""
+
+import importlib
+from typing import TYPE_CHECKING
+
+_EXPORTS = {
+    "CapabilitiesClient": ".client",
+    "get_default_client": ".client",
+    "set_default_client": ".client",
+    "AdaptiveLimiter": ".adaptive",
+    "BatchResult": ".batch",
+    "ResultCache": ".cache",
+    "RateLimiter": ".ratelimit",
+    "get_rate_limiter": ".ratelimit",
+    "set_rate_limiter": ".ratelimit",
+    "Priority": ".scheduler",
+    "Scheduler": ".scheduler",
+    "scheduling": ".scheduler",
+    "CallMetrics": ".instrumentation",
+    "HistogramAggregator": ".instrumentation",
+    "Instrumentation": ".instrumentation",
+    "get_instrumentation": ".instrumentation",
+    "set_instrumentation": ".instrumentation",
+    "MicroBatcher": ".microbatch",
+    "Pipeline": ".pipeline",
+    "Capability": ".core",
+    "llm": ".dec",
+    "AiFunction": ".dec",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted([*globals(), *__all__])
+
+
+if TYPE_CHECKING:
+    from .client import CapabilitiesClient, get_default_client, set_default_client
+    from .adaptive import AdaptiveLimiter
+    from .batch import BatchResult
+    from .cache import ResultCache
+    from .ratelimit import RateLimiter, get_rate_limiter, set_rate_limiter
+    from .scheduler import Priority, Scheduler, scheduling
+    from .instrumentation import (
+        CallMetrics,
+        HistogramAggregator,
+        Instrumentation,
+        get_instrumentation,
+        set_instrumentation,
+    )
+    from .microbatch import MicroBatcher
+    from .pipeline import Pipeline
+    from .core import Capability
+    from .dec import llm, AiFunction
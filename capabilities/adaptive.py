@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, List, Optional, Tuple, TypeVar
+
+import requests
+
+from capabilities.retry import RetryError, status_of
+
+logger = logging.getLogger("capabilities")
+
+T = TypeVar("T")
+
+OVERLOAD_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+def is_overload(e: BaseException) -> bool:
+    """429s, 5xx responses and timeouts are signs that the server is overloaded.
+
+    A `RetryError` is judged by the last error that was retried.
+    """
+    if isinstance(e, RetryError) and e.__cause__ is not None:
+        e = e.__cause__
+    status = status_of(e)
+    if status is not None:
+        return status in OVERLOAD_STATUSES
+    return isinstance(e, (requests.Timeout, asyncio.TimeoutError))
+
+
+@dataclass
+class AdaptiveStats:
+    calls: int = 0
+    successes: int = 0
+    overloads: int = 0
+    """ Calls that failed with `is_overload`. """
+    spikes: int = 0
+    """ Calls whose latency exceeded `latency_tolerance` times the baseline. """
+    decreases: int = 0
+    """ Number of times the limit was cut. """
+
+
+class AdaptiveLimiter:
+    """Concurrency limit adjusted by additive increase / multiplicative decrease (AIMD).
+
+    Each call holds one of `limit` slots while it runs. Every healthy completion raises the limit by
+    `increase / limit`, ie by about `increase` per window of `limit` calls. A call failing with a 429, a 5xx
+    or a timeout, or taking longer than `latency_tolerance` times the baseline latency (a moving average
+    of the observed latencies), multiplies the limit by `decrease`. The limit is cut at most once per
+    baseline latency, so a burst of failures from the same window of calls only counts once.
+
+    The limiter can be shared by threads and event loops. Pass it as the `concurrency` of
+    `map`/`amap`/`batch`/`abatch`, or as the `concurrency_limiter` of a `CapabilitiesClient`
+    to apply it to every request. `limit`, `in_flight` and `stats` can be exported to dashboards.
+
+    Args:
+        initial_limit: starting concurrency limit.
+        min_limit: the limit is never cut below this.
+        max_limit: the limit is never raised above this.
+        increase: additive increase per window of `limit` healthy calls.
+        decrease: multiplicative decrease factor on overload.
+        latency_tolerance: a call is a latency spike if it takes longer than this many times the baseline.
+        smoothing: weight of each new sample in the baseline latency's moving average.
+    """
+
+    def __init__(
+        self,
+        initial_limit: float = 8,
+        min_limit: float = 1,
+        max_limit: float = 64,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+        latency_tolerance: float = 2.0,
+        smoothing: float = 0.1,
+    ):
+        if not 1 <= min_limit <= initial_limit <= max_limit:
+            raise ValueError("limits must satisfy 1 <= min_limit <= initial_limit <= max_limit")
+        if not 0 < decrease < 1:
+            raise ValueError(f"decrease must be between 0 and 1, got {decrease}")
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+        self.stats = AdaptiveStats()
+        self.baseline_latency: Optional[float] = None
+        self._limit = float(initial_limit)
+        self._in_flight = 0
+        self._last_decrease = float("-inf")
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+    @property
+    def limit(self) -> int:
+        """The number of calls currently allowed in flight."""
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def _try_acquire(self) -> bool:
+        if self._in_flight < int(self._limit):
+            self._in_flight += 1
+            return True
+        return False
+
+    def acquire(self):
+        """Blocks until a slot is free and takes it. Must be followed by `release`."""
+        with self._cond:
+            while not self._try_acquire():
+                self._cond.wait()
+
+    async def acquire_async(self):
+        """Async version of `acquire`."""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if self._try_acquire():
+                    return
+                waiter = loop.create_future()
+                self._waiters.append((loop, waiter))
+            await waiter
+
+    def release(self, latency: Optional[float] = None, error: Optional[BaseException] = None):
+        """Frees a slot and adjusts the limit according to the outcome of the call."""
+        with self._cond:
+            self._in_flight -= 1
+            self._update(latency, error)
+            waiters, self._waiters = self._waiters, []
+            # everyone retries, waiters that were cancelled meanwhile don't swallow a wake-up.
+            self._cond.notify_all()
+        for loop, waiter in waiters:
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(_wake, waiter)
+
+    def _update(self, latency: Optional[float], error: Optional[BaseException]):
+        self.stats.calls += 1
+        if error is not None:
+            if is_overload(error):
+                self.stats.overloads += 1
+                self._cut(f"{error!r}")
+            return
+        if latency is None:
+            return
+        baseline = self.baseline_latency
+        if baseline is not None and latency > self.latency_tolerance * baseline:
+            self.stats.spikes += 1
+            self._cut(f"latency {latency:.3f}s over baseline {baseline:.3f}s")
+        else:
+            self.stats.successes += 1
+            self._limit = min(self.max_limit, self._limit + self.increase / self._limit)
+        self.baseline_latency = (
+            latency
+            if baseline is None
+            else (1 - self.smoothing) * baseline + self.smoothing * latency
+        )
+
+    def _cut(self, reason: str):
+        now = time.monotonic()
+        if now - self._last_decrease < (self.baseline_latency or 0.0):
+            return
+        self._last_decrease = now
+        self._limit = max(self.min_limit, self._limit * self.decrease)
+        self.stats.decreases += 1
+        logger.info(f"[adaptive] {reason}, concurrency limit cut to {self.limit}")
+
+    def call(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """Calls `fn(*args, **kwargs)` holding a slot."""
+        self.acquire()
+        start = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self.release(error=e)
+            raise
+        self.release(latency=time.monotonic() - start)
+        return result
+
+    async def call_async(self, fn: Callable[..., Awaitable[T]], *args, **kwargs) -> T:
+        """Awaits `fn(*args, **kwargs)` holding a slot."""
+        await self.acquire_async()
+        start = time.monotonic()
+        try:
+            result = await fn(*args, **kwargs)
+        except BaseException as e:
+            self.release(error=e)
+            raise
+        self.release(latency=time.monotonic() - start)
+        return result
+
+
+def _wake(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
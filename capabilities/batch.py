@@ -0,0 +1,223 @@
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Generic,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
+
+from capabilities.adaptive import AdaptiveLimiter
+from capabilities.scheduler import Priority, scheduling
+
+T = TypeVar("T")
+
+
+@dataclass
+class BatchResult(Generic[T]):
+    """Outcome of one item of a batch.
+
+    Failures are collected per item: if the call raised, `error` is set and `output` is None.
+    """
+
+    index: int
+    """ Position of the item in the input sequence. """
+    input: Any
+    output: Optional[T] = None
+    error: Optional[BaseException] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def unwrap(self) -> T:
+        """Returns the output, or raises the error of a failed item."""
+        if self.error is not None:
+            raise self.error
+        return self.output  # type: ignore
+
+
+def call_args(item: Any, kwargs: dict) -> Tuple[tuple, dict]:
+    """Converts a batch item to call arguments.
+
+    A tuple is passed as positional arguments, a dict as keyword arguments,
+    and anything else as a single positional argument.
+    `kwargs` are shared by all items and merged into each call.
+    """
+    if isinstance(item, tuple):
+        return item, kwargs
+    elif isinstance(item, dict):
+        return (), {**kwargs, **item}
+    else:
+        return (item,), kwargs
+
+
+async def _run_one(
+    fn: Callable[..., Awaitable[T]],
+    index: int,
+    item: Any,
+    kwargs: dict,
+    priority: Optional[Priority] = None,
+) -> BatchResult[T]:
+    args, kw = call_args(item, kwargs)
+    try:
+        with scheduling(priority=priority):
+            return BatchResult(index, item, output=await fn(*args, **kw))
+    except Exception as e:
+        return BatchResult(index, item, error=e)
+
+
+def _window(concurrency: Union[int, AdaptiveLimiter]) -> int:
+    if isinstance(concurrency, AdaptiveLimiter):
+        return int(concurrency.max_limit)
+    if concurrency < 1:
+        raise ValueError(f"concurrency must be positive, got {concurrency}")
+    return concurrency
+
+
+REORDER_WINDOWS = 4
+""" Ordered maps start calls until the calls in flight and the results waiting for an earlier one
+span this many windows of `concurrency` inputs. """
+
+
+class _Reorder(Generic[T]):
+    """Buffers results that complete out of order, and releases them in input order."""
+
+    def __init__(self):
+        self._buffered: Dict[int, BatchResult[T]] = {}
+        self._next = 0
+
+    def __len__(self):
+        return len(self._buffered)
+
+    def push(self, results: Iterable[BatchResult[T]]) -> List[BatchResult[T]]:
+        """Adds completed results, returning those that are now next in input order."""
+        for r in results:
+            self._buffered[r.index] = r
+        ready = []
+        while self._next in self._buffered:
+            ready.append(self._buffered.pop(self._next))
+            self._next += 1
+        return ready
+
+
+async def amap_calls(
+    fn: Callable[..., Awaitable[T]],
+    inputs: Iterable[Any],
+    concurrency: Union[int, AdaptiveLimiter] = 8,
+    ordered: bool = True,
+    priority: Optional[Priority] = Priority.LOW,
+    **kwargs,
+) -> AsyncIterator[BatchResult[T]]:
+    """Runs `fn` over `inputs` with at most `concurrency` calls in flight.
+
+    Inputs are pulled lazily, so a new call is only started once an earlier one has finished (backpressure).
+    If `ordered` is True results are yielded in input order, otherwise as soon as they complete.
+    Ordered results that complete before an earlier one are buffered, and calls keep being started until
+    `REORDER_WINDOWS * concurrency` inputs are in flight or buffered, so a slow call doesn't stall the rest.
+    Failed items are yielded as `BatchResult`s with `error` set, the rest of the batch carries on.
+    If `concurrency` is an `AdaptiveLimiter`, calls run in its slots and up to its `max_limit` inputs are pulled ahead.
+    Calls are made at `priority`, so that a client's `Scheduler` serves single calls first.
+    None keeps the caller's priority.
+    """
+    window_size = _window(concurrency)
+    if isinstance(concurrency, AdaptiveLimiter):
+        fn = functools.partial(concurrency.call_async, fn)
+    it = enumerate(inputs)
+    pending: set = set()
+    reorder: _Reorder[T] = _Reorder()
+    lookahead = window_size * (REORDER_WINDOWS if ordered else 1)
+
+    def fill(tasks):
+        while len(tasks) < window_size and len(tasks) + len(reorder) < lookahead:
+            try:
+                i, item = next(it)
+            except StopIteration:
+                return
+            tasks.add(asyncio.ensure_future(_run_one(fn, i, item, kwargs, priority)))
+
+    try:
+        fill(pending)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            results = [task.result() for task in done]
+            if ordered:
+                results = reorder.push(results)
+            fill(pending)
+            for result in results:
+                yield result
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def _run_one_sync(
+    fn: Callable[..., T],
+    index: int,
+    item: Any,
+    kwargs: dict,
+    priority: Optional[Priority] = None,
+) -> BatchResult[T]:
+    args, kw = call_args(item, kwargs)
+    try:
+        with scheduling(priority=priority):
+            return BatchResult(index, item, output=fn(*args, **kw))
+    except Exception as e:
+        return BatchResult(index, item, error=e)
+
+
+def map_calls(
+    fn: Callable[..., T],
+    inputs: Iterable[Any],
+    concurrency: Union[int, AdaptiveLimiter] = 8,
+    ordered: bool = True,
+    priority: Optional[Priority] = Priority.LOW,
+    **kwargs,
+) -> Iterator[BatchResult[T]]:
+    """Blocking version of `amap_calls`, running `fn` on a pool of `concurrency` threads
+    (or `max_limit` threads for an `AdaptiveLimiter`)."""
+    window_size = _window(concurrency)
+    if isinstance(concurrency, AdaptiveLimiter):
+        fn = functools.partial(concurrency.call, fn)
+    it = enumerate(inputs)
+    pending: set = set()
+    reorder: _Reorder[T] = _Reorder()
+    lookahead = window_size * (REORDER_WINDOWS if ordered else 1)
+    with ThreadPoolExecutor(max_workers=window_size) as ex:
+
+        def fill(futures):
+            while len(futures) < window_size and len(futures) + len(reorder) < lookahead:
+                try:
+                    i, item = next(it)
+                except StopIteration:
+                    return
+                # the calls inherit the caller's tenant and deadline.
+                f = ex.submit(
+                    contextvars.copy_context().run, _run_one_sync, fn, i, item, kwargs, priority
+                )
+                futures.add(f)
+
+        try:
+            fill(pending)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                results = [f.result() for f in done]
+                if ordered:
+                    results = reorder.push(results)
+                fill(pending)
+                yield from results
+        finally:
+            for f in pending:
+                f.cancel()
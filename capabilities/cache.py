@@ -0,0 +1,130 @@
+import collections
+import copy
+import json
+import threading
+import time
+from dataclasses import dataclass
+from hashlib import blake2b
+from pathlib import Path
+from typing import Any, Optional, Tuple, Union
+
+MISSING: Any = object()
+
+
+def payload_key(path: str, payload: Any) -> str:
+    """Canonical hash of a request: the same path and payload always give the same key,
+    regardless of dict ordering. Pre-encoded json bytes are hashed as they are."""
+    h = blake2b(digest_size=20)
+    h.update(path.encode("utf-8"))
+    h.update(b"\0")
+    if isinstance(payload, bytes):
+        h.update(payload)
+        return h.hexdigest()
+    h.update(
+        json.dumps(
+            payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+        ).encode("utf-8")
+    )
+    return h.hexdigest()
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    """ Lookups answered by either tier. """
+    misses: int = 0
+    disk_hits: int = 0
+    """ Lookups that missed the memory tier but were answered by the disk tier. """
+    evictions: int = 0
+    """ Entries dropped from the memory tier because it was full. """
+
+
+class ResultCache:
+    """Exact-match cache of capability responses, keyed by `payload_key`.
+
+    Responses are kept in an in-memory LRU tier and, if a `directory` is given,
+    in a `diskcache` tier that survives restarts and is shared between processes.
+    Values are copied when they are set and on every hit, so callers can mutate what they get.
+
+    Args:
+        max_size: maximum number of entries in the memory tier.
+        ttl: seconds after which an entry expires. None means entries never expire.
+        directory: location of the disk tier. If None, only the memory tier is used.
+        disk_size_limit: maximum size of the disk tier in bytes.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 1024,
+        ttl: Optional[float] = None,
+        directory: Optional[Union[str, Path]] = None,
+        disk_size_limit: int = 2**30,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._entries: "collections.OrderedDict[str, Tuple[float, Any]]" = (
+            collections.OrderedDict()
+        )
+        self._disk = None
+        if directory is not None:
+            try:
+                from diskcache import Cache
+            except ModuleNotFoundError:
+                raise ModuleNotFoundError(
+                    "In order to use a disk cache tier, please run `pip install diskcache`"
+                )
+            self._disk = Cache(str(directory), size_limit=disk_size_limit)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _expiry(self) -> float:
+        return time.monotonic() + self.ttl if self.ttl is not None else float("inf")
+
+    def _set_memory(self, key: str, value: Any, expires_at: float):
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+
+    def get(self, key: str) -> Any:
+        """Returns a copy of the cached response for `key`, or `MISSING`."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.stats.hits += 1
+                    return copy.deepcopy(value)
+                del self._entries[key]
+        if self._disk is not None:
+            value, expire_time = self._disk.get(key, default=MISSING, expire_time=True)
+            if value is not MISSING:
+                # the disk tier's expiry is wall clock time, the memory tier's is monotonic.
+                expires_at = float("inf")
+                if expire_time is not None:
+                    expires_at = time.monotonic() + expire_time - time.time()
+                with self._lock:
+                    self._set_memory(key, value, expires_at)
+                    self.stats.hits += 1
+                    self.stats.disk_hits += 1
+                return copy.deepcopy(value)
+        with self._lock:
+            self.stats.misses += 1
+        return MISSING
+
+    def set(self, key: str, value: Any):
+        with self._lock:
+            self._set_memory(key, copy.deepcopy(value), self._expiry())
+        if self._disk is not None:
+            self._disk.set(key, value, expire=self.ttl)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self._disk is not None:
+            self._disk.clear()
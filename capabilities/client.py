@@ -0,0 +1,793 @@
+import asyncio
+import functools
+import logging
+import threading
+import time
+import weakref
+from typing import TYPE_CHECKING, Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from capabilities.adaptive import AdaptiveLimiter
+from capabilities.cache import MISSING, ResultCache, payload_key
+from capabilities.coalesce import SingleFlight
+from capabilities.instrumentation import (
+    CallMetrics,
+    Instrumentation,
+    current_metrics,
+    get_instrumentation,
+    measuring,
+)
+from capabilities.payload import compress, dumps, loads
+from capabilities.ratelimit import RateLimiter, get_rate_limiter
+from capabilities.resilience import CallPolicy
+from capabilities.retry import DeadlineExceeded, RetryPolicy
+from capabilities.scheduler import Scheduler, current_deadline, current_priority, scheduling
+from capabilities.streaming import Event, StreamParser, result_events
+
+if TYPE_CHECKING:
+    import aiohttp
+
+logger = logging.getLogger("capabilities")
+
+DEFAULT_BASE_URL = "https://api.blazon.ai"
+
+OFFLOAD_COMPRESSION_BYTES = 2**20
+""" Async request bodies at least this large are compressed, and their tokens counted, on a worker thread. """
+
+STREAM_HEADERS = {"Accept": "text/event-stream, application/x-ndjson, application/json"}
+
+
+def _flight_key(key: str) -> str:
+    # only calls of the same priority class are coalesced, so a single call never waits in a batch's queue.
+    return f"{key}/{current_priority().name}"
+
+
+def _deadline(policy: Optional[CallPolicy]) -> Optional[float]:
+    """The deadline of a call under `policy`, that a call joining an identical one waits for it until."""
+    with scheduling(timeout=policy.timeout if policy is not None else None):
+        return current_deadline()
+
+
+class CapabilitiesClient:
+    """HTTP transport shared by all capabilities.
+
+    The client owns a keep-alive connection pool for blocking calls (a `requests.Session`)
+    and one `aiohttp.ClientSession` per running event loop for async calls, so that
+    consecutive calls reuse TCP+TLS connections instead of paying for a new handshake each time.
+
+    A single client can be shared between threads and event loops:
+    the blocking pool is backed by urllib3's thread-safe connection pools,
+    and async sessions are created lazily for each event loop that uses the client.
+
+    Args:
+        base_url: root URL that capability paths are resolved against.
+        api_key: Blazon API key. Defaults to the configured `api_key` at request time, see `get_config`.
+        pool_connections: number of per-host pools cached by the blocking session.
+        pool_maxsize: maximum number of keep-alive connections kept per host by the blocking session.
+        limit: maximum number of simultaneous connections per async session (0 means unlimited).
+        limit_per_host: maximum number of simultaneous connections per host per async session (0 means unlimited).
+        keepalive_timeout: seconds an idle async connection is kept open.
+        ssl: whether async connections verify TLS certificates.
+        retry: the `RetryPolicy` applied to every request. Retry counts are accumulated in `retry.stats`.
+        cache: if given, responses are cached by a canonical hash of the request path, payload and headers,
+            and identical requests are answered from the cache without a network call.
+        coalesce: whether concurrent identical requests (same canonical hash of the path, payload and headers)
+            of the same priority class share a single call, see `SingleFlight`. Async calls given their own
+            session are not shared. The number of shared calls is counted in `single_flight.stats.deduplicated`.
+        rate_limiter: the `RateLimiter` that every request waits on before it is sent.
+            Defaults to the process-wide limiter, see `set_rate_limiter`.
+        concurrency_limiter: if given, every request attempt holds one of its slots while it runs,
+            so the number of requests in flight adapts to the observed latencies and overload errors.
+        scheduler: if given, every request attempt is admitted by it, by priority class, tenant and deadline,
+            see `Scheduler` and `scheduling`. Attempts that can no longer finish in time are dropped unsent.
+        instrumentation: receives the `CallMetrics` of every `post`/`apost` call.
+            Defaults to the process-wide instrumentation, see `set_instrumentation`.
+        compression: `Content-Encoding` of request bodies, "gzip", "deflate" or None (the default) to send
+            them uncompressed. Only enable it for servers that accept compressed bodies;
+            hosts that reject them (400 or 415) are sent uncompressed bodies afterwards.
+        compress_min_bytes: bodies smaller than this are sent uncompressed.
+        compress_level: zlib compression level.
+    """
+
+    def __init__(
+        self,
+        base_url: str = DEFAULT_BASE_URL,
+        api_key: Optional[str] = None,
+        *,
+        pool_connections: int = 10,
+        pool_maxsize: int = 100,
+        limit: int = 100,
+        limit_per_host: int = 0,
+        keepalive_timeout: float = 30.0,
+        ssl: bool = False,
+        retry: Optional[RetryPolicy] = None,
+        cache: Optional[ResultCache] = None,
+        coalesce: bool = True,
+        rate_limiter: Optional[RateLimiter] = None,
+        concurrency_limiter: Optional[AdaptiveLimiter] = None,
+        scheduler: Optional[Scheduler] = None,
+        instrumentation: Optional[Instrumentation] = None,
+        compression: Optional[str] = None,
+        compress_min_bytes: int = 4096,
+        compress_level: int = 6,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.ssl = ssl
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.cache = cache
+        # a joiner whose leader missed its own deadline makes the call itself.
+        self.single_flight: Optional[SingleFlight] = (
+            SingleFlight(rejoin=(DeadlineExceeded,)) if coalesce else None
+        )
+        self.rate_limiter = rate_limiter
+        self.concurrency_limiter = concurrency_limiter
+        self.scheduler = scheduler
+        self.instrumentation = instrumentation
+        self.compression = compression
+        self.compress_min_bytes = compress_min_bytes
+        self.compress_level = compress_level
+        self._uncompressed_hosts: set = set()
+        self._lock = threading.Lock()
+        self._session: Optional[requests.Session] = None
+        self._async_sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession]" = (
+            weakref.WeakKeyDictionary()
+        )
+
+    def url(self, path: str) -> str:
+        """Resolves a capability path (or absolute url) against `base_url`."""
+        if path.startswith("http://") or path.startswith("https://"):
+            return path
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        api_key = self.api_key
+        if api_key is None:
+            from capabilities.config import get_config
+
+            api_key = get_config().api_key
+        headers = {"Content-Type": "application/json"}
+        if api_key is not None:
+            headers["api-key"] = api_key
+        return headers
+
+    @property
+    def session(self) -> requests.Session:
+        """The pooled blocking session, created on first use."""
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(
+                        pool_connections=self.pool_connections,
+                        pool_maxsize=self.pool_maxsize,
+                    )
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._session = session
+        return self._session
+
+    def async_session(self) -> "aiohttp.ClientSession":
+        """The pooled `aiohttp.ClientSession` for the running event loop, created on first use."""
+        # aiohttp is only imported by async calls, blocking ones don't pay for it.
+        import aiohttp
+
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            session = self._async_sessions.get(loop)
+            if session is None or session.closed:
+                connector = aiohttp.TCPConnector(
+                    limit=self.limit,
+                    limit_per_host=self.limit_per_host,
+                    keepalive_timeout=self.keepalive_timeout,
+                    ssl=self.ssl,
+                )
+                session = aiohttp.ClientSession(connector=connector)
+                self._async_sessions[loop] = session
+            return session
+
+    def post(
+        self,
+        path: str,
+        payload: Any,
+        headers: Optional[dict] = None,
+        policy: Optional[CallPolicy] = None,
+    ) -> Any:
+        """POSTs `payload` as json and returns the decoded json response.
+
+        `payload` is either a json-like value or already-encoded json bytes (eg from a `PayloadTemplate`).
+        Retryable failures (connection errors, 429s and 5xx responses) are retried according to `self.retry`.
+        If a `policy` is given, the call is subject to its deadline, hedging and circuit breaker.
+        """
+        instrumentation = self.instrumentation_hook()
+        if not instrumentation.enabled:
+            return self._request(path, payload, headers, policy)
+        with instrumentation.measure(path):
+            return self._request(path, payload, headers, policy)
+
+    def _request(
+        self, path: str, payload: Any, headers: Optional[dict], policy: Optional[CallPolicy]
+    ) -> Any:
+        url = self.url(path)
+        body = self._encode(payload)
+        if self.cache is None and self.single_flight is None:
+            return self._call(url, body, headers, policy)
+        key = self._request_key(url, payload, headers)
+        if self.cache is not None:
+            result = self._cached(key)
+            if result is not MISSING:
+                return result
+        if self.single_flight is None:
+            return self._fetch(key, url, body, headers, policy)
+        return self.single_flight.call(
+            _flight_key(key),
+            self._fetch,
+            key,
+            url,
+            body,
+            headers,
+            policy,
+            deadline=_deadline(policy),
+        )
+
+    def _attempt(
+        self,
+        url: str,
+        body: bytes,
+        headers: Optional[dict],
+        tokens: int,
+        timeout: Optional[float] = None,
+    ) -> Any:
+        post: Callable[..., Any] = self._post
+        if self.concurrency_limiter is not None:
+            post = functools.partial(self.concurrency_limiter.call, post)
+        # throttled before taking a concurrency slot, so that the limiter only measures the request itself.
+        post = functools.partial(self._throttled, tokens, post)
+        if self.scheduler is not None:
+            post = functools.partial(self.scheduler.call, post)
+        return post(url, body, headers, timeout)
+
+    def _call(
+        self, url: str, body: bytes, headers: Optional[dict], policy: Optional[CallPolicy]
+    ) -> Any:
+        # counted once per call rather than per attempt, as the retries and hedges send the same body.
+        tokens = self._cost(body)
+        if policy is None:
+            return self.retry.call(self._attempt, url, body, headers, tokens)
+        return policy.call(
+            self.retry,
+            urlsplit(url).netloc,
+            functools.partial(self._attempt, url, body, headers, tokens),
+        )
+
+    def _fetch(
+        self,
+        key: str,
+        url: str,
+        body: bytes,
+        headers: Optional[dict],
+        policy: Optional[CallPolicy],
+    ) -> Any:
+        result = self._call(url, body, headers, policy)
+        if self.cache is not None:
+            self.cache.set(key, result)
+        return result
+
+    def instrumentation_hook(self) -> Instrumentation:
+        """The instrumentation that calls are reported to."""
+        return self.instrumentation if self.instrumentation is not None else get_instrumentation()
+
+    def _encode(self, payload: Any) -> bytes:
+        if isinstance(payload, bytes):
+            return payload
+        metrics = current_metrics()
+        if metrics is None:
+            return dumps(payload)
+        start = time.perf_counter()
+        body = dumps(payload)
+        metrics.serialize_seconds += time.perf_counter() - start
+        return body
+
+    def _cached(self, key: str) -> Any:
+        assert self.cache is not None
+        result = self.cache.get(key)
+        metrics = current_metrics()
+        if metrics is not None and result is not MISSING:
+            metrics.cached = True
+        return result
+
+    def _decode(self, content: bytes) -> Any:
+        metrics = current_metrics()
+        if metrics is None:
+            return loads(content)
+        start = time.perf_counter()
+        result = loads(content)
+        metrics.decode_seconds += time.perf_counter() - start
+        metrics.response_bytes = len(content)
+        return result
+
+    def limiter(self) -> Optional[RateLimiter]:
+        """The rate limiter that requests wait on, if any."""
+        return self.rate_limiter if self.rate_limiter is not None else get_rate_limiter()
+
+    def _cost(self, body: bytes) -> int:
+        """Estimated number of tokens of a request body for the rate limiter."""
+        limiter = self.limiter()
+        return limiter.cost(body) if limiter is not None else 0
+
+    async def _acost(self, body: bytes) -> int:
+        limiter = self.limiter()
+        if limiter is None:
+            return 0
+        if len(body) >= OFFLOAD_COMPRESSION_BYTES:
+            # don't hold up the event loop while tokenizing large documents
+            return await asyncio.get_running_loop().run_in_executor(None, limiter.cost, body)
+        return limiter.cost(body)
+
+    def _throttled(self, tokens: int, send: Callable[..., Any], url: str, *args) -> Any:
+        """Waits on the rate limiter for a request costing `tokens`, then calls `send(url, *args)`."""
+        limiter = self.limiter()
+        if limiter is not None:
+            limiter.acquire(tokens)
+        return send(url, *args)
+
+    async def _athrottled(self, tokens: int, send: Callable[..., Awaitable[Any]], url: str, *args) -> Any:
+        limiter = self.limiter()
+        if limiter is not None:
+            await limiter.acquire_async(tokens)
+        return await send(url, *args)
+
+    def _encoding_for(self, url: str, body: bytes) -> Optional[str]:
+        if self.compression is None or len(body) < self.compress_min_bytes:
+            return None
+        if urlsplit(url).netloc in self._uncompressed_hosts:
+            return None
+        return self.compression
+
+    def _request_headers(self, headers: Optional[dict], encoding: Optional[str]) -> dict:
+        h = self.headers
+        if headers:
+            h.update(headers)
+        if encoding is not None:
+            h["Content-Encoding"] = encoding
+        return h
+
+    def _request_key(
+        self,
+        url: str,
+        payload: Any,
+        headers: Optional[dict],
+        session: "Optional[aiohttp.ClientSession]" = None,
+    ) -> str:
+        """Key of a request in the cache and in the single flight: its url, payload and a digest of the
+        headers it is sent with, including the default headers of its `session`, so that responses to
+        different credentials or tenants are never shared."""
+        sent = {k.lower(): v for k, v in (session.headers if session is not None else {}).items()}
+        sent.update((k.lower(), v) for k, v in self._request_headers(headers, None).items())
+        return payload_key(f"{url}#{payload_key('headers', sent)}", payload)
+
+    def _compression_rejected(self, encoding: Optional[str], status: int) -> bool:
+        return encoding is not None and status in (400, 415)
+
+    def _mark_uncompressed(self, url: str):
+        host = urlsplit(url).netloc
+        logger.info(f"{host} rejected compressed request bodies, sending them uncompressed from now on")
+        with self._lock:
+            self._uncompressed_hosts.add(host)
+
+    def _send(
+        self,
+        url: str,
+        body: bytes,
+        headers: Optional[dict],
+        stream: bool = False,
+        timeout: Optional[float] = None,
+    ) -> requests.Response:
+        encoding = self._encoding_for(url, body)
+        data = compress(body, encoding, self.compress_level)
+        resp = self.session.post(
+            url,
+            headers=self._request_headers(headers, encoding),
+            data=data,
+            stream=stream,
+            timeout=timeout,
+        )
+        if self._compression_rejected(encoding, resp.status_code):
+            resp.close()
+            data = body
+            resp = self.session.post(
+                url,
+                headers=self._request_headers(headers, None),
+                data=data,
+                stream=stream,
+                timeout=timeout,
+            )
+            if resp.ok:
+                self._mark_uncompressed(url)
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics.attempts += 1
+            metrics.request_bytes = len(data)
+            # requests measures the time until the response headers were parsed.
+            metrics.ttfb_seconds = resp.elapsed.total_seconds()
+        if not resp.ok:
+            resp.close()
+        resp.raise_for_status()
+        return resp
+
+    def _post(
+        self, url: str, body: bytes, headers: Optional[dict], timeout: Optional[float] = None
+    ) -> Any:
+        return self._decode(self._send(url, body, headers, timeout=timeout).content)
+
+    def stream(
+        self,
+        path: str,
+        payload: Any,
+        text_of: Callable[[Any], Optional[str]],
+        headers: Optional[dict] = None,
+        policy: Optional[CallPolicy] = None,
+    ) -> Iterator[Event]:
+        """POSTs `payload` and yields the events of the streamed response as they arrive, see `StreamParser`.
+
+        Establishing the stream is retried according to `self.retry`, the stream itself is not.
+        If the server answers with plain json, `text_of(response)` is yielded as a single text chunk.
+        A `policy`'s deadline and circuit breaker apply to establishing the stream and its `attempt_timeout`
+        bounds the wait for each chunk. Streams are never hedged.
+        The `CallMetrics` of a stream are recorded when it ends, with the time to its first event as TTFB.
+        """
+        instrumentation = self.instrumentation_hook()
+        if not instrumentation.enabled:
+            yield from self._stream(path, payload, text_of, headers, policy, None)
+            return
+        with instrumentation.measure(path, current=False) as metrics:
+            yield from self._stream(path, payload, text_of, headers, policy, metrics)
+
+    def _stream(
+        self,
+        path: str,
+        payload: Any,
+        text_of: Callable[[Any], Optional[str]],
+        headers: Optional[dict],
+        policy: Optional[CallPolicy],
+        metrics: Optional[CallMetrics],
+    ) -> Iterator[Event]:
+        url = self.url(path)
+        headers = {**STREAM_HEADERS, **(headers or {})}
+        with measuring(metrics):
+            body = self._encode(payload)
+            tokens = self._cost(body)
+            if policy is None:
+                resp = self.retry.call(self._throttled, tokens, self._send, url, body, headers, True)
+            else:
+                resp = policy.call(
+                    self.retry,
+                    urlsplit(url).netloc,
+                    functools.partial(self._throttled, tokens, self._send, url, body, headers, True),
+                    hedge=False,
+                )
+        established: Optional[float] = time.perf_counter()
+
+        def first_event():
+            # ttfb_seconds is the wait for the response headers, the wait for the first event is added to it.
+            nonlocal established
+            if metrics is not None and established is not None:
+                metrics.ttfb_seconds += time.perf_counter() - established
+                established = None
+
+        try:
+            content_type = resp.headers.get("Content-Type", "")
+            if content_type.startswith("application/json"):
+                for event in result_events(loads(resp.content), text_of):
+                    first_event()
+                    yield event
+                return
+            resp.encoding = resp.encoding or "utf-8"
+            parser = StreamParser(content_type)
+            for line in resp.iter_lines(chunk_size=None, decode_unicode=True):
+                event = parser.feed(line)
+                if event is not None:
+                    first_event()
+                    yield event
+            event = parser.close()
+            if event is not None:
+                first_event()
+                yield event
+        finally:
+            resp.close()
+
+    async def apost(
+        self,
+        path: str,
+        payload: Any,
+        headers: Optional[dict] = None,
+        session: "Optional[aiohttp.ClientSession]" = None,
+        policy: Optional[CallPolicy] = None,
+    ) -> Any:
+        """Async version of `post`. If `session` is not given, the pooled session for the running loop is used."""
+        instrumentation = self.instrumentation_hook()
+        if not instrumentation.enabled:
+            return await self._arequest(path, payload, headers, session, policy)
+        with instrumentation.measure(path):
+            return await self._arequest(path, payload, headers, session, policy)
+
+    async def _arequest(
+        self,
+        path: str,
+        payload: Any,
+        headers: Optional[dict],
+        session: "Optional[aiohttp.ClientSession]",
+        policy: Optional[CallPolicy],
+    ) -> Any:
+        url = self.url(path)
+        body = self._encode(payload)
+        if self.cache is None and self.single_flight is None:
+            return await self._acall(url, body, headers, session, policy)
+        key = self._request_key(url, payload, headers, session)
+        if self.cache is not None:
+            result = self._cached(key)
+            if result is not MISSING:
+                return result
+        # a caller's own session may carry its own cookies or credentials, so its calls aren't shared.
+        if self.single_flight is None or session is not None:
+            return await self._afetch(key, url, body, headers, session, policy)
+        return await self.single_flight.call_async(
+            _flight_key(key),
+            self._afetch,
+            key,
+            url,
+            body,
+            headers,
+            session,
+            policy,
+            deadline=_deadline(policy),
+        )
+
+    async def _aattempt(
+        self,
+        url: str,
+        body: bytes,
+        headers: Optional[dict],
+        session: "Optional[aiohttp.ClientSession]",
+        tokens: int,
+        timeout: Optional[float] = None,
+    ) -> Any:
+        post: Callable[..., Awaitable[Any]] = self._apost
+        if self.concurrency_limiter is not None:
+            post = functools.partial(self.concurrency_limiter.call_async, post)
+        # throttled before taking a concurrency slot, so that the limiter only measures the request itself.
+        post = functools.partial(self._athrottled, tokens, post)
+        if self.scheduler is not None:
+            post = functools.partial(self.scheduler.call_async, post)
+        return await post(url, body, headers, session, timeout)
+
+    async def _acall(
+        self,
+        url: str,
+        body: bytes,
+        headers: Optional[dict],
+        session: "Optional[aiohttp.ClientSession]",
+        policy: Optional[CallPolicy],
+    ) -> Any:
+        tokens = await self._acost(body)
+        if policy is None:
+            return await self.retry.call_async(self._aattempt, url, body, headers, session, tokens)
+        return await policy.call_async(
+            self.retry,
+            urlsplit(url).netloc,
+            functools.partial(self._aattempt, url, body, headers, session, tokens),
+        )
+
+    async def _afetch(
+        self,
+        key: str,
+        url: str,
+        body: bytes,
+        headers: Optional[dict],
+        session: "Optional[aiohttp.ClientSession]",
+        policy: Optional[CallPolicy],
+    ) -> Any:
+        result = await self._acall(url, body, headers, session, policy)
+        if self.cache is not None:
+            self.cache.set(key, result)
+        return result
+
+    async def _asend(
+        self,
+        url: str,
+        body: bytes,
+        headers: Optional[dict],
+        session: "Optional[aiohttp.ClientSession]",
+        timeout: Optional[float] = None,
+        stream: bool = False,
+    ) -> "aiohttp.ClientResponse":
+        """Sends the request and returns the response with its body unread. The caller must release it.
+
+        `timeout` bounds the whole request, or for a `stream` the wait for each chunk.
+        """
+        session = session or self.async_session()
+        encoding = self._encoding_for(url, body)
+        if encoding is not None and len(body) >= OFFLOAD_COMPRESSION_BYTES:
+            # don't hold up the event loop while compressing large documents
+            data = await asyncio.get_running_loop().run_in_executor(
+                None, compress, body, encoding, self.compress_level
+            )
+        else:
+            data = compress(body, encoding, self.compress_level)
+        kwargs = {}
+        if timeout is not None:
+            import aiohttp
+
+            kwargs["timeout"] = (
+                aiohttp.ClientTimeout(sock_connect=timeout, sock_read=timeout)
+                if stream
+                else aiohttp.ClientTimeout(total=timeout)
+            )
+        start = time.perf_counter()
+        resp = await session.post(
+            url, headers=self._request_headers(headers, encoding), data=data, **kwargs
+        )
+        if self._compression_rejected(encoding, resp.status):
+            resp.release()
+            data = body
+            start = time.perf_counter()
+            resp = await session.post(
+                url, headers=self._request_headers(headers, None), data=data, **kwargs
+            )
+            if resp.ok:
+                self._mark_uncompressed(url)
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics.attempts += 1
+            metrics.request_bytes = len(data)
+            metrics.ttfb_seconds = time.perf_counter() - start
+        if not resp.ok:
+            resp.release()
+        resp.raise_for_status()
+        return resp
+
+    async def _apost(
+        self,
+        url: str,
+        body: bytes,
+        headers: Optional[dict],
+        session: "Optional[aiohttp.ClientSession]",
+        timeout: Optional[float] = None,
+    ) -> Any:
+        resp = await self._asend(url, body, headers, session, timeout)
+        try:
+            return self._decode(await resp.read())
+        finally:
+            resp.release()
+
+    async def astream(
+        self,
+        path: str,
+        payload: Any,
+        text_of: Callable[[Any], Optional[str]],
+        headers: Optional[dict] = None,
+        session: "Optional[aiohttp.ClientSession]" = None,
+        policy: Optional[CallPolicy] = None,
+    ) -> AsyncIterator[Event]:
+        """Async version of `stream`."""
+        instrumentation = self.instrumentation_hook()
+        if not instrumentation.enabled:
+            async for event in self._astream(path, payload, text_of, headers, session, policy, None):
+                yield event
+            return
+        with instrumentation.measure(path, current=False) as metrics:
+            async for event in self._astream(path, payload, text_of, headers, session, policy, metrics):
+                yield event
+
+    async def _astream(
+        self,
+        path: str,
+        payload: Any,
+        text_of: Callable[[Any], Optional[str]],
+        headers: Optional[dict],
+        session: "Optional[aiohttp.ClientSession]",
+        policy: Optional[CallPolicy],
+        metrics: Optional[CallMetrics],
+    ) -> AsyncIterator[Event]:
+        url = self.url(path)
+        headers = {**STREAM_HEADERS, **(headers or {})}
+        with measuring(metrics):
+            body = self._encode(payload)
+            tokens = await self._acost(body)
+            if policy is None:
+                resp = await self.retry.call_async(
+                    self._athrottled, tokens, self._asend, url, body, headers, session
+                )
+            else:
+                resp = await policy.call_async(
+                    self.retry,
+                    urlsplit(url).netloc,
+                    lambda timeout: self._athrottled(
+                        tokens, self._asend, url, body, headers, session, timeout, True
+                    ),
+                    hedge=False,
+                )
+        established: Optional[float] = time.perf_counter()
+
+        def first_event():
+            nonlocal established
+            if metrics is not None and established is not None:
+                metrics.ttfb_seconds += time.perf_counter() - established
+                established = None
+
+        try:
+            content_type = resp.headers.get("Content-Type", "")
+            if content_type.startswith("application/json"):
+                for event in result_events(loads(await resp.read()), text_of):
+                    first_event()
+                    yield event
+                return
+            parser = StreamParser(content_type)
+            async for line in resp.content:
+                event = parser.feed(line.decode("utf-8").rstrip("\r\n"))
+                if event is not None:
+                    first_event()
+                    yield event
+            event = parser.close()
+            if event is not None:
+                first_event()
+                yield event
+        finally:
+            resp.release()
+
+    def close(self):
+        """Closes the blocking pool. Async sessions are closed with `aclose`."""
+        with self._lock:
+            session, self._session = self._session, None
+        if session is not None:
+            session.close()
+
+    async def aclose(self):
+        """Closes the async session belonging to the running event loop."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            session = self._async_sessions.pop(loop, None)
+        if session is not None:
+            await session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+
+_default_client: Optional[CapabilitiesClient] = None
+_default_client_lock = threading.Lock()
+
+
+def get_default_client() -> CapabilitiesClient:
+    """Returns the process-wide client used by capabilities that weren't given one explicitly."""
+    global _default_client
+    if _default_client is None:
+        with _default_client_lock:
+            if _default_client is None:
+                _default_client = CapabilitiesClient()
+    return _default_client
+
+
+def set_default_client(client: CapabilitiesClient):
+    """Replaces the process-wide default client."""
+    global _default_client
+    with _default_client_lock:
+        _default_client = client
@@ -0,0 +1,185 @@
+import asyncio
+import concurrent.futures
+import copy
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, Type
+
+from capabilities.retry import DeadlineExceeded
+
+
+@dataclass
+class CoalesceStats:
+    calls: int = 0
+    """ Number of calls made through the `SingleFlight`. """
+    deduplicated: int = 0
+    """ Calls that joined an identical call already in flight instead of making their own. """
+
+
+class _Flight:
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.future: concurrent.futures.Future = concurrent.futures.Future()
+        self.loop = loop
+        """ The event loop running the call, or None for a blocking call. """
+        self.task: Optional[asyncio.Future] = None
+        self.waiters = 0
+
+
+def _running_loop() -> Optional[asyncio.AbstractEventLoop]:
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+def _remaining(deadline: Optional[float]) -> Optional[float]:
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+
+def _raised_by(future, error: BaseException) -> bool:
+    """Whether `error` is the outcome of the call of `future`, rather than the end of a wait for it."""
+    return future.done() and not future.cancelled() and future.exception() is error
+
+
+def _retrieve(future: asyncio.Future):
+    # marks the exception as retrieved, the waiter may have been cancelled before it arrived.
+    if not future.cancelled():
+        future.exception()
+
+
+class SingleFlight:
+    """Coalesces concurrent identical calls: while a call for a key is in flight,
+    further calls with the same key wait for its outcome instead of making their own.
+
+    Calls are shared between threads and between event loops, blocking and async callers alike.
+    The caller that started the call receives its result, the others a copy of it; all receive the same exception.
+    A key is only shared while its call is in flight; once it completes the next call starts afresh.
+
+    An async call keeps running as long as at least one caller is waiting for it,
+    so cancelling the caller that started it doesn't fail the others.
+    A caller that joins a call waits for it until its own `deadline` at most, then raises `DeadlineExceeded`.
+
+    Args:
+        rejoin: exceptions that are specific to the caller that started the call, eg its deadline passing.
+            The callers that joined it make the call again instead of raising them.
+    """
+
+    def __init__(self, rejoin: Tuple[Type[BaseException], ...] = ()):
+        self.rejoin = rejoin
+        self.stats = CoalesceStats()
+        self._lock = threading.Lock()
+        self._flights: Dict[str, _Flight] = {}
+
+    def __len__(self):
+        """Number of calls in flight."""
+        return len(self._flights)
+
+    def _join(self, key: str, loop: Optional[asyncio.AbstractEventLoop]):
+        """Returns the flight for key and whether the caller leads it."""
+        with self._lock:
+            self.stats.calls += 1
+            flight = self._flights.get(key)
+            if flight is not None and not (
+                loop is None and flight.loop is not None and flight.loop is _running_loop()
+            ):
+                # a blocking caller running on the loop of an async flight can't wait for it without deadlocking.
+                flight.waiters += 1
+                self.stats.deduplicated += 1
+                return flight, False
+            flight = _Flight(loop)
+            flight.waiters = 1
+            if key not in self._flights:
+                self._flights[key] = flight
+            return flight, True
+
+    def _land(self, key: str, flight: _Flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def call(self, key: str, fn: Callable[..., Any], *args, deadline: Optional[float] = None) -> Any:
+        """Returns `fn(*args)`, or the outcome of the identical call in flight for `key`.
+
+        `deadline` is the `time.monotonic()` timestamp until which the caller waits for a call it joined.
+        """
+        while True:
+            flight, leader = self._join(key, None)
+            if leader:
+                break
+            try:
+                result = flight.future.result(timeout=_remaining(deadline))
+            except concurrent.futures.TimeoutError as e:
+                if not _raised_by(flight.future, e):
+                    self._leave(key, flight)
+                    raise DeadlineExceeded("deadline exceeded while waiting for an identical call") from None
+                if isinstance(e, self.rejoin):
+                    continue
+                raise
+            except self.rejoin:
+                continue
+            return copy.deepcopy(result)
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            self._land(key, flight)
+            flight.future.set_exception(e)
+            raise
+        self._land(key, flight)
+        flight.future.set_result(result)
+        return result
+
+    async def call_async(
+        self, key: str, fn: Callable[..., Awaitable[Any]], *args, deadline: Optional[float] = None
+    ) -> Any:
+        """Async version of `call`, `fn(*args)` returns an awaitable."""
+        loop = asyncio.get_running_loop()
+        while True:
+            flight, leader = self._join(key, loop)
+            if leader:
+                flight.task = asyncio.ensure_future(fn(*args))
+                flight.task.add_done_callback(lambda task, flight=flight: self._settle(key, flight, task))
+            waiter = asyncio.wrap_future(flight.future)
+            waiter.add_done_callback(_retrieve)
+            try:
+                if leader:
+                    result = await asyncio.shield(waiter)
+                else:
+                    result = await asyncio.wait_for(asyncio.shield(waiter), _remaining(deadline))
+            except asyncio.CancelledError:
+                self._leave(key, flight)
+                raise
+            except asyncio.TimeoutError as e:
+                if leader:
+                    raise
+                if not _raised_by(waiter, e):
+                    self._leave(key, flight)
+                    raise DeadlineExceeded("deadline exceeded while waiting for an identical call") from None
+                if isinstance(e, self.rejoin):
+                    continue
+                raise
+            except self.rejoin:
+                if leader:
+                    raise
+                continue
+            return result if leader else copy.deepcopy(result)
+
+    def _settle(self, key: str, flight: _Flight, task: asyncio.Future):
+        self._land(key, flight)
+        if task.cancelled():
+            flight.future.cancel()
+        elif task.exception() is not None:
+            flight.future.set_exception(task.exception())
+        else:
+            flight.future.set_result(task.result())
+
+    def _leave(self, key: str, flight: _Flight):
+        """Called when an async waiter is cancelled: the call is cancelled once nobody waits for it."""
+        with self._lock:
+            flight.waiters -= 1
+            if flight.waiters > 0 or flight.task is None:
+                return
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        if not flight.loop.is_closed():
+            flight.loop.call_soon_threadsafe(flight.task.cancel)
@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+import functools
 import os
 from typing import Optional
 import termcolor as tc
@@ -24,4 +25,14 @@ class Config(pydantic.BaseSettings):
             out.write("\n")
 
 
-CONFIG = Config()
+@functools.lru_cache(maxsize=None)
+def get_config() -> Config:
+    """The configuration, read from the environment and `.env` on first use."""
+    return Config()
+
+
+def __getattr__(name):
+    # `CONFIG` used to be read at import time, it is now read when first accessed.
+    if name == "CONFIG":
+        return get_config()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
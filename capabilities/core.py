@@ -1,26 +1,82 @@
 import os
+import asyncio
+import collections
 import dataclasses
+import functools
+import inspect
+import json
+import threading
 import typing
 import dacite
 from dataclasses import dataclass, field, is_dataclass
 from typing import Dict, Any, List, Type, TypeAlias, TypeVar, Union, Literal
+from typing import AsyncIterator, Callable, Iterable, Iterator
 from typing import Optional
-import requests
-import aiohttp
-import asyncio
-import time
-from capabilities.config import CONFIG
+from capabilities.adaptive import AdaptiveLimiter
+from capabilities.batch import BatchResult, amap_calls, map_calls
+from capabilities.client import CapabilitiesClient, get_default_client
+from capabilities.microbatch import BATCH_SUFFIX, MicroBatcher
+from capabilities.payload import PayloadTemplate
+from capabilities.resilience import CallPolicy, CircuitBreaker
+from capabilities.streaming import AsyncTextStream, TextStream
 from pydantic import BaseModel
 from pydantic.fields import ModelField
 from pydantic.main import ModelMetaclass
 import logging
 
+if typing.TYPE_CHECKING:
+    from capabilities.search import EmbeddingModel, SearchIndex, SearchResult, TextItem
+
 logger = logging.getLogger("capabilities")
 
 
 @dataclass
 class CapabilityBase:
-    ...
+    client: Optional[CapabilitiesClient] = field(default=None, kw_only=True)
+    """ The client used to send requests. If None, the process-wide default client is used. """
+    policy: Optional[CallPolicy] = field(default=None, kw_only=True)
+    """ Deadline, hedging and circuit breaking of the capability's calls. If None, calls have no deadline. """
+
+    def get_client(self) -> CapabilitiesClient:
+        return self.client or get_default_client()
+
+    def map(
+        self,
+        inputs: Iterable[Any],
+        concurrency: Union[int, AdaptiveLimiter] = 8,
+        ordered: bool = True,
+        **kwargs,
+    ) -> Iterator[BatchResult]:
+        """Calls the capability on each of the `inputs` with at most `concurrency` calls in flight.
+
+        Each input is a tuple of positional arguments, a dict of keyword arguments or a single positional argument.
+        `kwargs` are passed to every call, eg
+        `c.map([{"input": row} for row in rows], input_spec=Row, output_spec=Label, instructions=...)`.
+
+        Yields a `BatchResult` per input, in input order if `ordered` is True, otherwise as they complete.
+        A failing input does not abort the batch, its `BatchResult.error` is set instead.
+        `concurrency` can also be an `AdaptiveLimiter`, which adjusts the number of calls in flight to the observed
+        latencies and overload errors.
+        """
+        return map_calls(self, inputs, concurrency=concurrency, ordered=ordered, **kwargs)
+
+    def amap(
+        self,
+        inputs: Iterable[Any],
+        concurrency: Union[int, AdaptiveLimiter] = 8,
+        ordered: bool = True,
+        **kwargs,
+    ) -> AsyncIterator[BatchResult]:
+        """Async version of `map`. All calls share the client's pooled session for the running loop."""
+        return amap_calls(
+            self.run_async, inputs, concurrency=concurrency, ordered=ordered, **kwargs
+        )
+
+    async def run_many(
+        self, inputs: Iterable[Any], concurrency: Union[int, AdaptiveLimiter] = 8, **kwargs
+    ) -> List[BatchResult]:
+        """Runs `amap` to completion and returns the results in input order."""
+        return [r async for r in self.amap(inputs, concurrency=concurrency, **kwargs)]
 
 
 @dataclass
@@ -29,7 +85,15 @@ class DocumentQA(CapabilityBase):
     DocumentQA capability that sends the given query to DocumentQA service for answering based on the provided document.
 
     Attributes:
-        None
+        client: the `CapabilitiesClient` used to send requests, defaults to the shared client.
+        policy: the `CallPolicy` (deadline, hedging, circuit breaker) of the calls, if any.
+        window_tokens: if set, documents longer than this many tokens are answered with `map_reduce`.
+        window_overlap: number of tokens shared by consecutive windows.
+        window_concurrency: maximum number of windows queried at the same time.
+        retrieval_k: if set, queries are answered from the `retrieval_k` most relevant passages of the document.
+        passage_tokens: maximum number of tokens per passage.
+        embedding_model: embedding model of the per-document search indexes.
+        index_cache_size: maximum number of per-document search indexes kept.
 
     Methods:
         __call__(self, document: str, query: str) -> dict:
@@ -40,85 +104,388 @@ class DocumentQA(CapabilityBase):
             Returns:
                 A dictionary containing the answer returned by the DocumentQA service.
             Raises:
-                Exception: When the retries hit maximum (8) times and nothing was returned.
+                RetryError: When the client's retry policy hit its maximum number of retries.
 
         async run_async(self, document: str, query: str, session=None) -> coroutine:
             Sends the given query to DocumentQA service for answering based on the provided document asynchronously.
             Args:
                 document: A string representing the input document.
                 query: A string representing the query for DocumentQA.
-                session: An instance of `aiohttp.ClientSession`.
+                session: An instance of `aiohttp.ClientSession`. Defaults to the client's pooled session.
             Returns:
                 A coroutine that resolves to a dictionary containing the answer returned
                 by the DocumentQA service.
             Raises:
-                Exception: When the retries hit maximum (8) times and nothing was returned.
+                RetryError: When the client's retry policy hit its maximum number of retries.
+
+        map_reduce(self, document: str, query: str, ...) -> dict:
+            Answers the query over overlapping windows of the document concurrently and merges the partial answers.
+            `map_reduce_async` is the async version.
+
+        ask_retrieved(self, document, query: str, k: int = None, index: SearchIndex = None) -> dict:
+            Answers the query from the top `k` passages of the document, found with a `SearchIndex` over its passages.
+            `ask_retrieved_async` is the async version.
+
+        stream(self, document: str, query: str) -> TextStream:
+            Streams the answer as text chunks. `astream` is the async version.
     """
 
-    def __call__(self, document: str, query: str):
-        print(
-            f"[DocumentQA] running query against document with {len(document)} characters"
+    path = "/blazon/documentqa"
+
+    window_tokens: Optional[int] = None
+    """ If set, documents longer than this many tokens are answered by `map_reduce` over windows of this size.
+    If None, documents are always sent whole. """
+    window_overlap: int = 128
+    """ Number of tokens shared by consecutive windows. """
+    window_concurrency: int = 4
+    """ Maximum number of windows queried at the same time. """
+    retrieval_k: Optional[int] = None
+    """ If set, each query is answered from the `retrieval_k` passages of the document that are most relevant to it
+    (see `ask_retrieved`) instead of from the whole document. """
+    passage_tokens: int = 256
+    """ Maximum number of tokens per passage in the per-document search indexes. """
+    embedding_model: Optional["EmbeddingModel"] = None
+    """ Embedding model of the per-document search indexes. If None, the `SearchIndex` default is used. """
+    index_cache_size: int = 16
+    """ Maximum number of per-document search indexes kept, the least recently used are dropped first. """
+    _indexes: "collections.OrderedDict[str, SearchIndex]" = field(
+        default_factory=collections.OrderedDict, init=False, repr=False, compare=False
+    )
+    _indexes_lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False, compare=False
+    )
+    _default_model: Optional["EmbeddingModel"] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+
+    def __call__(self, document: Union[str, "TextItem"], query: str):
+        if self._use_retrieval(document):
+            return self.ask_retrieved(document, query)
+        document = _document_text(document)
+        if self._use_windows(document):
+            return self.map_reduce(document, query)
+        return self._ask(document, query)
+
+    async def run_async(self, document: Union[str, "TextItem"], query: str, session=None):
+        if self._use_retrieval(document):
+            return await self.ask_retrieved_async(document, query, session=session)
+        document = _document_text(document)
+        if self._use_windows(document):
+            return await self.map_reduce_async(document, query, session=session)
+        return await self._ask_async(document, query, session=session)
+
+    def _ask(self, document: str, query: str):
+        logger.info(f"[DocumentQA] running query against document with {len(document)} characters")
+        payload = {
+            "document": document,
+            "query": query,
+        }
+        return self.get_client().post(self.path, payload, policy=self.policy)
+
+    async def _ask_async(self, document: str, query: str, session=None):
+        logger.info(f"[DocumentQA] running query against document with {len(document)} characters")
+        payload = {
+            "document": document,
+            "query": query,
+        }
+        return await self.get_client().apost(
+            self.path, payload, session=session, policy=self.policy
+        )
+
+    def _use_windows(self, document: str) -> bool:
+        if self.window_tokens is None or len(document) <= self.window_tokens:
+            # a token spans at least one character, so short documents fit without tokenizing.
+            return False
+        from capabilities.util import get_tokenized_length
+
+        return get_tokenized_length(document) > self.window_tokens
+
+    def windows(
+        self,
+        document: str,
+        window_tokens: Optional[int] = None,
+        overlap: Optional[int] = None,
+    ) -> List[str]:
+        """Splits the document into windows of `window_tokens` tokens, consecutive windows sharing `overlap` tokens.
+
+        Defaults to `self.window_tokens` and `self.window_overlap`.
+        """
+        from capabilities.util import get_chunks_core
+
+        window_tokens = window_tokens or self.window_tokens
+        if window_tokens is None:
+            raise ValueError("window_tokens must be given when self.window_tokens is None")
+        overlap = self.window_overlap if overlap is None else overlap
+        if not 0 <= overlap < window_tokens:
+            raise ValueError(
+                f"overlap={overlap} must be non-negative and smaller than window_tokens={window_tokens}"
+            )
+        return [
+            w for w in get_chunks_core(document, window_tokens, window_tokens - overlap) if w
+        ]
+
+    def _partial_answers(self, results: List[BatchResult]) -> List[Any]:
+        failed = [r for r in results if not r.ok]
+        if len(failed) == len(results):
+            raise failed[0].error  # type: ignore
+        for r in failed:
+            logger.warning(f"[DocumentQA] window {r.index} failed with {r.error!r}, skipping it")
+        return [r.output for r in results if r.ok]
+
+    @staticmethod
+    def reduce_document(answers: List[Any]) -> str:
+        """The document that the partial answers are merged from in the reduce step."""
+        n = len(answers)
+        return "\n\n".join(
+            f"Answer based on part {i + 1} of {n} of the document:\n{json.dumps(a)}"
+            for i, a in enumerate(answers)
         )
-        patience = 8
-        count = 0
-        while count < patience:
-            try:
-                url = "https://api.blazon.ai/blazon/documentqa"
-                headers = {
-                    "Content-type": "application/json",
-                    "api-key": CONFIG.api_key,
-                }
-                payload = {
-                    "document": document,
-                    "query": query,
-                }
-                resp = requests.post(url=url, headers=headers, json=payload)
-                return resp.json()
-            except:
-                sleep_duration = 2.0**count
-                print(f"retrying after sleeping for {sleep_duration:.2f}")
-                count += 1
-                time.sleep(sleep_duration)
-        raise Exception("[DocumentQA] failed after hitting max retries")
-
-    async def run_async(self, document: str, query: str, session=None):
-        print(
-            f"[DocumentQA] running query against document with {len(document)} characters"
+
+    def map_reduce(
+        self,
+        document: str,
+        query: str,
+        window_tokens: Optional[int] = None,
+        overlap: Optional[int] = None,
+        concurrency: Optional[int] = None,
+        reduce: Optional[Callable[[str, List[Any]], Any]] = None,
+    ):
+        """Answers the query against a document that is too long for one request.
+
+        The document is split into overlapping `windows`, which are queried concurrently
+        (at most `concurrency` at a time, defaulting to `self.window_concurrency`).
+        The partial answers are then merged by `reduce(query, answers)`,
+        which defaults to asking the same query against the `reduce_document` of the partial answers.
+        Windows that fail are skipped, unless they all fail.
+        """
+        ws = self.windows(document, window_tokens, overlap)
+        results = list(
+            map_calls(
+                lambda w: self._ask(w, query),
+                ws,
+                concurrency=concurrency or self.window_concurrency,
+                # the windows are part of a single call, they keep its priority.
+                priority=None,
+            )
         )
-        patience = 8
-        count = 0
-        while count < patience:
-            try:
-                url = "https://api.blazon.ai/blazon/documentqa"
-                if session is None:
-                    async with aiohttp.ClientSession(
-                        connector=aiohttp.TCPConnector(ssl=False)
-                    ) as session:
-                        return await self.run_async(
-                            document=document, query=query, session=session
-                        )
-                headers = {
-                    "Content-type": "application/json",
-                    "api-key": CONFIG.api_key,
-                }
-                payload = {
-                    "document": document,
-                    "query": query,
-                }
-                async with session.post(url, headers=headers, json=payload) as resp:
-                    response = await resp.json()
-                    try:
-                        return response
-                    except Exception as e:
-                        print(f"caught exception={e}")
-                        print(f"bad response={response}")
-                        raise e
-            except:
-                sleep_duration = 2.0**count
-                print(f"retrying after sleeping for {sleep_duration:.2f}")
-                count += 1
-                time.sleep(sleep_duration)
-        raise Exception("[DocumentQA] failed after hitting max retries")
+        answers = self._partial_answers(results)
+        if reduce is not None:
+            return reduce(query, answers)
+        if len(answers) == 1:
+            return answers[0]
+        return self._ask(self.reduce_document(answers), query)
+
+    async def map_reduce_async(
+        self,
+        document: str,
+        query: str,
+        window_tokens: Optional[int] = None,
+        overlap: Optional[int] = None,
+        concurrency: Optional[int] = None,
+        reduce: Optional[Callable[[str, List[Any]], Any]] = None,
+        session=None,
+    ):
+        """Async version of `map_reduce`. `reduce` may be a coroutine function."""
+        ws = self.windows(document, window_tokens, overlap)
+        results = [
+            r
+            async for r in amap_calls(
+                lambda w: self._ask_async(w, query, session=session),
+                ws,
+                concurrency=concurrency or self.window_concurrency,
+                # the windows are part of a single call, they keep its priority.
+                priority=None,
+            )
+        ]
+        answers = self._partial_answers(results)
+        if reduce is not None:
+            result = reduce(query, answers)
+            return await result if inspect.isawaitable(result) else result
+        if len(answers) == 1:
+            return answers[0]
+        return await self._ask_async(self.reduce_document(answers), query, session=session)
+
+    def _passage_model(self) -> "EmbeddingModel":
+        """The `embedding_model`, or the `SearchIndex` default, created once and shared by the indexes."""
+        if self.embedding_model is not None:
+            return self.embedding_model
+        with self._indexes_lock:
+            if self._default_model is None:
+                from capabilities.search.hf import STEmbeddingModel
+
+                self._default_model = STEmbeddingModel()
+            return self._default_model
+
+    def _use_retrieval(self, document: Union[str, "TextItem"]) -> bool:
+        if self.retrieval_k is None:
+            return False
+        with self._indexes_lock:
+            if _document_digest(document) in self._indexes:
+                return True
+        # a document that fits in a single passage is sent whole without building an index.
+        text = _document_text(document)
+        return len(self._passage_model().tokenize(text)) > self.passage_tokens
+
+    def index(self, document: Union[str, "TextItem"]) -> "SearchIndex":
+        """The `SearchIndex` over the passages of the document.
+
+        The index is built on first use and cached by the document's digest,
+        so repeated queries against the same document only embed the query.
+        """
+        from capabilities.search import SearchIndex, split_passages
+
+        text, key = _document_text(document), _document_digest(document)
+        with self._indexes_lock:
+            index = self._indexes.get(key)
+            if index is not None:
+                self._indexes.move_to_end(key)
+                return index
+        index = SearchIndex(embedding_model=self._passage_model())
+        item_id = document.id if not isinstance(document, str) else key[:36]
+        index.update(
+            split_passages(text, item_id, self.passage_tokens, index.embedding_model)
+        )
+        with self._indexes_lock:
+            self._indexes[key] = index
+            while len(self._indexes) > self.index_cache_size:
+                self._indexes.popitem(last=False)
+        return index
+
+    def retrieve(
+        self,
+        document: Union[str, "TextItem"],
+        query: str,
+        k: Optional[int] = None,
+        index: Optional["SearchIndex"] = None,
+    ) -> List["SearchResult"]:
+        """Finds the `k` passages of the document that are most relevant to the query.
+
+        `k` defaults to `self.retrieval_k`. If `index` is given it is searched instead of the cached `index(document)`,
+        it should index the document either as `Passage`s (eg made by `split_passages`) or as a single item.
+        """
+        k = k or self.retrieval_k
+        if k is None:
+            raise ValueError("k must be given when self.retrieval_k is None")
+        if index is None:
+            index = self.index(document)
+        return list(index.search(query, limit=k))
+
+    def _retrieval_payload(
+        self, document: Union[str, "TextItem"], query: str, results: List["SearchResult"]
+    ) -> dict:
+        text = _document_text(document)
+        ranges = _merge_ranges(_result_range(r) for r in results)
+        logger.info(
+            f"[DocumentQA] running query against {len(ranges)} passages"
+            f" ({sum(len(r) for r in ranges)} of {len(text)} characters)"
+        )
+        return {
+            "document": "\n\n".join(text[r.start : r.stop] for r in ranges),
+            "query": query,
+            "substring_ranges": [[r.start, r.stop] for r in ranges],
+        }
+
+    def ask_retrieved(
+        self,
+        document: Union[str, "TextItem"],
+        query: str,
+        k: Optional[int] = None,
+        index: Optional["SearchIndex"] = None,
+    ):
+        """Answers the query from only the passages of the document that are most relevant to it.
+
+        The top `k` passages found by `retrieve` are merged where they overlap and sent in document order,
+        along with their `substring_ranges` in the document's text.
+        """
+        results = self.retrieve(document, query, k, index)
+        return self.get_client().post(
+            self.path, self._retrieval_payload(document, query, results), policy=self.policy
+        )
+
+    async def ask_retrieved_async(
+        self,
+        document: Union[str, "TextItem"],
+        query: str,
+        k: Optional[int] = None,
+        index: Optional["SearchIndex"] = None,
+        session=None,
+    ):
+        """Async version of `ask_retrieved`. Indexing and search run in the loop's default executor."""
+        loop = asyncio.get_running_loop()
+        results = await loop.run_in_executor(
+            None, self.retrieve, document, query, k, index
+        )
+        return await self.get_client().apost(
+            self.path,
+            self._retrieval_payload(document, query, results),
+            session=session,
+            policy=self.policy,
+        )
+
+    def stream(self, document: str, query: str) -> TextStream:
+        """Streams the answer as text chunks while it is generated.
+
+        After the stream is exhausted, `stream.result` holds the same dictionary that `__call__` returns.
+        """
+        payload = {"document": document, "query": query, "stream": True}
+        events = self.get_client().stream(
+            self.path, payload, text_of=_answer_text, policy=self.policy
+        )
+        return TextStream(events, default_result=lambda text: {"answer": text})
+
+    def astream(self, document: str, query: str, session=None) -> AsyncTextStream:
+        """Async version of `stream`."""
+        payload = {"document": document, "query": query, "stream": True}
+        events = self.get_client().astream(
+            self.path, payload, text_of=_answer_text, session=session, policy=self.policy
+        )
+        return AsyncTextStream(events, default_result=lambda text: {"answer": text})
+
+
+def _document_text(document: Union[str, "TextItem"]) -> str:
+    return document if isinstance(document, str) else document.get_text()
+
+
+def _document_digest(document: Union[str, "TextItem"]) -> str:
+    if isinstance(document, str):
+        from capabilities.search.util import digest
+
+        return digest(document)
+    return document.digest
+
+
+def _result_range(result: "SearchResult") -> range:
+    """The range of the document's text covered by a search result."""
+    from capabilities.search import Passage
+
+    inner = result.substring_range
+    if isinstance(result.item, Passage):
+        outer = result.item.substring_range
+        if inner is None:
+            return outer
+        return range(outer.start + inner.start, outer.start + inner.stop)
+    return inner if inner is not None else range(len(result.item.get_text()))
+
+
+def _merge_ranges(ranges: Iterable[range]) -> List[range]:
+    """Sorts the ranges and merges the ones that overlap or touch."""
+    merged: List[range] = []
+    for r in sorted(ranges, key=lambda r: r.start):
+        if merged and r.start <= merged[-1].stop:
+            last = merged.pop()
+            r = range(last.start, max(last.stop, r.stop))
+        merged.append(r)
+    return merged
+
+
+def _answer_text(result: Any) -> Optional[str]:
+    answer = result.get("answer") if isinstance(result, dict) else None
+    return answer if isinstance(answer, str) else None
+
+
+def _summary_text(result: Any) -> Optional[str]:
+    summary = result.get("summary") if isinstance(result, dict) else None
+    return summary if isinstance(summary, str) else None
 
 
 @dataclass
@@ -132,7 +499,7 @@ class Summarize(CapabilityBase):
     Methods:
         __call__(self, document: str) -> Dict[str, Any]:
             Method for summarizing `document`. Makes a POST request to the API and returns the JSON response.
-            Retries up to 8 times with exponentially increasing sleep times before giving up.
+            Retryable failures are retried according to the client's `RetryPolicy`.
             Args:
                 document (str): The text to be summarized.
             Returns:
@@ -140,74 +507,53 @@ class Summarize(CapabilityBase):
 
         async run_async(self, document: str, session=None) -> Dict[str, Any]:
             Async method for summarizing `document`. Makes an async POST request to the API and returns the JSON response.
-            Retries up to 8 times with exponentially increasing sleep times before giving up.
+            Retryable failures are retried according to the client's `RetryPolicy`.
             Args:
                 document (str): The text to be summarized.
-                session (aiohttp.ClientSession, optional): An aiohttp client session. If not provided, a new one is created. Defaults to None.
+                session (aiohttp.ClientSession, optional): An aiohttp client session. If not provided, the client's pooled session is used. Defaults to None.
             Returns:
                 Dict[str, Any]: A dictionary object representing the summary, with keys 'summary' (str) and 'score' (float).
+
+        stream(self, document: str) -> TextStream:
+            Streams the summary as text chunks. `astream` is the async version.
     """
 
+    path = "/blazon/summarize"
+
     def __call__(self, document: str):
-        patience = 8
-        count = 0
-        while count < patience:
-            try:
-                url = "https://api.blazon.ai/blazon/summarize"
-                headers = {
-                    "Content-type": "application/json",
-                    "api-key": CONFIG.api_key,
-                }
-                payload = {
-                    "document": document,
-                }
-                print(
-                    f"[Summarize] running query against document with {len(document)} characters"
-                )
-                resp = requests.post(url=url, headers=headers, json=payload)
-                return resp.json()
-            except:
-                sleep_duration = 2.0**count
-                print(f"retrying after sleeping for {sleep_duration:.2f}")
-                count += 1
-                time.sleep(sleep_duration)
-        raise Exception("[Summarize] failed after hitting max retries")
+        payload = {
+            "document": document,
+        }
+        logger.info(f"[Summarize] running query against document with {len(document)} characters")
+        return self.get_client().post(self.path, payload, policy=self.policy)
 
     async def run_async(self, document: str, session=None):
-        patience = 8
-        count = 0
-        while count < patience:
-            try:
-                url = "https://api.blazon.ai/blazon/summarize"
-                if session is None:
-                    async with aiohttp.ClientSession(
-                        connector=aiohttp.TCPConnector(ssl=False)
-                    ) as session:
-                        return await self.run_async(document=document, session=session)
-                headers = {
-                    "Content-type": "application/json",
-                    "api-key": CONFIG.api_key,
-                }
-                payload = {
-                    "document": document,
-                }
-                print(
-                    f"[Summarize] running query against document with {len(document)} characters"
-                )
-                async with session.post(url, headers=headers, json=payload) as resp:
-                    response = await resp.json()
-                    try:
-                        return response
-                    except Exception as e:
-                        print(f"caught exception={e}")
-                        print(f"bad response={response}")
-                        raise e
-            except:
-                sleep_duration = 2.0**count
-                print(f"retrying after sleeping for {sleep_duration:.2f}")
-                count += 1
-                time.sleep(sleep_duration)
-        raise Exception("[Summarize] failed after hitting max retries")
+        payload = {
+            "document": document,
+        }
+        logger.info(f"[Summarize] running query against document with {len(document)} characters")
+        return await self.get_client().apost(
+            self.path, payload, session=session, policy=self.policy
+        )
+
+    def stream(self, document: str) -> TextStream:
+        """Streams the summary as text chunks while it is generated.
+
+        After the stream is exhausted, `stream.result` holds the same dictionary that `__call__` returns.
+        """
+        payload = {"document": document, "stream": True}
+        events = self.get_client().stream(
+            self.path, payload, text_of=_summary_text, policy=self.policy
+        )
+        return TextStream(events, default_result=lambda text: {"summary": text})
+
+    def astream(self, document: str, session=None) -> AsyncTextStream:
+        """Async version of `stream`."""
+        payload = {"document": document, "stream": True}
+        events = self.get_client().astream(
+            self.path, payload, text_of=_summary_text, session=session, policy=self.policy
+        )
+        return AsyncTextStream(events, default_result=lambda text: {"summary": text})
 
 
 StructuredSchema: TypeAlias = Any
@@ -216,12 +562,30 @@ StructuredSchema: TypeAlias = Any
 def flatten_model(m: Type, path: list[str] = []) -> StructuredSchema:
     """Converts the given type m to a structured schema.
 
+    The schema of each type is computed once and cached, so the returned
+    schema is shared between callers and must not be mutated.
+
     Args:
         * m (Type): The type to be converted.
         * path (list[str], optional): The path to the current type,
           used for more helpful diagnostic messages saying where
           the conversion failed. Defaults to [].
     """
+    if path:
+        return _flatten_model(m, path)
+    try:
+        hash(m)
+    except TypeError:
+        return _flatten_model(m, path)
+    return _flatten_model_cached(m)
+
+
+@functools.lru_cache(maxsize=None)
+def _flatten_model_cached(m: Type) -> StructuredSchema:
+    return _flatten_model(m, [])
+
+
+def _flatten_model(m: Type, path: list[str] = []) -> StructuredSchema:
     orig = typing.get_origin(m)
     if m == list or orig == list:
         args = typing.get_args(m)
@@ -258,15 +622,106 @@ def flatten_model(m: Type, path: list[str] = []) -> StructuredSchema:
         )
 
 
+class _Fallback(Exception):
+    """Raised by compiled encoders/decoders on inputs they don't handle,
+    so that the caller can defer to the reference implementation."""
+
+
+_PRIMITIVES = (str, bool, float, int)
+_ASDICT_LEAVES = frozenset([str, bool, float, int, type(None)])
+
+
+def _asdict_value(v: Any) -> Any:
+    cls = type(v)
+    if cls in _ASDICT_LEAVES:
+        return v
+    elif cls is list:
+        return [_asdict_value(x) for x in v]
+    elif cls is dict:
+        return {_asdict_value(k): _asdict_value(x) for k, x in v.items()}
+    elif is_dataclass(cls):
+        return _asdict_encoder(cls)(v)
+    raise _Fallback()
+
+
+@functools.lru_cache(maxsize=None)
+def _asdict_encoder(cls: type) -> Callable[[Any], dict]:
+    """`dataclasses.asdict` specialised to the given class, for values made of
+    primitives, lists, dicts and dataclasses. Raises `_Fallback` on anything else."""
+    names = [f.name for f in dataclasses.fields(cls)]
+
+    def encode(obj):
+        return {name: _asdict_value(getattr(obj, name)) for name in names}
+
+    return encode
+
+
+def _encode_dataclass(obj: Any) -> dict:
+    try:
+        return _asdict_encoder(type(obj))(obj)
+    except _Fallback:
+        return dataclasses.asdict(obj)
+
+
+def _encode_list(obj: list) -> list:
+    return [to_dict(o) for o in obj]
+
+
+def _encode_dict(obj: dict) -> dict:
+    return {k: to_dict(v) for k, v in obj.items()}
+
+
+def _encode_primitive(obj: Any) -> Any:
+    return obj
+
+
+def _encode_unsupported(obj: Any) -> Any:
+    raise TypeError(f"unsupported datatype={obj}")
+
+
+_ENCODERS: Dict[type, Callable[[Any], Any]] = {}
+
+
+def _compile_encoder(cls: type) -> Callable[[Any], Any]:
+    if isinstance(cls, type) and issubclass(cls, type):
+        # classes themselves (eg a dataclass type) take the reference path.
+        return _to_dict
+    elif issubclass(cls, BaseModel):
+        return cls.dict
+    elif is_dataclass(cls):
+        return _encode_dataclass
+    elif issubclass(cls, list):
+        return _encode_list
+    elif issubclass(cls, dict):
+        return _encode_dict
+    elif issubclass(cls, _PRIMITIVES):
+        return _encode_primitive
+    else:
+        return _encode_unsupported
+
+
 def to_dict(obj: Any) -> Any:
+    """Converts pydantic models, dataclasses, lists and dicts of these to plain json-like values.
+
+    The conversion for each runtime type is compiled once and cached.
+    """
+    cls = type(obj)
+    encoder = _ENCODERS.get(cls)
+    if encoder is None:
+        encoder = _ENCODERS[cls] = _compile_encoder(cls)
+    return encoder(obj)
+
+
+def _to_dict(obj: Any) -> Any:
+    """Reference implementation of `to_dict`."""
     if isinstance(obj, BaseModel):
         return obj.dict()
     elif is_dataclass(obj):
         return dataclasses.asdict(obj)
     elif isinstance(obj, list):
-        return [to_dict(o) for o in obj]
+        return [_to_dict(o) for o in obj]
     elif isinstance(obj, dict):
-        return {k: to_dict(v) for k, v in obj.items()}
+        return {k: _to_dict(v) for k, v in obj.items()}
     elif isinstance(obj, (str, bool, float, int)):
         return obj
     else:
@@ -277,6 +732,20 @@ T = TypeVar("T")
 
 
 def of_dict(t: Type[T], d: Any) -> T:
+    """Converts the json-like value `d` to an instance of the type `t`.
+
+    The decoder for each type is compiled once and cached, see `compile_decoder`.
+    """
+    try:
+        decoder = compile_decoder(t)
+    except TypeError:
+        # unhashable type annotation
+        return _of_dict(t, d)
+    return decoder(d)
+
+
+def _of_dict(t: Type[T], d: Any) -> T:
+    """Reference implementation of `of_dict`."""
     if isinstance(t, ModelMetaclass):
         assert isinstance(d, dict)
         return t.parse_obj(d)
@@ -289,12 +758,12 @@ def of_dict(t: Type[T], d: Any) -> T:
         if len(args)!= 1:
             return d # type: ignore
         (arg,) = args
-        return [of_dict(arg, o) for o in d]  # type: ignore
+        return [_of_dict(arg, o) for o in d]  # type: ignore
     elif t == dict:
         (kt, vt) = typing.get_args(t)
         assert isinstance(d, dict)
         assert kt in [str, int]
-        return {of_dict(kt, k): of_dict(vt, v) for k, v in d.items()}  # type: ignore
+        return {_of_dict(kt, k): _of_dict(vt, v) for k, v in d.items()}  # type: ignore
     elif t in [str, int, float, bool]:
         assert isinstance(d, t)
         return d
@@ -302,14 +771,205 @@ def of_dict(t: Type[T], d: Any) -> T:
         raise TypeError(f"unsupported datatype={t}")
 
 
+_compiling = threading.local()
+
+
+def _dacite_field_builder(tp: Any) -> Optional[Callable[[Any], Any]]:
+    """Replicates dacite's build-and-type-check of a value for field type `tp`.
+
+    Returns None for types without a fast path. The builder raises `_Fallback`
+    whenever dacite might behave differently, eg on a type mismatch that dacite reports.
+    """
+    if tp is float:
+
+        def build_float(v):
+            if isinstance(v, (int, float)):
+                return v
+            raise _Fallback()
+
+        return build_float
+    elif tp in (str, int, bool):
+
+        def build_primitive(v):
+            if isinstance(v, tp):
+                return v
+            raise _Fallback()
+
+        return build_primitive
+    elif isinstance(tp, type) and is_dataclass(tp):
+        inner = _compile_dataclass(tp)
+        if inner is None:
+            return None
+
+        def build_dataclass(v):
+            if isinstance(v, dict):
+                return inner(v)
+            raise _Fallback()
+
+        return build_dataclass
+    elif typing.get_origin(tp) is list and len(typing.get_args(tp)) == 1:
+        item = _dacite_field_builder(typing.get_args(tp)[0])
+        if item is None:
+            return None
+
+        def build_list(v):
+            if type(v) is list:
+                return [item(x) for x in v]
+            raise _Fallback()
+
+        return build_list
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_dataclass(t: type) -> Optional[Callable[[dict], Any]]:
+    """Fast replacement for `dacite.from_dict(t, d)` on the common case where
+    every field is present and every value has the annotated type. Returns None
+    if the dataclass uses features (defaults aside) that only dacite handles."""
+    in_progress = _compiling.__dict__.setdefault("types", set())
+    if t in in_progress:
+        # recursive dataclass
+        return None
+    in_progress.add(t)
+    try:
+        try:
+            hints = typing.get_type_hints(t)
+        except Exception:
+            return None
+        fields = dataclasses.fields(t)
+        if len(fields) != len(t.__dataclass_fields__) or any(
+            not f.init for f in fields
+        ):
+            # InitVars, ClassVars or init=False fields
+            return None
+        builders = []
+        for f in fields:
+            builder = _dacite_field_builder(hints[f.name])
+            if builder is None:
+                return None
+            builders.append((f.name, builder))
+    finally:
+        in_progress.discard(t)
+
+    def build(d: dict):
+        kwargs = {}
+        for name, builder in builders:
+            if name not in d:
+                raise _Fallback()
+            kwargs[name] = builder(d[name])
+        return t(**kwargs)
+
+    return build
+
+
+def _decode_unsupported(t: Any) -> Callable[[Any], Any]:
+    def decode(d):
+        return _of_dict(t, d)
+
+    return decode
+
+
+@functools.lru_cache(maxsize=None)
+def compile_decoder(t: Type[T]) -> Callable[[Any], T]:
+    """Returns a function equivalent to `lambda d: of_dict(t, d)`, specialised to `t`.
+
+    Type dispatch is done once here instead of on every value,
+    and dataclasses skip `dacite` unless the data needs its full treatment.
+    Raises TypeError if `t` is not hashable.
+    """
+    if isinstance(t, ModelMetaclass):
+        parse_obj = t.parse_obj  # type: ignore
+
+        def decode_model(d):
+            assert isinstance(d, dict)
+            return parse_obj(d)
+
+        return decode_model
+    elif is_dataclass(t):
+        fast = _compile_dataclass(t) if isinstance(t, type) else None
+
+        def decode_dataclass(d):
+            assert isinstance(d, dict)
+            if fast is not None:
+                try:
+                    return fast(d)
+                except _Fallback:
+                    pass
+            return dacite.from_dict(t, d)  # type: ignore
+
+        return decode_dataclass
+    elif t == list or typing.get_origin(t) == list:
+        args = typing.get_args(t)
+        if len(args) != 1:
+
+            def decode_untyped_list(d):
+                assert isinstance(d, list)
+                return d
+
+            return decode_untyped_list
+        (arg,) = args
+        try:
+            item = compile_decoder(arg)
+        except TypeError:
+            item = _decode_unsupported(arg)
+
+        def decode_list(d):
+            assert isinstance(d, list)
+            return [item(o) for o in d]
+
+        return decode_list
+    elif t in [str, int, float, bool]:
+
+        def decode_primitive(d):
+            assert isinstance(d, t)
+            return d
+
+        return decode_primitive
+    else:
+        return _decode_unsupported(t)
+
+
+@functools.lru_cache(maxsize=256)
+def _structured_template_cached(
+    input_spec: Type, output_spec: Type, instructions: str
+) -> PayloadTemplate:
+    return _structured_template(input_spec, output_spec, instructions)
+
+
+def _structured_template(
+    input_spec: Type, output_spec: Type, instructions: str
+) -> PayloadTemplate:
+    return PayloadTemplate(
+        dict(
+            input_spec=flatten_model(input_spec),
+            output_spec=flatten_model(output_spec),
+            instructions=instructions,
+        )
+    )
+
+
+def structured_template(
+    input_spec: Type, output_spec: Type, instructions: str
+) -> PayloadTemplate:
+    """Returns the request template of a structured task, with the specs and instructions pre-serialized."""
+    try:
+        hash((input_spec, output_spec, instructions))
+    except TypeError:
+        return _structured_template(input_spec, output_spec, instructions)
+    return _structured_template_cached(input_spec, output_spec, instructions)
+
+
 @dataclass
 class Structured(CapabilityBase):
     """
     `Structured` class allows making requests to the multi API for structured tasks. The class extends CapabilityBase which provides required functionality to interact with multi API. Structured tasks are tasks with specific input and output specs with a natural language instruction.
 
     Attributes:
-        headers (Dict[Any, Any]): HTTP headers to use in requests. It includes the Content-type and API Key parameters.
-        url (str): API endpoint URL
+        headers (Dict[Any, Any]): Extra HTTP headers to send with each request. The Content-type and API Key headers are provided by the client.
+        url (str): API endpoint, either a path resolved against the client's `base_url` or an absolute URL.
+        client (CapabilitiesClient): the client used to send requests, defaults to the shared client.
+        policy (CallPolicy): deadline, hedging and circuit breaking of the calls, configured per uri in `_CAPABILITIES`.
+        batcher (MicroBatcher): if given, calls with the same specs and instructions are collected into batched requests to `url + "/batch"`.
 
     Methods:
         __call__(self, input_spec: ModelMetaclass, output_spec: ModelMetaclass, instructions: str, input: BaseModel) -> Union[output_spec, BaseModel]: Calls the API by sending a payload within a request object. Returns output_spec object if output_spec is ModelMetaclass or if it is an instance of a BaseModel.
@@ -317,13 +977,9 @@ class Structured(CapabilityBase):
         async run_async(self, input_spec: ModelMetaclass, output_spec: ModelMetaclass, instructions: str, input: BaseModel, session=None) -> Union[output_spec, BaseModel]: Calls the API asynchronously. Returns output_spec object if output_spec is ModelMetaclass or if it is an instance of a BaseModel.
     """
 
-    headers: dict = field(
-        default_factory=lambda: {
-            "Content-type": "application/json",
-            "api-key": CONFIG.api_key,
-        }
-    )
-    url: str = "https://api.blazon.ai/blazon/structured"
+    headers: dict = field(default_factory=dict)
+    url: str = "/blazon/structured"
+    batcher: Optional[MicroBatcher] = None
 
     def __call__(
         self,
@@ -332,17 +988,23 @@ class Structured(CapabilityBase):
         instructions: str,
         input: Any,
     ):
-        payload = dict(
-            input_spec=flatten_model(input_spec),
-            output_spec=flatten_model(output_spec),
-            instructions=instructions,
-            input=to_dict(input),
+        template = structured_template(input_spec, output_spec, instructions)
+        if self.batcher is not None:
+            output = self.batcher.call(
+                self.get_client(),
+                self.url + BATCH_SUFFIX,
+                template,
+                to_dict(input),
+                headers=self.headers,
+                policy=self.policy,
+            )
+            return of_dict(output_spec, output)
+        payload = template.render(to_dict(input))
+        result = self.get_client().post(
+            self.url, payload, headers=self.headers, policy=self.policy
         )
-        r = requests.post(self.url, headers=self.headers, json=payload)
-        r.raise_for_status()
-        logger.debug("R: ", r)
-        result = r.json()["output"]
-        return of_dict(output_spec, result)
+        logger.debug("R: %s", result)
+        return of_dict(output_spec, result["output"])
 
     async def run_async(
         self,
@@ -352,42 +1014,54 @@ class Structured(CapabilityBase):
         input: BaseModel,
         session=None,
     ):
-        payload = dict(
-            input_spec=flatten_model(input_spec),
-            output_spec=flatten_model(output_spec),
-            input=to_dict(input),
-            instructions=instructions,
+        template = structured_template(input_spec, output_spec, instructions)
+        if self.batcher is not None:
+            output = await self.batcher.call_async(
+                self.get_client(),
+                self.url + BATCH_SUFFIX,
+                template,
+                to_dict(input),
+                headers=self.headers,
+                policy=self.policy,
+                session=session,
+            )
+            return of_dict(output_spec, output)
+        payload = template.render(to_dict(input))
+        result = await self.get_client().apost(
+            self.url, payload, headers=self.headers, session=session, policy=self.policy
         )
-        if session is None:
-            async with aiohttp.ClientSession(
-                connector=aiohttp.TCPConnector(ssl=False)
-            ) as session:
-                async with session.post(
-                    self.url, headers=self.headers, json=payload
-                ) as resp:
-                    result = await resp.json()
-                    result = result["output"]
-                    return of_dict(output_spec, result)
-        else:
-            async with session.post(
-                self.url, headers=self.headers, json=payload
-            ) as resp:
-                result = (await resp.json())["output"]
-                return of_dict(output_spec, result)
+        return of_dict(output_spec, result["output"])
+
+
+def _structured_policy() -> CallPolicy:
+    return CallPolicy(timeout=120.0, attempt_timeout=60.0, breaker=CircuitBreaker())
+
+
+def _document_policy() -> CallPolicy:
+    # whole documents take much longer to process than structured inputs.
+    return CallPolicy(timeout=600.0, attempt_timeout=300.0, breaker=CircuitBreaker())
 
 
+# Each uri has its own `CallPolicy`, eg `CallPolicy(hedge=True, ...)` hedges slow calls after their p95 latency.
 _CAPABILITIES = {
-    "multi/structured": Structured(),
-    "multi/document_qa": DocumentQA(),
-    "multi/summarize": Summarize(),
-    "blazon/structured": Structured(),
-    "blazon/document_qa": DocumentQA(),
-    "blazon/summarize": Summarize(),
+    "multi/structured": Structured(policy=_structured_policy()),
+    "multi/document_qa": DocumentQA(policy=_document_policy()),
+    "multi/summarize": Summarize(policy=_document_policy()),
+    "blazon/structured": Structured(policy=_structured_policy()),
+    "blazon/document_qa": DocumentQA(policy=_document_policy()),
+    "blazon/summarize": Summarize(policy=_document_policy()),
 }
 
 
 @dataclass
 class Capability(CapabilityBase):
+    """Looks up a capability by uri.
+
+    If a `client` is given, the looked-up capability sends its requests through it
+    instead of the process-wide default client, and if a `policy` is given, its calls use it
+    instead of the capability's default policy.
+    """
+
     uri: str
     _capability: Optional[CapabilityBase] = None
 
@@ -397,10 +1071,20 @@ class Capability(CapabilityBase):
     async def run_async(self, *args, **kwargs):
         return await self._capability.run_async(*args, **kwargs)
 
+    def stream(self, *args, **kwargs):
+        return self._capability.stream(*args, **kwargs)
+
+    def astream(self, *args, **kwargs):
+        return self._capability.astream(*args, **kwargs)
+
     def __post_init__(self):
         try:
             self._capability = _CAPABILITIES[self.uri]
         except KeyError as e:
-            print(f"Capability lookup failed for uri={self.uri}.\nValid URIs are:")
-            for k in _CAPABILITIES.keys():
-                print(f"  {k}")
+            logger.error(
+                f"Capability lookup failed for uri={self.uri}. Valid URIs are: {', '.join(_CAPABILITIES)}"
+            )
+            return
+        changes = {k: v for k, v in [("client", self.client), ("policy", self.policy)] if v is not None}
+        if changes:
+            self._capability = dataclasses.replace(self._capability, **changes)
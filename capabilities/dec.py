@@ -1,12 +1,28 @@
 import functools
 import inspect
-from typing import Callable, Generic, ParamSpec, TypeVar, overload
+from typing import (
+    Any,
+    Callable,
+    Generic,
+    Iterable,
+    List,
+    Optional,
+    ParamSpec,
+    TypeVar,
+    Union,
+    overload,
+)
 import warnings
 
-import requests
-from capabilities.config import CONFIG
+from capabilities.adaptive import AdaptiveLimiter
+from capabilities.batch import BatchResult, amap_calls, map_calls
+from capabilities.client import CapabilitiesClient, get_default_client
+from capabilities.microbatch import BATCH_SUFFIX, MicroBatcher
+from capabilities.payload import PayloadTemplate
+from capabilities.resilience import CallPolicy
 
 from capabilities.core import (
+    _CAPABILITIES,
     StructuredSchema,
     flatten_model,
     of_dict,
@@ -34,8 +50,24 @@ def _flatten_param(param: inspect.Parameter, path=[]) -> StructuredSchema:
 class AiFunction(Generic[P, R]):
     __wrapped__: Callable[P, R]
 
-    def __init__(self, func, *, instructions=None, **kwargs):
+    url = "/blazon/structured"
+
+    def __init__(
+        self,
+        func,
+        *,
+        instructions=None,
+        client: Optional[CapabilitiesClient] = None,
+        policy: Optional[CallPolicy] = None,
+        batcher: Optional[MicroBatcher] = None,
+        **kwargs,
+    ):
         functools.update_wrapper(self, func)
+        self.client = client
+        # concurrent calls are sent as batched requests to the batch endpoint if a batcher is given.
+        self.batcher = batcher
+        # calls share the deadline, hedging and circuit breaker of the structured capability by default.
+        self.policy = policy if policy is not None else _CAPABILITIES["blazon/structured"].policy
         if instructions is not None:
             self.instructions = instructions
         else:
@@ -53,43 +85,105 @@ class AiFunction(Generic[P, R]):
             k: _flatten_param(p, path=[k]) for k, p in self.signature.parameters.items()
         }
         self.output_spec = flatten_model(self.signature.return_annotation)
+        # [todo](ed) currently endpoint can't handle having root spec not be a dictionary.
+        self._wrap_output = not isinstance(self.output_spec, dict)
+        if self._wrap_output:
+            self._request_output_spec = {"output": self.output_spec}
+        else:
+            self._request_output_spec = self.output_spec
+
+    @property
+    def _template(self) -> PayloadTemplate:
+        # the specs and instructions are serialized once, and again only if the instructions are changed.
+        cached = self.__dict__.get("_cached_template")
+        if cached is None or cached[0] != self.instructions:
+            template = PayloadTemplate(
+                dict(
+                    input_spec=self.input_spec,
+                    output_spec=self._request_output_spec,
+                    instructions=self.instructions,
+                )
+            )
+            cached = self._cached_template = (self.instructions, template)
+        return cached[1]
 
-    def __call__(self, *args: P.args, **kwargs: P.kwargs):
+    def _input(self, *args, **kwargs) -> dict:
         binding = self.signature.bind(*args, **kwargs)
         binding.apply_defaults()
-        input_dict = {k: to_dict(v) for k, v in binding.arguments.items()}
-        # [todo](ed) currently endpoint can't handle having root spec not be a dictionary.
-        wrap_output = not isinstance(self.output_spec, dict)
-        if wrap_output:
-            output_spec = {"output": self.output_spec}
-        else:
-            output_spec = self.output_spec
-        payload = dict(
-            input_spec=self.input_spec,
-            output_spec=output_spec,
-            instructions=self.instructions,
-            input=input_dict,
-        )
-        if CONFIG.api_key is None:
+        return {k: to_dict(v) for k, v in binding.arguments.items()}
+
+    def _payload(self, *args, **kwargs) -> bytes:
+        return self._template.render(self._input(*args, **kwargs))
+
+    def _get_client(self) -> CapabilitiesClient:
+        client = self.client or get_default_client()
+        if "api-key" not in client.headers:
             raise RuntimeError("CAPABILITIES_API_KEY is not set")
-        resp = requests.post(
-            "https://api.blazon.ai/blazon/structured",
-            headers={
-                "Content-Type": "application/json",
-                "api-key": CONFIG.api_key,
-            },
-            json=payload,
-        )
-        resp.raise_for_status()
-        result_dict = resp.json()["output"]
-        if wrap_output:
+        return client
+
+    def _decode(self, response) -> R:
+        result_dict = response["output"]
+        if self._wrap_output:
             result_dict = result_dict["output"]
-        result = of_dict(self.signature.return_annotation, result_dict)
-        return result
+        return of_dict(self.signature.return_annotation, result_dict)
+
+    def __call__(self, *args: P.args, **kwargs: P.kwargs) -> R:
+        if self.batcher is not None:
+            output = self.batcher.call(
+                self._get_client(),
+                self.url + BATCH_SUFFIX,
+                self._template,
+                self._input(*args, **kwargs),
+                policy=self.policy,
+            )
+            return self._decode({"output": output})
+        payload = self._payload(*args, **kwargs)
+        return self._decode(self._get_client().post(self.url, payload, policy=self.policy))
+
+    async def run_async(self, *args: P.args, **kwargs: P.kwargs) -> R:
+        """Async version of calling the function, using the client's pooled session for the running loop."""
+        if self.batcher is not None:
+            output = await self.batcher.call_async(
+                self._get_client(),
+                self.url + BATCH_SUFFIX,
+                self._template,
+                self._input(*args, **kwargs),
+                policy=self.policy,
+            )
+            return self._decode({"output": output})
+        payload = self._payload(*args, **kwargs)
+        return self._decode(
+            await self._get_client().apost(self.url, payload, policy=self.policy)
+        )
+
+    def batch(
+        self, inputs: Iterable[Any], concurrency: Union[int, AdaptiveLimiter] = 8
+    ) -> List[BatchResult[R]]:
+        """Calls the function on each of the `inputs` with at most `concurrency` calls in flight.
+
+        Each input is a tuple of positional arguments, a dict of keyword arguments or a single positional argument.
+        Returns a `BatchResult` per input in input order; failing inputs have `BatchResult.error` set.
+        `concurrency` can also be an `AdaptiveLimiter`.
+        """
+        return list(map_calls(self, inputs, concurrency=concurrency))
+
+    async def abatch(
+        self, inputs: Iterable[Any], concurrency: Union[int, AdaptiveLimiter] = 8
+    ) -> List[BatchResult[R]]:
+        """Async version of `batch`."""
+        return [
+            r async for r in amap_calls(self.run_async, inputs, concurrency=concurrency)
+        ]
 
 
 @overload
-def llm(*, instructions=None) -> Callable[[Callable[P, R]], AiFunction[P, R]]:
+def llm(
+    *,
+    instructions=None,
+    client: Optional[CapabilitiesClient] = None,
+    policy: Optional[CallPolicy] = None,
+    batcher: Optional[MicroBatcher] = None,
+) -> Callable[[Callable[P, R]], AiFunction[P, R]]:
     ...
 
 
@@ -104,7 +198,7 @@ def llm(*args, **kwargs):  # type: ignore
         item = AiFunction(func)
         return item
 
-    if callable(args[0]):
+    if args and callable(args[0]):
         return decorator(args[0])
     else:
         return functools.partial(AiFunction, *args, **kwargs)
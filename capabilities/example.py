@@ -316,6 +316,46 @@ def make_paragraph(bullet_points: List[str]) -> str:
     ).summary
 
 
+def example_pipeline():
+    """
+    Summarizes the passage and answers a question about it concurrently, then combines both into a paragraph.
+    """
+    from capabilities import Pipeline
+
+    class Document(BaseModel):
+        text: str
+
+    class BulletPoints(BaseModel):
+        bullet_points: List[str]
+
+    c = Capability("blazon/structured")
+
+    def bullet_points(passage: str) -> List[str]:
+        return c(
+            Document,
+            BulletPoints,
+            "Summarize the `text` as a list of at most five `bullet_points`.",
+            Document(text=passage),
+        ).bullet_points
+
+    def answer(passage: str, question: str) -> List[str]:
+        claims = Capability("blazon/document_qa")(passage, question)["answer"]["claims"]
+        return [claim["bullet_point"] for claim in claims]
+
+    p = Pipeline(inputs=["passage", "question"])
+    p.add("bullet_points", bullet_points, "passage")
+    p.add("answer", answer, "passage", "question")
+    p.add(
+        "paragraph",
+        lambda bullets, answer: make_paragraph([*bullets, *answer]),
+        "bullet_points",
+        "answer",
+    )
+    run = p.run(passage=EXAMPLE_PASSAGE, question="Who formed the Carborundum Company?")
+    print(run["paragraph"])
+    print(run.report())
+
+
 # example usage: python -m capabilities.example example_translation
 if __name__ == "__main__":
     import sys
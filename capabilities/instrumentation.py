@@ -0,0 +1,234 @@
+import collections
+import contextlib
+import contextvars
+import logging
+import math
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterator, Optional, Sequence
+
+logger = logging.getLogger("capabilities")
+
+
+@dataclass
+class CallMetrics:
+    """Measurements of one capability call, see `Instrumentation`."""
+
+    uri: str
+    """ The capability path that was called, eg "/blazon/summarize". """
+    serialize_seconds: float = 0.0
+    """ Time spent encoding the payload to json. """
+    request_bytes: int = 0
+    """ Size of the last request body sent, after compression. """
+    ttfb_seconds: float = 0.0
+    """ Time from sending the last attempt to receiving its response headers. """
+    latency_seconds: float = 0.0
+    """ Total duration of the call, including retries and waits. """
+    attempts: int = 0
+    """ Number of requests sent, 0 if the call was answered from the cache or shared with an identical call. """
+    response_bytes: int = 0
+    """ Size of the last response body. """
+    decode_seconds: float = 0.0
+    """ Time spent decoding the response json. """
+    cached: bool = False
+    """ Whether the call was answered from the client's `ResultCache`. """
+    error: Optional[BaseException] = None
+
+    @property
+    def retries(self) -> int:
+        return max(0, self.attempts - 1)
+
+
+_metrics: contextvars.ContextVar[Optional[CallMetrics]] = contextvars.ContextVar(
+    "capabilities_call_metrics", default=None
+)
+
+
+def current_metrics() -> Optional[CallMetrics]:
+    """The metrics of the call being measured in the current context, None if calls aren't instrumented."""
+    return _metrics.get()
+
+
+@contextlib.contextmanager
+def measuring(metrics: Optional[CallMetrics]) -> Iterator[None]:
+    """Makes `metrics` the `current_metrics` inside the block, if given."""
+    if metrics is None:
+        yield
+        return
+    token = _metrics.set(metrics)
+    try:
+        yield
+    finally:
+        _metrics.reset(token)
+
+
+class Instrumentation:
+    """Hook receiving the `CallMetrics` of every capability call.
+
+    Subclass it and override `record` to export the metrics, eg to statsd or OpenTelemetry,
+    then pass it as the `instrumentation` of a `CapabilitiesClient` or install it process-wide
+    with `set_instrumentation`. `record` is called on the thread or event loop that made the call,
+    so it should be quick and must not block.
+    """
+
+    enabled = True
+    """ Calls are only measured when this is True. """
+
+    def record(self, metrics: CallMetrics):
+        pass
+
+    @contextlib.contextmanager
+    def measure(self, uri: str, current: bool = True) -> Iterator[CallMetrics]:
+        """Measures the call made inside the block and records it when the block exits.
+
+        If `current` is False the metrics aren't made the `current_metrics` of the whole block, for blocks that
+        yield, such as streams, which can be resumed from another context: use `measuring` around the requests.
+        """
+        metrics = CallMetrics(uri)
+        start = time.perf_counter()
+        try:
+            with measuring(metrics if current else None):
+                yield metrics
+        except GeneratorExit:
+            # a stream that was closed early.
+            raise
+        except BaseException as e:
+            metrics.error = e
+            raise
+        finally:
+            metrics.latency_seconds = time.perf_counter() - start
+            try:
+                self.record(metrics)
+            except Exception:
+                logger.exception(f"[instrumentation] {type(self).__name__}.record failed")
+
+
+class NoopInstrumentation(Instrumentation):
+    """The default: calls are not measured at all."""
+
+    enabled = False
+
+
+class Histogram:
+    """Streaming histogram of non-negative values with logarithmic buckets.
+
+    Quantiles are estimated within `relative_error` of the true value, in constant memory
+    per order of magnitude of the values. Not thread-safe on its own.
+    """
+
+    def __init__(self, relative_error: float = 0.01):
+        self.relative_error = relative_error
+        self._gamma = (1 + relative_error) / (1 - relative_error)
+        self._log_gamma = math.log(self._gamma)
+        self._buckets: Dict[int, int] = collections.Counter()
+        self._zeros = 0
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value: float):
+        self.count += 1
+        self.total += value
+        if value <= 0:
+            self._zeros += 1
+        else:
+            self._buckets[math.ceil(math.log(value) / self._log_gamma)] += 1
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def quantile(self, q: float) -> float:
+        if self.count == 0:
+            return 0.0
+        rank = q * (self.count - 1)
+        seen = self._zeros
+        if rank < seen:
+            return 0.0
+        for i in sorted(self._buckets):
+            seen += self._buckets[i]
+            if rank < seen:
+                return 2 * self._gamma**i / (self._gamma + 1)
+        return 2 * self._gamma ** max(self._buckets) / (self._gamma + 1)
+
+
+METRICS = (
+    "serialize_seconds",
+    "request_bytes",
+    "ttfb_seconds",
+    "latency_seconds",
+    "retries",
+    "response_bytes",
+    "decode_seconds",
+)
+
+
+class HistogramAggregator(Instrumentation):
+    """Aggregates the metrics of each capability uri into in-process histograms.
+
+    `summary()` returns the count, mean and p50/p95/p99 of every metric per uri,
+    for logging or serving on a debug endpoint. Cached calls are only counted in `calls`.
+
+    Args:
+        relative_error: accuracy of the quantile estimates.
+        quantiles: the quantiles reported by `summary`.
+    """
+
+    def __init__(
+        self, relative_error: float = 0.01, quantiles: Sequence[float] = (0.5, 0.95, 0.99)
+    ):
+        self.relative_error = relative_error
+        self.quantiles = tuple(quantiles)
+        self._histograms: Dict[str, Dict[str, Histogram]] = {}
+        self._calls: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, metrics: CallMetrics):
+        with self._lock:
+            calls = self._calls.setdefault(metrics.uri, {"calls": 0, "cached": 0, "errors": 0})
+            calls["calls"] += 1
+            calls["errors"] += metrics.error is not None
+            if metrics.cached:
+                calls["cached"] += 1
+                return
+            hs = self._histograms.setdefault(
+                metrics.uri, {m: Histogram(self.relative_error) for m in METRICS}
+            )
+            for m in METRICS:
+                hs[m].add(getattr(metrics, m))
+
+    def histogram(self, uri: str, metric: str) -> Histogram:
+        with self._lock:
+            return self._histograms[uri][metric]
+
+    def summary(self) -> Dict[str, dict]:
+        """`{uri: {"calls": .., "cached": .., "errors": .., metric: {"count", "mean", "p50", ...}}}`."""
+        with self._lock:
+            result = {}
+            for uri, calls in self._calls.items():
+                s: dict = dict(calls)
+                for m, h in self._histograms.get(uri, {}).items():
+                    s[m] = {"count": h.count, "mean": h.mean}
+                    for q in self.quantiles:
+                        s[m][f"p{q * 100:g}"] = h.quantile(q)
+                result[uri] = s
+            return result
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._calls.clear()
+
+
+_instrumentation: Instrumentation = NoopInstrumentation()
+
+
+def get_instrumentation() -> Instrumentation:
+    """Returns the process-wide instrumentation, a `NoopInstrumentation` unless one was set."""
+    return _instrumentation
+
+
+def set_instrumentation(instrumentation: Optional[Instrumentation]):
+    """Sets the process-wide instrumentation. None restores the no-op default."""
+    global _instrumentation
+    _instrumentation = instrumentation if instrumentation is not None else NoopInstrumentation()
@@ -0,0 +1,215 @@
+import asyncio
+import concurrent.futures
+import threading
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Dict, Hashable, List, Optional, Set, Tuple
+
+from capabilities.payload import PayloadTemplate, dumps
+from capabilities.resilience import CallPolicy
+
+if TYPE_CHECKING:
+    from capabilities.client import CapabilitiesClient
+
+BATCH_SUFFIX = "/batch"
+""" Batch endpoints live under the path of the capability, eg `/blazon/structured/batch`. """
+
+
+class BatchItemError(Exception):
+    """Raised to the caller whose item of a batched request failed, while the rest of the batch succeeded."""
+
+
+@dataclass
+class MicroBatchStats:
+    calls: int = 0
+    """ Number of calls submitted. """
+    batches: int = 0
+    """ Number of batched requests sent. """
+    full_batches: int = 0
+    """ Batches sent because they reached `max_batch_size` rather than because `max_wait` elapsed. """
+
+    @property
+    def mean_batch_size(self) -> float:
+        return self.calls / self.batches if self.batches else 0.0
+
+
+class _Batch:
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop], owners: tuple):
+        self.loop = loop
+        """ The event loop of the async callers, or None for blocking callers. """
+        self.owners = owners
+        """ The objects whose ids are in the batch's key, kept alive so that their ids aren't reused while it's open. """
+        self.items: List[bytes] = []
+        self.futures: List[Any] = []
+        self.full = threading.Event() if loop is None else asyncio.Event()
+
+
+class MicroBatcher:
+    """Collects small structured calls and sends them as batched requests.
+
+    Calls with the same specs and instructions (the same static fields of their `PayloadTemplate`),
+    client, endpoint, headers, policy and session that arrive within `max_wait` seconds of each other are sent as a
+    single request to the batch endpoint, up to `max_batch_size` calls per request.
+    Each caller gets back the output of its own input.
+
+    Batch endpoint contract: `POST <path>/batch` with the static fields of the single-call request and
+    `"inputs": [input, ...]` instead of `"input"`, answered with `{"outputs": [output, ...]}` in the same order.
+    An optional `"errors": [null | message, ...]` fails individual items with `BatchItemError`.
+    A failure of the whole request is raised to every caller of the batch.
+
+    Blocking callers are batched together, and async callers are batched per event loop.
+    The first blocking caller of a batch waits for it to fill up and sends it on its own thread,
+    the async batches are sent by a task of their loop.
+
+    Args:
+        max_batch_size: maximum number of calls per batched request.
+        max_wait: seconds the first call of a batch waits for more calls before the batch is sent.
+    """
+
+    def __init__(self, max_batch_size: int = 32, max_wait: float = 0.005):
+        if max_batch_size < 1:
+            raise ValueError(f"max_batch_size must be positive, got {max_batch_size}")
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.stats = MicroBatchStats()
+        self._lock = threading.Lock()
+        self._open: Dict[Hashable, _Batch] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    def _add(
+        self,
+        key: Hashable,
+        loop: Optional[asyncio.AbstractEventLoop],
+        owners: tuple,
+        item: bytes,
+        future,
+    ) -> Tuple[_Batch, bool]:
+        """Adds the item to the open batch of key. Returns the batch and whether the caller opened it."""
+        with self._lock:
+            self.stats.calls += 1
+            batch = self._open.get(key)
+            opened = batch is None
+            if batch is None:
+                batch = self._open[key] = _Batch(loop, owners)
+            batch.items.append(item)
+            batch.futures.append(future)
+            if len(batch.items) >= self.max_batch_size:
+                del self._open[key]
+                self.stats.full_batches += 1
+                batch.full.set()
+            return batch, opened
+
+    def _close(self, key: Hashable, batch: _Batch):
+        with self._lock:
+            if self._open.get(key) is batch:
+                del self._open[key]
+            self.stats.batches += 1
+
+    @staticmethod
+    def _key(client, url, template, headers, policy, session, loop) -> Hashable:
+        # policies are unhashable dataclasses, so objects are keyed by identity.
+        return (
+            id(client),
+            url,
+            template.batched()._prefix,
+            tuple(sorted(headers.items())) if headers else (),
+            id(policy),
+            id(session),
+            loop,
+        )
+
+    @staticmethod
+    def _body(template: PayloadTemplate, batch: _Batch) -> bytes:
+        return template.batched().render_encoded(b"[" + b",".join(batch.items) + b"]")
+
+    def _deliver(self, batch: _Batch, response: Any = None, error: Optional[BaseException] = None):
+        if error is None:
+            try:
+                outputs = response["outputs"]
+                errors = response.get("errors") or [None] * len(outputs)
+                if len(outputs) != len(batch.futures) or len(errors) != len(outputs):
+                    raise ValueError(
+                        f"batch of {len(batch.futures)} inputs was answered with {len(outputs)} outputs"
+                    )
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                error = e
+        for i, future in enumerate(batch.futures):
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            elif errors[i] is not None:
+                future.set_exception(BatchItemError(errors[i]))
+            else:
+                future.set_result(outputs[i])
+
+    def call(
+        self,
+        client: "CapabilitiesClient",
+        url: str,
+        template: PayloadTemplate,
+        input: Any,
+        headers: Optional[dict] = None,
+        policy: Optional[CallPolicy] = None,
+    ) -> Any:
+        """Makes the call of `template` with `input` as part of a batch sent to `url` and returns its output."""
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        key = self._key(client, url, template, headers, policy, None, None)
+        batch, opened = self._add(key, None, (client, policy), dumps(input), future)
+        if opened:
+            batch.full.wait(self.max_wait)
+            self._close(key, batch)
+            try:
+                response = client.post(url, self._body(template, batch), headers=headers, policy=policy)
+            except BaseException as e:
+                self._deliver(batch, error=e)
+                if not isinstance(e, Exception):
+                    raise
+            else:
+                self._deliver(batch, response)
+        return future.result()
+
+    async def call_async(
+        self,
+        client: "CapabilitiesClient",
+        url: str,
+        template: PayloadTemplate,
+        input: Any,
+        headers: Optional[dict] = None,
+        policy: Optional[CallPolicy] = None,
+        session=None,
+    ) -> Any:
+        """Async version of `call`."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        key = self._key(client, url, template, headers, policy, session, loop)
+        batch, opened = self._add(key, loop, (client, policy, session), dumps(input), future)
+        if opened:
+            # the batch is sent by its own task, so that cancelling this caller doesn't fail the others.
+            task = loop.create_task(
+                self._flush(client, url, template, headers, policy, session, key, batch)
+            )
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return await future
+
+    async def _flush(self, client, url, template, headers, policy, session, key, batch: _Batch):
+        try:
+            await asyncio.wait_for(batch.full.wait(), self.max_wait)
+        except asyncio.TimeoutError:
+            pass
+        self._close(key, batch)
+        if all(f.done() for f in batch.futures):
+            # every caller was cancelled.
+            return
+        try:
+            response = await client.apost(
+                url, self._body(template, batch), headers=headers, session=session, policy=policy
+            )
+        except Exception as e:
+            self._deliver(batch, error=e)
+        except BaseException:
+            for future in batch.futures:
+                future.cancel()
+            raise
+        else:
+            self._deliver(batch, response)
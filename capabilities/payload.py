@@ -0,0 +1,70 @@
+import gzip
+import json
+import zlib
+from typing import Any, Optional
+
+try:
+    import orjson
+except ModuleNotFoundError:
+    orjson = None
+
+
+def dumps(obj: Any) -> bytes:
+    """Encodes `obj` as compact json bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def loads(data: bytes) -> Any:
+    """Decodes json bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class PayloadTemplate:
+    """A json object whose static fields are serialized once.
+
+    Rendering only encodes the per-call value and splices it after the pre-encoded fields,
+    so `template.render(x)` is equivalent to `dumps({**static, key: x})`.
+
+    Args:
+        static: the fields that are the same for every call.
+        key: name of the field that holds the per-call value.
+    """
+
+    def __init__(self, static: dict, key: str = "input"):
+        if key in static:
+            raise ValueError(f"{key!r} can't be both a static and a per-call field")
+        self.static = static
+        self.key = key
+        prefix = dumps(static)[:-1]
+        if static:
+            prefix += b","
+        self._prefix = prefix + dumps(key) + b":"
+
+    def render(self, value: Any) -> bytes:
+        return self._prefix + dumps(value) + b"}"
+
+    def render_encoded(self, encoded: bytes) -> bytes:
+        """Like `render`, for a per-call value that is already encoded json."""
+        return self._prefix + encoded + b"}"
+
+    def batched(self, key: str = "inputs") -> "PayloadTemplate":
+        """The template of a batched request: the same static fields, with a list of per-call values under `key`."""
+        batched = self.__dict__.get("_batched")
+        if batched is None or batched.key != key:
+            batched = self._batched = PayloadTemplate(self.static, key)
+        return batched
+
+
+def compress(body: bytes, encoding: Optional[str], level: int = 6) -> bytes:
+    """Compresses a request body with the given `Content-Encoding` (gzip, deflate or None)."""
+    if encoding is None:
+        return body
+    elif encoding == "gzip":
+        return gzip.compress(body, compresslevel=level, mtime=0)
+    elif encoding == "deflate":
+        return zlib.compress(body, level)
+    raise ValueError(f"unsupported content encoding {encoding!r}")
@@ -0,0 +1,349 @@
+import asyncio
+import contextvars
+import inspect
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from capabilities.cache import MISSING, ResultCache, payload_key
+
+logger = logging.getLogger("capabilities")
+
+
+@dataclass
+class Step:
+    """A call of the pipeline, and the names of the inputs and steps its arguments come from."""
+
+    name: str
+    fn: Callable
+    args: Tuple[str, ...] = ()
+    """ Names of the values passed as positional arguments. """
+    kwargs: Dict[str, str] = field(default_factory=dict)
+    """ Keyword argument name to the name of the value passed for it. """
+    cache: bool = True
+    """ Whether the output is kept in the pipeline's cache. """
+    version: Optional[str] = None
+    """ Part of the cache key, to change when `fn` changes without being renamed. """
+
+    @property
+    def fn_name(self) -> str:
+        """Qualified name of the function, so that steps of the same name calling different functions
+        don't share cached outputs."""
+        fn = self.fn
+        if not hasattr(fn, "__qualname__"):
+            fn = type(fn)
+        return f"{getattr(fn, '__module__', None)}.{fn.__qualname__}"
+
+    @property
+    def deps(self) -> List[str]:
+        return [*self.args, *self.kwargs.values()]
+
+
+@dataclass
+class StepTiming:
+    start: float
+    """ Seconds from the start of the run to the start of the step. """
+    end: float
+    """ Seconds from the start of the run to the end of the step. """
+    cached: bool = False
+    """ Whether the output came from the cache rather than a call. """
+
+    @property
+    def seconds(self) -> float:
+        return self.end - self.start
+
+
+@dataclass
+class PipelineRun:
+    """Outputs and timings of a run of a `Pipeline`."""
+
+    results: Dict[str, Any]
+    """ Output of every step that ran, and the inputs of the run. """
+    timings: Dict[str, StepTiming]
+    critical_path: List[str]
+    """ The chain of dependent steps that ended last: the run can't be faster than this chain. """
+    wall_seconds: float
+
+    @property
+    def critical_path_seconds(self) -> float:
+        """Total duration of the steps on the critical path."""
+        return sum(self.timings[name].seconds for name in self.critical_path)
+
+    def __getitem__(self, name: str) -> Any:
+        return self.results[name]
+
+    def report(self) -> str:
+        lines = [
+            f"wall {self.wall_seconds * 1e3:.1f} ms, critical path {self.critical_path_seconds * 1e3:.1f} ms:"
+            f" {' -> '.join(self.critical_path)}"
+        ]
+        for name, t in sorted(self.timings.items(), key=lambda kv: kv[1].start):
+            mark = "*" if name in self.critical_path else " "
+            cached = " (cached)" if t.cached else ""
+            lines.append(
+                f"{mark} {name:<24} {t.start * 1e3:8.1f} -> {t.end * 1e3:8.1f} ms{cached}"
+            )
+        return "\n".join(lines)
+
+
+class PipelineError(Exception):
+    """Raised when a step of a pipeline fails. The error of the step is the `__cause__`."""
+
+    def __init__(self, step: str, run: PipelineRun):
+        super().__init__(f"pipeline step {step!r} failed")
+        self.step = step
+        self.run = run
+        """ The outputs and timings of the steps that completed before the failure. """
+
+
+class Pipeline:
+    """A DAG of calls, such as `AiFunction`s and capabilities, with data dependencies between them.
+
+    Each step is called with the outputs of the steps (or the inputs of the run) it depends on,
+    as soon as they are all available, so that independent branches run concurrently.
+    Within a run each step is called once, and if a `cache` is given, outputs of previous runs are reused
+    for the same step name, function, version and arguments. Each run reports its timings and critical path.
+
+    ```
+    p = Pipeline(inputs=["passage"])
+    p.add("summary", summarize, "passage")
+    p.add("claims", extract_claims, "passage")
+    p.add("report", write_report, summary="summary", claims="claims")
+    run = p.run(passage=text)
+    run["report"], run.report()
+    ```
+
+    Args:
+        inputs: names of the values given to each run.
+        cache: cache of the step outputs, shared between runs.
+        max_workers: maximum number of steps running at once in `run`.
+    """
+
+    def __init__(
+        self,
+        inputs: Iterable[str] = (),
+        cache: Optional[ResultCache] = None,
+        max_workers: int = 8,
+    ):
+        self.inputs = list(inputs)
+        self.steps: Dict[str, Step] = {}
+        self.cache = cache
+        self.max_workers = max_workers
+
+    def add(
+        self,
+        name: str,
+        fn: Callable,
+        *args: str,
+        cache: bool = True,
+        version: Optional[str] = None,
+        **kwargs: str,
+    ) -> Step:
+        """Adds the step `name` calling `fn(*args, **kwargs)` with the values of the named inputs and steps.
+
+        Cached outputs are keyed by the qualified name of `fn` and `version`, to be changed when the
+        behaviour of `fn` changes.
+
+        Dependencies must be added before the steps that use them, so the pipeline can't have cycles.
+        """
+        if name in self.steps or name in self.inputs:
+            raise ValueError(f"duplicate pipeline step {name!r}")
+        step = Step(name, fn, tuple(args), dict(kwargs), cache, version)
+        for dep in step.deps:
+            if dep not in self.steps and dep not in self.inputs:
+                raise ValueError(f"step {name!r} depends on unknown step or input {dep!r}")
+        self.steps[name] = step
+        return step
+
+    def step(
+        self,
+        *args: str,
+        name: Optional[str] = None,
+        cache: bool = True,
+        version: Optional[str] = None,
+        **kwargs: str,
+    ):
+        """Decorator version of `add`, named after the decorated function by default."""
+
+        def decorator(fn):
+            self.add(name or fn.__name__, fn, *args, cache=cache, version=version, **kwargs)
+            return fn
+
+        return decorator
+
+    def _plan(self, outputs: Optional[Sequence[str]], inputs: Dict[str, Any]) -> List[str]:
+        """The steps needed for `outputs` (all steps if None), in the order they were added."""
+        missing = [i for i in self.inputs if i not in inputs]
+        if missing:
+            raise TypeError(f"pipeline run is missing inputs {missing}")
+        if outputs is None:
+            return list(self.steps)
+        needed: Set[str] = set()
+        todo = list(outputs)
+        while todo:
+            name = todo.pop()
+            if name in needed or name in self.inputs:
+                continue
+            if name not in self.steps:
+                raise KeyError(f"unknown pipeline step {name!r}")
+            needed.add(name)
+            todo.extend(self.steps[name].deps)
+        return [name for name in self.steps if name in needed]
+
+    def _key(self, step: Step, args: tuple, kwargs: dict) -> Optional[str]:
+        if self.cache is None or not step.cache:
+            return None
+        from capabilities.core import to_dict
+
+        try:
+            return payload_key(
+                f"pipeline/{step.name}",
+                {
+                    "fn": step.fn_name,
+                    "version": step.version,
+                    "args": [to_dict(a) for a in args],
+                    "kwargs": to_dict(kwargs),
+                },
+            )
+        except TypeError:
+            # outputs that can't be converted to json values aren't cached.
+            return None
+
+    @staticmethod
+    def _arguments(step: Step, results: Dict[str, Any]) -> Tuple[tuple, dict]:
+        return (
+            tuple(results[d] for d in step.args),
+            {k: results[d] for k, d in step.kwargs.items()},
+        )
+
+    @staticmethod
+    def _critical_path(
+        plan: List[str], steps: Dict[str, Step], timings: Dict[str, StepTiming]
+    ) -> List[str]:
+        path: List[str] = []
+        done = [name for name in plan if name in timings]
+        name = max(done, key=lambda n: timings[n].end, default=None)
+        while name is not None:
+            path.append(name)
+            deps = [d for d in steps[name].deps if d in timings]
+            name = max(deps, key=lambda d: timings[d].end, default=None)
+        return path[::-1]
+
+    def _finish(
+        self, plan: List[str], results: Dict[str, Any], timings: Dict[str, StepTiming], start: float
+    ) -> PipelineRun:
+        run = PipelineRun(
+            results,
+            timings,
+            self._critical_path(plan, self.steps, timings),
+            time.perf_counter() - start,
+        )
+        logger.debug("pipeline run:\n%s", run.report())
+        return run
+
+    def _call(self, step: Step, args: tuple, kwargs: dict, start: float) -> Tuple[Any, StepTiming]:
+        key = self._key(step, args, kwargs)
+        t0 = time.perf_counter() - start
+        if key is not None:
+            value = self.cache.get(key)  # type: ignore
+            if value is not MISSING:
+                return value, StepTiming(t0, time.perf_counter() - start, cached=True)
+        value = step.fn(*args, **kwargs)
+        if key is not None:
+            self.cache.set(key, value)  # type: ignore
+        return value, StepTiming(t0, time.perf_counter() - start)
+
+    async def _acall(
+        self, step: Step, args: tuple, kwargs: dict, start: float
+    ) -> Tuple[Any, StepTiming]:
+        key = self._key(step, args, kwargs)
+        t0 = time.perf_counter() - start
+        if key is not None:
+            value = self.cache.get(key)  # type: ignore
+            if value is not MISSING:
+                return value, StepTiming(t0, time.perf_counter() - start, cached=True)
+        fn = step.fn
+        if hasattr(fn, "run_async"):
+            value = await fn.run_async(*args, **kwargs)
+        elif inspect.iscoroutinefunction(fn):
+            value = await fn(*args, **kwargs)
+        else:
+            value = await asyncio.to_thread(fn, *args, **kwargs)
+        if key is not None:
+            self.cache.set(key, value)  # type: ignore
+        return value, StepTiming(t0, time.perf_counter() - start)
+
+    def run(self, outputs: Optional[Sequence[str]] = None, **inputs: Any) -> PipelineRun:
+        """Runs the steps needed for `outputs` (all steps if None) on a thread pool.
+
+        Raises `PipelineError` from the error of the first failing step, after the running steps complete.
+        """
+        plan = self._plan(outputs, inputs)
+        start = time.perf_counter()
+        results: Dict[str, Any] = dict(inputs)
+        timings: Dict[str, StepTiming] = {}
+        waiting = list(plan)
+        running: Dict[Future, str] = {}
+        failed: Optional[Tuple[str, BaseException]] = None
+        with ThreadPoolExecutor(self.max_workers, thread_name_prefix="pipeline") as pool:
+            while waiting or running:
+                if failed is None:
+                    for name in [n for n in waiting if all(d in results for d in self.steps[n].deps)]:
+                        waiting.remove(name)
+                        step = self.steps[name]
+                        args, kwargs = self._arguments(step, results)
+                        ctx = contextvars.copy_context()
+                        running[pool.submit(ctx.run, self._call, step, args, kwargs, start)] = name
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name], timings[name] = future.result()
+                    except Exception as e:
+                        if failed is None:
+                            failed = (name, e)
+        run = self._finish(plan, results, timings, start)
+        if failed is not None:
+            raise PipelineError(failed[0], run) from failed[1]
+        return run
+
+    async def run_async(self, outputs: Optional[Sequence[str]] = None, **inputs: Any) -> PipelineRun:
+        """Async version of `run`. Steps with a `run_async` method, such as `AiFunction`s and capabilities,
+        and coroutine functions are awaited on the running loop, other functions run in threads."""
+        plan = self._plan(outputs, inputs)
+        start = time.perf_counter()
+        results: Dict[str, Any] = dict(inputs)
+        timings: Dict[str, StepTiming] = {}
+        waiting = list(plan)
+        running: Dict[asyncio.Task, str] = {}
+        failed: Optional[Tuple[str, BaseException]] = None
+        try:
+            while waiting or running:
+                if failed is None:
+                    for name in [n for n in waiting if all(d in results for d in self.steps[n].deps)]:
+                        waiting.remove(name)
+                        step = self.steps[name]
+                        args, kwargs = self._arguments(step, results)
+                        running[asyncio.create_task(self._acall(step, args, kwargs, start))] = name
+                if not running:
+                    break
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name = running.pop(task)
+                    try:
+                        results[name], timings[name] = task.result()
+                    except Exception as e:
+                        if failed is None:
+                            failed = (name, e)
+        finally:
+            # only reached with running steps if this run is cancelled.
+            for task in running:
+                task.cancel()
+        run = self._finish(plan, results, timings, start)
+        if failed is not None:
+            raise PipelineError(failed[0], run) from failed[1]
+        return run
@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional, Union
+
+logger = logging.getLogger("capabilities")
+
+
+def count_tokens(text: str) -> int:
+    """Estimates the number of tokens in `text` with the tiktoken encoder of `capabilities.util`."""
+    from capabilities.util import tokenize
+
+    return len(tokenize(text))
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled at `rate` units per second, holding at most `capacity` units.
+
+    Units are reserved rather than waited for: `reserve(n)` takes them immediately, letting the
+    level go negative, and returns how long the caller has to wait before using them.
+    Callers are therefore served in the order they reserve, and a single reservation larger than
+    the capacity is allowed, it just waits for the bucket to refill.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        if rate <= 0 or capacity <= 0:
+            raise ValueError("rate and capacity must be positive")
+        self.rate = rate
+        self.capacity = capacity
+        self._level = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, n: float) -> float:
+        """Takes `n` units and returns the number of seconds to wait before using them."""
+        with self._lock:
+            now = time.monotonic()
+            self._level = min(
+                self.capacity, self._level + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._level -= n
+            return max(0.0, -self._level / self.rate)
+
+
+@dataclass
+class RateLimitStats:
+    calls: int = 0
+    """ Number of acquisitions. """
+    delayed: int = 0
+    """ Acquisitions that had to wait. """
+    wait_seconds: float = 0.0
+    """ Total time spent waiting. """
+    tokens: int = 0
+    """ Total number of estimated tokens acquired. """
+
+
+class RateLimiter:
+    """Client-side limiter of requests per minute and tokens per minute.
+
+    Every request waits on the limiter before it is sent, so that a process runs at the provider's quota
+    instead of exceeding it and backing off on 429s. Token costs are estimated from the request text
+    with `tokenizer`, which defaults to the tiktoken encoder in `capabilities.util`.
+
+    A process-wide limiter set with `set_rate_limiter` is used by all capability calls,
+    `capabilities.util.text_embed*` and `OpenAIEmbeddingModel.encode`.
+
+    Args:
+        requests_per_minute: maximum request rate. None means unlimited.
+        tokens_per_minute: maximum rate of estimated tokens. None means unlimited.
+        burst_seconds: how many seconds' worth of quota can be spent at once after an idle period.
+        tokenizer: estimates the number of tokens of a text.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        burst_seconds: float = 5.0,
+        tokenizer: Optional[Callable[[str], int]] = None,
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.tokenizer = tokenizer or count_tokens
+        self.stats = RateLimitStats()
+        self._lock = threading.Lock()
+        self._requests = self._bucket(requests_per_minute, burst_seconds)
+        self._tokens = self._bucket(tokens_per_minute, burst_seconds)
+
+    @staticmethod
+    def _bucket(per_minute: Optional[float], burst_seconds: float) -> Optional[TokenBucket]:
+        if per_minute is None:
+            return None
+        rate = per_minute / 60
+        # the bucket must at least hold one request's worth of quota.
+        return TokenBucket(rate, max(1.0, rate * burst_seconds))
+
+    def cost(self, text: Union[str, bytes]) -> int:
+        """Estimated number of tokens of a request, 0 if tokens aren't limited."""
+        if self._tokens is None:
+            return 0
+        if isinstance(text, bytes):
+            text = text.decode("utf-8", errors="replace")
+        return self.tokenizer(text)
+
+    def _reserve(self, tokens: int) -> float:
+        wait = 0.0
+        if self._requests is not None:
+            wait = self._requests.reserve(1)
+        if self._tokens is not None and tokens > 0:
+            wait = max(wait, self._tokens.reserve(tokens))
+        with self._lock:
+            self.stats.calls += 1
+            self.stats.tokens += tokens
+            if wait > 0:
+                self.stats.delayed += 1
+                self.stats.wait_seconds += wait
+        if wait > 0:
+            logger.debug(f"[rate limit] waiting {wait:.2f}s for {tokens} tokens")
+        return wait
+
+    def acquire(self, tokens: int = 0) -> float:
+        """Waits until a request costing `tokens` tokens can be sent, returns the time waited."""
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, tokens: int = 0) -> float:
+        """Async version of `acquire` that waits without blocking the event loop."""
+        wait = self._reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+
+_rate_limiter: Optional[RateLimiter] = None
+
+
+def get_rate_limiter() -> Optional[RateLimiter]:
+    """Returns the process-wide rate limiter, or None if requests are not limited."""
+    return _rate_limiter
+
+
+def set_rate_limiter(limiter: Optional[RateLimiter]):
+    """Sets the process-wide rate limiter. None removes the limit."""
+    global _rate_limiter
+    _rate_limiter = limiter
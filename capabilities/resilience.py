@@ -0,0 +1,425 @@
+import asyncio
+import collections
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Deque, Dict, Optional, TypeVar
+
+from capabilities.retry import DeadlineExceeded, RetryError, RetryPolicy, is_retryable, status_of
+from capabilities.scheduler import current_deadline, scheduling
+
+logger = logging.getLogger("capabilities")
+
+T = TypeVar("T")
+
+Attempt = Callable[[Optional[float]], T]
+""" A single attempt of a call, given the timeout of the attempt in seconds (None for no timeout). """
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request while the circuit of a backend is open."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LatencyTracker:
+    """The latencies of the most recent successful attempts, for estimating quantiles."""
+
+    def __init__(self, window: int = 512):
+        self._latencies: Deque[float] = collections.deque(maxlen=window)
+
+    def __len__(self):
+        return len(self._latencies)
+
+    def add(self, latency: float):
+        self._latencies.append(latency)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """The `q` quantile of the recent latencies, or None if there are none yet."""
+        latencies = sorted(self._latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+@dataclass
+class BreakerStats:
+    opened: int = 0
+    """ Number of times a circuit opened. """
+    rejected: int = 0
+    """ Calls that failed fast because their circuit was open. """
+
+
+class _Circuit:
+    def __init__(self):
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trials = 0
+
+
+class CircuitBreaker:
+    """Fails fast while a backend is degraded, instead of piling up requests and retries on it.
+
+    Each backend (keyed by host) has its own circuit. A circuit opens after `failure_threshold` consecutive
+    failed calls, and calls are then rejected with `CircuitOpenError` for `reset_timeout` seconds.
+    After that the circuit is half-open: up to `half_open_calls` trial calls are let through,
+    and the first of them to succeed closes the circuit, while a failure opens it again.
+    Only retryable failures (connection errors, timeouts, 429s and 5xx responses) count as failures,
+    and only responses count as successes. Other errors, eg a `DeadlineExceeded` raised before the request
+    was sent or an error in the caller's code, say nothing about the backend and leave the circuit as it is.
+    A `CallPolicy` records one outcome per call, once its retries are over, so that a single call retrying
+    through a short outage doesn't open the circuit on its own.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        half_open_calls: int = 1,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.stats = BreakerStats()
+        self._lock = threading.Lock()
+        self._circuits: Dict[str, _Circuit] = collections.defaultdict(_Circuit)
+
+    def state(self, key: str = "") -> str:
+        """"closed", "open" or "half_open"."""
+        with self._lock:
+            circuit = self._circuits[key]
+            if circuit.state == "open" and self._cooled_down(circuit):
+                return "half_open"
+            return circuit.state
+
+    def _cooled_down(self, circuit: _Circuit) -> bool:
+        return time.monotonic() - circuit.opened_at >= self.reset_timeout
+
+    def before_call(self, key: str = ""):
+        """Raises `CircuitOpenError` if a call to the backend must fail fast."""
+        with self._lock:
+            circuit = self._circuits[key]
+            if circuit.state == "open" and self._cooled_down(circuit):
+                circuit.state, circuit.trials = "half_open", 0
+            if circuit.state == "closed":
+                return
+            if circuit.state == "half_open" and circuit.trials < self.half_open_calls:
+                circuit.trials += 1
+                return
+            self.stats.rejected += 1
+            retry_after = max(0.0, circuit.opened_at + self.reset_timeout - time.monotonic())
+        raise CircuitOpenError(
+            f"circuit for {key or 'backend'} is open, failing fast", retry_after
+        )
+
+    def record(self, key: str = "", error: Optional[BaseException] = None):
+        """Records the outcome of a call that `before_call` let through."""
+        failed = error is not None and is_retryable(error)
+        if error is not None and not failed and status_of(error) is None:
+            self.release(key)
+            return
+        with self._lock:
+            circuit = self._circuits[key]
+            if not failed:
+                circuit.state, circuit.failures = "closed", 0
+                return
+            circuit.failures += 1
+            if circuit.state == "half_open" or circuit.failures >= self.failure_threshold:
+                if circuit.state != "open":
+                    self.stats.opened += 1
+                    logger.warning(
+                        f"[circuit breaker] opening circuit for {key or 'backend'} after {error!r}"
+                    )
+                circuit.state, circuit.opened_at = "open", time.monotonic()
+
+    def release(self, key: str = ""):
+        """Records a call that ended without an outcome, eg because it was cancelled."""
+        with self._lock:
+            circuit = self._circuits[key]
+            if circuit.state == "half_open":
+                circuit.trials = max(0, circuit.trials - 1)
+
+
+@dataclass
+class PolicyStats:
+    hedges: int = 0
+    """ Duplicate attempts sent because the first one was slow. """
+    hedge_wins: int = 0
+    """ Hedged attempts that answered before the attempt they duplicated. """
+    hedges_skipped: int = 0
+    """ Blocking attempts that weren't hedged because every worker of the `hedge_executor` was busy. """
+    deadlines_exceeded: int = 0
+
+
+HEDGE_WORKERS = 32
+""" Number of threads running the attempts of hedged blocking calls. """
+
+_hedge_executor: Optional[ThreadPoolExecutor] = None
+_hedge_executor_lock = threading.Lock()
+_hedge_slots = threading.BoundedSemaphore(HEDGE_WORKERS)
+
+
+def hedge_executor() -> ThreadPoolExecutor:
+    """Thread pool running the attempts of hedged blocking calls."""
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _hedge_executor_lock:
+            if _hedge_executor is None:
+                _hedge_executor = ThreadPoolExecutor(
+                    max_workers=HEDGE_WORKERS, thread_name_prefix="capabilities-hedge"
+                )
+    return _hedge_executor
+
+
+def _submit_hedge(fn: Callable[..., T], *args) -> "Optional[Future[T]]":
+    """Runs `fn(*args)` on an idle worker of the `hedge_executor` in the caller's context,
+    or returns None if they are all busy, rather than queueing behind the attempts that are still running."""
+    slots = _hedge_slots
+    if not slots.acquire(blocking=False):
+        return None
+    future = hedge_executor().submit(contextvars.copy_context().run, fn, *args)
+    future.add_done_callback(lambda _: slots.release())
+    return future
+
+
+@dataclass
+class CallPolicy:
+    """Deadline, hedging and circuit breaking of the calls to one capability.
+
+    Policies are configured per capability uri in the `_CAPABILITIES` registry.
+    Latencies and circuits are tracked separately for each backend host.
+
+    Args:
+        timeout: deadline of a whole call including its retries, in seconds. None means no deadline.
+            An enclosing `scheduling(timeout=...)` block can tighten it.
+        attempt_timeout: cap on the duration of a single attempt, in seconds.
+        hedge: whether to send a duplicate of an attempt that takes longer than usual,
+            and take whichever answers first. Blocking calls aren't hedged while every `HEDGE_WORKERS`
+            thread is busy.
+        hedge_quantile: an attempt is hedged once it takes longer than this quantile of the recent latencies.
+        hedge_after: if given, attempts are hedged after this many seconds instead of after `hedge_quantile`.
+        hedge_min_samples: number of latencies observed before hedging on `hedge_quantile`.
+        breaker: if given, calls fail fast with `CircuitOpenError` while the backend is degraded.
+    """
+
+    timeout: Optional[float] = None
+    attempt_timeout: Optional[float] = None
+    hedge: bool = False
+    hedge_quantile: float = 0.95
+    hedge_after: Optional[float] = None
+    hedge_min_samples: int = 20
+    breaker: Optional[CircuitBreaker] = None
+    stats: PolicyStats = field(default_factory=PolicyStats, compare=False)
+    _latencies: Dict[str, LatencyTracker] = field(
+        default_factory=lambda: collections.defaultdict(LatencyTracker),
+        init=False,
+        repr=False,
+        compare=False,
+    )
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False, compare=False
+    )
+
+    def latencies(self, key: str = "") -> LatencyTracker:
+        with self._lock:
+            return self._latencies[key]
+
+    def hedge_delay(self, key: str = "") -> Optional[float]:
+        """Seconds after which an attempt to the backend is hedged, or None if it isn't."""
+        if not self.hedge:
+            return None
+        if self.hedge_after is not None:
+            return self.hedge_after
+        latencies = self.latencies(key)
+        if len(latencies) < self.hedge_min_samples:
+            return None
+        return latencies.quantile(self.hedge_quantile)
+
+    def _attempt_timeout(self, deadline: Optional[float]) -> Optional[float]:
+        timeout = self.attempt_timeout
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceeded("deadline exceeded")
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        return timeout
+
+    def _count(self, stat: str):
+        with self._lock:
+            setattr(self.stats, stat, getattr(self.stats, stat) + 1)
+
+    def call(
+        self, retry: RetryPolicy, key: str, attempt: Attempt[T], hedge: bool = True
+    ) -> T:
+        """Calls `attempt(timeout)` under the policy, retrying according to `retry`.
+
+        `key` identifies the backend. Raises `DeadlineExceeded` once the deadline has passed.
+        """
+        with scheduling(timeout=self.timeout):
+            deadline = current_deadline()
+            if self.breaker is not None:
+                self.breaker.before_call(key)
+            try:
+                result = retry.call_until(deadline, self._attempt, key, attempt, deadline, hedge)
+            except Exception as e:
+                self._record(key, e)
+                raise
+            except BaseException:
+                self._release(key)
+                raise
+            self._record(key)
+            return result
+
+    def _record(self, key: str, error: Optional[BaseException] = None):
+        """Records the outcome of a whole call, after its retries, in the breaker."""
+        if isinstance(error, DeadlineExceeded):
+            self._count("deadlines_exceeded")
+        if self.breaker is None:
+            return
+        # a call that gave up failed with the error of its last attempt.
+        if isinstance(error, (RetryError, DeadlineExceeded)) and error.__cause__ is not None:
+            error = error.__cause__
+        self.breaker.record(key, error)
+
+    def _release(self, key: str):
+        if self.breaker is not None:
+            self.breaker.release(key)
+
+    def _attempt(
+        self, key: str, attempt: Attempt[T], deadline: Optional[float], hedge: bool
+    ) -> T:
+        timeout = self._attempt_timeout(deadline)
+        if hedge:
+            return self._hedged(key, attempt, timeout)
+        return self._timed(key, attempt, timeout)
+
+    def _timed(self, key: str, attempt: Attempt[T], timeout: Optional[float]) -> T:
+        start = time.monotonic()
+        result = attempt(timeout)
+        self.latencies(key).add(time.monotonic() - start)
+        return result
+
+    def _hedged(self, key: str, attempt: Attempt[T], timeout: Optional[float]) -> T:
+        delay = self.hedge_delay(key)
+        if delay is None or (timeout is not None and delay >= timeout):
+            return self._timed(key, attempt, timeout)
+        # the attempts run in the caller's context, so that they are scheduled with its priority and deadline.
+        # the losers of earlier hedges keep running, so hedging is skipped while they occupy every worker.
+        first = _submit_hedge(self._timed, key, attempt, timeout)
+        if first is None:
+            self._count("hedges_skipped")
+            return self._timed(key, attempt, timeout)
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+        second = _submit_hedge(
+            self._timed, key, attempt, None if timeout is None else timeout - delay
+        )
+        if second is None:
+            self._count("hedges_skipped")
+            return first.result()
+        self._count("hedges")
+        pending = {first, second}
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                if f.exception() is None:
+                    if f is second:
+                        self._count("hedge_wins")
+                    return f.result()
+                error = f.exception()
+        assert error is not None
+        raise error
+
+    async def call_async(
+        self,
+        retry: RetryPolicy,
+        key: str,
+        attempt: Callable[[Optional[float]], Awaitable[T]],
+        hedge: bool = True,
+    ) -> T:
+        """Async version of `call`, `attempt(timeout)` returns an awaitable.
+
+        The slower of two hedged attempts is cancelled.
+        """
+        with scheduling(timeout=self.timeout):
+            deadline = current_deadline()
+            if self.breaker is not None:
+                self.breaker.before_call(key)
+            try:
+                result = await retry.call_async_until(
+                    deadline, self._aattempt, key, attempt, deadline, hedge
+                )
+            except Exception as e:
+                self._record(key, e)
+                raise
+            except BaseException:
+                self._release(key)
+                raise
+            self._record(key)
+            return result
+
+    async def _aattempt(
+        self,
+        key: str,
+        attempt: Callable[[Optional[float]], Awaitable[T]],
+        deadline: Optional[float],
+        hedge: bool,
+    ) -> T:
+        timeout = self._attempt_timeout(deadline)
+        if hedge:
+            return await self._ahedged(key, attempt, timeout)
+        return await self._atimed(key, attempt, timeout)
+
+    async def _atimed(
+        self,
+        key: str,
+        attempt: Callable[[Optional[float]], Awaitable[T]],
+        timeout: Optional[float],
+    ) -> T:
+        start = time.monotonic()
+        result = await attempt(timeout)
+        self.latencies(key).add(time.monotonic() - start)
+        return result
+
+    async def _ahedged(
+        self,
+        key: str,
+        attempt: Callable[[Optional[float]], Awaitable[T]],
+        timeout: Optional[float],
+    ) -> T:
+        delay = self.hedge_delay(key)
+        if delay is None or (timeout is not None and delay >= timeout):
+            return await self._atimed(key, attempt, timeout)
+        first = asyncio.ensure_future(self._atimed(key, attempt, timeout))
+        pending = {first}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return first.result()
+            self._count("hedges")
+            second = asyncio.ensure_future(
+                self._atimed(key, attempt, None if timeout is None else timeout - delay)
+            )
+            pending = {first, second}
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self._count("hedge_wins")
+                        return task.result()
+                    error = task.exception()
+            assert error is not None
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
@@ -0,0 +1,259 @@
+import asyncio
+import contextvars
+import email.utils
+import functools
+import logging
+import random
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+import requests
+
+logger = logging.getLogger("capabilities")
+
+T = TypeVar("T")
+
+RETRYABLE_STATUSES = frozenset([408, 429, 500, 502, 503, 504])
+
+_last_attempts: contextvars.ContextVar[int] = contextvars.ContextVar(
+    "capabilities_last_attempts", default=0
+)
+
+
+def last_attempts() -> int:
+    """Number of attempts made by the most recent retried call in the current thread or task."""
+    return _last_attempts.get()
+
+
+class RetryError(Exception):
+    """Raised when a call still fails after the maximum number of retries.
+
+    The last underlying exception is available as `__cause__`.
+    """
+
+    def __init__(self, message: str, attempts: int):
+        super().__init__(message)
+        self.attempts = attempts
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a call's deadline passes before it succeeds.
+
+    The last underlying exception, if any, is available as `__cause__`.
+    """
+
+    def __init__(self, message: str, attempts: int = 0):
+        super().__init__(message)
+        self.attempts = attempts
+
+
+@dataclass
+class RetryStats:
+    """Counters accumulated by a `RetryPolicy` over all the calls it has made."""
+
+    calls: int = 0
+    """ Number of calls made through the policy. """
+    attempts: int = 0
+    """ Number of attempts, including the first attempt of each call. """
+    retries: int = 0
+    """ Number of attempts that were retries. """
+    failures: int = 0
+    """ Number of calls that gave up. """
+
+
+def _aiohttp():
+    """The aiohttp module if it was imported. It is imported by the async calls only,
+    so an exception can't be an aiohttp one otherwise."""
+    return sys.modules.get("aiohttp")
+
+
+def status_of(e: BaseException) -> Optional[int]:
+    """Returns the HTTP status code carried by the given exception, if any."""
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        return e.response.status_code
+    aiohttp = _aiohttp()
+    if aiohttp is not None and isinstance(e, aiohttp.ClientResponseError):
+        return e.status
+    return None
+
+
+def retry_after_of(e: BaseException) -> Optional[float]:
+    """Returns the number of seconds requested by a `Retry-After` header on the given exception, if any."""
+    aiohttp = _aiohttp()
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        value = e.response.headers.get("Retry-After")
+    elif (
+        aiohttp is not None
+        and isinstance(e, aiohttp.ClientResponseError)
+        and e.headers is not None
+    ):
+        value = e.headers.get("Retry-After")
+    else:
+        return None
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+
+def is_retryable(e: BaseException) -> bool:
+    """Connection errors, timeouts, 429s and 5xx responses are retryable, other errors are not."""
+    status = status_of(e)
+    if status is not None:
+        return status in RETRYABLE_STATUSES
+    if isinstance(e, (requests.ConnectionError, requests.Timeout, asyncio.TimeoutError)):
+        return True
+    aiohttp = _aiohttp()
+    return aiohttp is not None and isinstance(
+        e, (aiohttp.ClientConnectionError, aiohttp.ServerTimeoutError)
+    )
+
+
+@dataclass
+class RetryPolicy:
+    """Exponential backoff with full jitter.
+
+    The n-th retry sleeps for a uniformly random duration in `[0, min(max_delay, initial_delay * exponential_base ** n)]`,
+    unless the server asked for a longer wait with a `Retry-After` header.
+    Async calls sleep with `asyncio.sleep` so that the event loop keeps running other calls.
+
+    Args:
+        max_retries: number of retries before giving up with a `RetryError`.
+        initial_delay: upper bound of the first sleep, in seconds.
+        exponential_base: growth factor of the upper bound between retries.
+        max_delay: cap on the upper bound of any sleep, in seconds.
+        jitter: if False, sleep for the full upper bound instead of a random fraction of it.
+        errors: if given, retry exactly these exception types instead of using `is_retryable`.
+    """
+
+    max_retries: int = 8
+    initial_delay: float = 1.0
+    exponential_base: float = 2.0
+    max_delay: float = 60.0
+    jitter: bool = True
+    errors: Optional[tuple] = None
+    stats: RetryStats = field(default_factory=RetryStats, compare=False)
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False, compare=False
+    )
+
+    def should_retry(self, e: BaseException) -> bool:
+        if self.errors is not None:
+            return isinstance(e, self.errors)
+        return is_retryable(e)
+
+    def delay(self, retry: int, e: Optional[BaseException] = None) -> float:
+        """Returns the time to sleep before the given retry (counting from 0)."""
+        bound = min(self.max_delay, self.initial_delay * self.exponential_base**retry)
+        d = random.uniform(0, bound) if self.jitter else bound
+        retry_after = retry_after_of(e) if e is not None else None
+        if retry_after is not None:
+            d = max(d, min(retry_after, self.max_delay))
+        return d
+
+    def _record(self, attempts: int, failed: bool):
+        _last_attempts.set(attempts)
+        with self._lock:
+            self.stats.calls += 1
+            self.stats.attempts += attempts
+            self.stats.retries += attempts - 1
+            self.stats.failures += int(failed)
+
+    def _give_up(self, e: BaseException, attempts: int) -> RetryError:
+        self._record(attempts, failed=True)
+        err = RetryError(
+            f"Maximum number of retries ({self.max_retries}) exceeded.", attempts
+        )
+        err.__cause__ = e
+        return err
+
+    def _check_deadline(
+        self, deadline: Optional[float], d: float, e: BaseException, attempts: int
+    ):
+        if deadline is not None and time.monotonic() + d >= deadline:
+            self._record(attempts, failed=True)
+            raise DeadlineExceeded(
+                f"deadline exceeded after {attempts} attempts", attempts
+            ) from e
+
+    def call(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """Calls `fn(*args, **kwargs)`, retrying on retryable errors."""
+        return self.call_until(None, fn, *args, **kwargs)
+
+    def call_until(
+        self, deadline: Optional[float], fn: Callable[..., T], *args, **kwargs
+    ) -> T:
+        """Like `call`, but gives up with `DeadlineExceeded` rather than sleeping past
+        the `deadline` (a `time.monotonic()` timestamp, None for no deadline)."""
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                if not self.should_retry(e):
+                    self._record(attempt, failed=True)
+                    raise
+                if attempt > self.max_retries:
+                    raise self._give_up(e, attempt)
+                d = self.delay(attempt - 1, e)
+                self._check_deadline(deadline, d, e, attempt)
+                logger.info(f"[retry] attempt {attempt} failed with {e!r}, retrying in {d:.2f}s")
+                time.sleep(d)
+            else:
+                self._record(attempt, failed=False)
+                return result
+
+    async def call_async(self, fn: Callable[..., Awaitable[T]], *args, **kwargs) -> T:
+        """Awaits `fn(*args, **kwargs)`, retrying on retryable errors without blocking the event loop."""
+        return await self.call_async_until(None, fn, *args, **kwargs)
+
+    async def call_async_until(
+        self, deadline: Optional[float], fn: Callable[..., Awaitable[T]], *args, **kwargs
+    ) -> T:
+        """Async version of `call_until`."""
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                if not self.should_retry(e):
+                    self._record(attempt, failed=True)
+                    raise
+                if attempt > self.max_retries:
+                    raise self._give_up(e, attempt)
+                d = self.delay(attempt - 1, e)
+                self._check_deadline(deadline, d, e, attempt)
+                logger.info(f"[retry] attempt {attempt} failed with {e!r}, retrying in {d:.2f}s")
+                await asyncio.sleep(d)
+            else:
+                self._record(attempt, failed=False)
+                return result
+
+    def wrap(self, fn: Callable[..., Any]) -> Callable[..., Any]:
+        """Decorator version of `call` / `call_async`, picked according to whether `fn` is a coroutine function."""
+        if asyncio.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                return await self.call_async(fn, *args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            return self.call(fn, *args, **kwargs)
+
+        return wrapper
@@ -0,0 +1,313 @@
+import asyncio
+import collections
+import contextlib
+import contextvars
+import enum
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Deque, Dict, Iterator, Optional, TypeVar
+
+from capabilities.retry import DeadlineExceeded
+
+logger = logging.getLogger("capabilities")
+
+T = TypeVar("T")
+
+
+class Priority(enum.IntEnum):
+    """Priority class of a call, lower values are scheduled first."""
+
+    HIGH = 0
+    """ Interactive calls, the default for single calls. """
+    NORMAL = 1
+    LOW = 2
+    """ Bulk work, the default for the batch APIs. """
+
+
+_priority: contextvars.ContextVar[Priority] = contextvars.ContextVar(
+    "capabilities_priority", default=Priority.HIGH
+)
+_tenant: contextvars.ContextVar[str] = contextvars.ContextVar(
+    "capabilities_tenant", default="default"
+)
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar(
+    "capabilities_deadline", default=None
+)
+
+
+def current_priority() -> Priority:
+    return _priority.get()
+
+
+def current_tenant() -> str:
+    return _tenant.get()
+
+
+def current_deadline() -> Optional[float]:
+    """The `time.monotonic()` timestamp by which the current call must finish, if any."""
+    return _deadline.get()
+
+
+@contextlib.contextmanager
+def scheduling(
+    priority: Optional[Priority] = None,
+    tenant: Optional[str] = None,
+    timeout: Optional[float] = None,
+) -> Iterator[None]:
+    """Sets the priority, tenant and deadline of the capability calls made inside the block.
+
+    The settings are carried by context variables, so they apply to the calls of the current thread
+    or task and of the tasks it creates. A `timeout` can only tighten an enclosing deadline.
+    """
+    tokens = []
+    if priority is not None:
+        tokens.append((_priority, _priority.set(Priority(priority))))
+    if tenant is not None:
+        tokens.append((_tenant, _tenant.set(tenant)))
+    if timeout is not None:
+        deadline = time.monotonic() + timeout
+        current = _deadline.get()
+        if current is not None:
+            deadline = min(deadline, current)
+        tokens.append((_deadline, _deadline.set(deadline)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+@dataclass
+class SchedulerStats:
+    submitted: int = 0
+    started: int = 0
+    dropped: int = 0
+    """ Calls dropped before they were sent because they could no longer finish before their deadline. """
+    started_by_priority: Dict[Priority, int] = field(
+        default_factory=lambda: {p: 0 for p in Priority}
+    )
+
+
+class _Waiter:
+    __slots__ = ("priority", "tenant", "deadline", "wake", "granted", "dropped")
+
+    def __init__(self, priority: Priority, tenant: str, deadline: Optional[float], wake: Callable[[], None]):
+        self.priority = priority
+        self.tenant = tenant
+        self.deadline = deadline
+        self.wake = wake
+        self.granted = False
+        self.dropped = False
+
+
+class Scheduler:
+    """Admission control for capability calls, by priority class, deadline and tenant.
+
+    At most `max_in_flight` calls run at once. When a slot frees up it goes to a waiting call of the
+    highest priority class present, and within a class to the tenant that has been granted the fewest slots,
+    so a tenant with a large backlog can't starve the others. Calls are FIFO within a tenant.
+
+    A call whose deadline (see `scheduling` and `CallPolicy.timeout`) would pass before it could finish,
+    judging by a moving average of the call latencies, is dropped with `DeadlineExceeded` without being sent.
+
+    Pass it as the `scheduler` of a `CapabilitiesClient`. Single calls default to `Priority.HIGH`
+    and the batch APIs to `Priority.LOW`.
+
+    Args:
+        max_in_flight: number of calls allowed to run at once.
+        smoothing: weight of each new sample in the latency's moving average.
+    """
+
+    def __init__(self, max_in_flight: int = 32, smoothing: float = 0.1):
+        if max_in_flight < 1:
+            raise ValueError(f"max_in_flight must be positive, got {max_in_flight}")
+        self.max_in_flight = max_in_flight
+        self.smoothing = smoothing
+        self.expected_latency = 0.0
+        self._samples = 0
+        self.stats = SchedulerStats()
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._queues: Dict[Priority, Dict[str, Deque[_Waiter]]] = {
+            p: collections.OrderedDict() for p in Priority
+        }
+        self._granted: Dict[str, int] = collections.defaultdict(int)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def queued(self, priority: Optional[Priority] = None) -> int:
+        """Number of calls waiting, of the given priority or in total."""
+        with self._lock:
+            priorities = list(Priority) if priority is None else [priority]
+            return sum(len(q) for p in priorities for q in self._queues[p].values())
+
+    def _late(self, w: _Waiter) -> bool:
+        return w.deadline is not None and time.monotonic() + self.expected_latency > w.deadline
+
+    def _start(self, w: _Waiter):
+        self._in_flight += 1
+        self._granted[w.tenant] += 1
+        self.stats.started += 1
+        self.stats.started_by_priority[w.priority] += 1
+        w.granted = True
+
+    def _drop(self, w: _Waiter):
+        self.stats.dropped += 1
+        w.dropped = True
+
+    def _pop(self) -> Optional[_Waiter]:
+        for p in Priority:
+            tenants = self._queues[p]
+            if not tenants:
+                continue
+            tenant = min(tenants, key=lambda t: self._granted[t])
+            queue = tenants[tenant]
+            w = queue.popleft()
+            if not queue:
+                del tenants[tenant]
+            return w
+        return None
+
+    def _grant_next(self):
+        """Hands free slots to waiters, dropping the ones that are too late. Called with the lock held."""
+        while self._in_flight < self.max_in_flight:
+            w = self._pop()
+            if w is None:
+                return
+            if self._late(w):
+                self._drop(w)
+            else:
+                self._start(w)
+            w.wake()
+
+    def _submit(self, w: _Waiter) -> bool:
+        """Starts or drops the call right away if possible, otherwise queues it. Returns whether it was queued."""
+        with self._lock:
+            self.stats.submitted += 1
+            if self._late(w):
+                self._drop(w)
+                return False
+            if self._in_flight < self.max_in_flight and not any(self._queues.values()):
+                self._start(w)
+                return False
+            tenants = self._queues[w.priority]
+            if w.tenant not in tenants:
+                tenants[w.tenant] = collections.deque()
+                # a tenant that was idle doesn't get to catch up on the slots it didn't use.
+                active = [self._granted[t] for q in self._queues.values() for t in q]
+                if active:
+                    self._granted[w.tenant] = max(self._granted[w.tenant], min(active))
+            tenants[w.tenant].append(w)
+            return True
+
+    def _dequeue(self, w: _Waiter):
+        queue = self._queues[w.priority].get(w.tenant)
+        if queue is not None and w in queue:
+            queue.remove(w)
+            if not queue:
+                del self._queues[w.priority][w.tenant]
+
+    def _withdraw(self, w: _Waiter):
+        """Removes a waiter that was cancelled, or frees its slot if it was granted one meanwhile."""
+        with self._lock:
+            if w.granted:
+                self._in_flight -= 1
+                self._grant_next()
+                return
+            self._dequeue(w)
+
+    def _time_out(self, w: _Waiter):
+        """Drops a waiter whose wait timed out, unless it was granted a slot (or dropped) meanwhile.
+
+        Decided under the lock in one step: a slot granted between the timeout and now is kept by the call.
+        """
+        with self._lock:
+            if w.granted or w.dropped:
+                return
+            self._dequeue(w)
+            self._drop(w)
+
+    def _raise_dropped(self, w: _Waiter):
+        message = f"dropped a {w.priority.name} priority call of tenant {w.tenant!r} that could not finish before its deadline"
+        logger.debug(f"[scheduler] {message}")
+        raise DeadlineExceeded(message)
+
+    def _wait_time(self, w: _Waiter) -> Optional[float]:
+        if w.deadline is None:
+            return None
+        return max(0.0, w.deadline - self.expected_latency - time.monotonic())
+
+    def _waiter(self, wake: Callable[[], None]) -> _Waiter:
+        return _Waiter(current_priority(), current_tenant(), current_deadline(), wake)
+
+    def acquire(self):
+        """Blocks until the current call may start. Must be followed by `release`."""
+        event = threading.Event()
+        w = self._waiter(event.set)
+        if self._submit(w):
+            if not event.wait(self._wait_time(w)):
+                self._time_out(w)
+        if w.dropped:
+            self._raise_dropped(w)
+
+    async def acquire_async(self):
+        """Async version of `acquire`."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        w = self._waiter(lambda: loop.call_soon_threadsafe(_wake, future))
+        if self._submit(w):
+            try:
+                done, _ = await asyncio.wait({future}, timeout=self._wait_time(w))
+            except asyncio.CancelledError:
+                self._withdraw(w)
+                raise
+            if not done:
+                self._time_out(w)
+        if w.dropped:
+            self._raise_dropped(w)
+
+    def release(self, latency: Optional[float] = None):
+        """Frees the slot of a call that finished after taking `latency` seconds."""
+        with self._lock:
+            self._in_flight -= 1
+            if latency is not None:
+                self._samples += 1
+                self.expected_latency = (
+                    latency
+                    if self._samples == 1
+                    else (1 - self.smoothing) * self.expected_latency + self.smoothing * latency
+                )
+            self._grant_next()
+
+    def call(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """Calls `fn(*args, **kwargs)` once the scheduler admits it."""
+        self.acquire()
+        start = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException:
+            self.release()
+            raise
+        self.release(time.monotonic() - start)
+        return result
+
+    async def call_async(self, fn: Callable[..., Awaitable[T]], *args, **kwargs) -> T:
+        """Async version of `call`."""
+        await self.acquire_async()
+        start = time.monotonic()
+        try:
+            result = await fn(*args, **kwargs)
+        except BaseException:
+            self.release()
+            raise
+        self.release(time.monotonic() - start)
+        return result
+
+
+def _wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
@@ -1,6 +1,10 @@
 
 from .simple_vector_index import *
 from .types import *
+from .quantized_vector_index import QuantizedVectorIndex
+from .binary_vector_index import BinaryVectorIndex
+from .memmap_vector_index import MemmapVectorIndex
+from .ivf_vector_index import IVFVectorIndex
 
-from .search_index import SearchIndex, SimpleVectorIndex, simple_chunker, SearchResult, AbstractSearchIndex
+from .search_index import SearchIndex, SimpleVectorIndex, simple_chunker, split_passages, SearchResult, AbstractSearchIndex
 from .loader import create_document
@@ -0,0 +1,193 @@
+import os
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+
+from .simple_vector_index import SimpleVectorIndex, topk
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _popcount_bytes(words: np.ndarray) -> np.ndarray:
+    """Number of bits set in each of the uint64 words, from a lookup table of the bytes."""
+    words = np.ascontiguousarray(words)
+    return _POPCOUNT[words.view(np.uint8)].reshape(*words.shape, 8).sum(axis=-1, dtype=np.uint8)
+
+
+# numpy >= 2.0 has a vectorized popcount.
+_popcount = getattr(np, "bitwise_count", _popcount_bytes)
+
+
+class DiskRows:
+    """Append-only float32 rows in a raw file, read back through a memory map.
+
+    Used to keep the full precision rows of a `BinaryVectorIndex` out of memory: only the
+    rows that are rescored are read, and the OS page cache decides what stays in memory.
+    """
+
+    def __init__(self, path: Union[str, Path], dim: int):
+        self.path = Path(path)
+        self.dim = dim
+        self._size = os.path.getsize(self.path) // (4 * dim) if self.path.exists() else 0
+        self._map: Optional[np.memmap] = None
+
+    def __len__(self):
+        return self._size
+
+    def add(self, rows: np.ndarray):
+        with open(self.path, "ab") as f:
+            f.write(np.ascontiguousarray(rows, dtype=np.float32).tobytes())
+        self._size += len(rows)
+
+    @property
+    def rows(self) -> np.ndarray:
+        if self._map is None or len(self._map) != self._size:
+            self._map = np.memmap(self.path, dtype=np.float32, mode="r", shape=(self._size, self.dim))
+        return self._map
+
+    def __getstate__(self):
+        return {"path": self.path, "dim": self.dim}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["dim"])
+
+
+class BinaryVectorIndex(SimpleVectorIndex):
+    """Two-stage vector index with cosine similarity for large corpora.
+
+    The first stage stores one bit per dimension, the sign of the row minus the `mean` of the rows
+    (fitted to the first batch added, or to the sample given to `train`), packed into 64-bit words:
+    32 times less memory than float32 rows. Candidates are the `oversample * limit` rows closest to the query
+    in Hamming distance, computed by xor and popcount. The second stage rescores the candidates with their
+    full precision rows, which are kept in memory, or in the file at `path` if given.
+    Raising `oversample` trades scan throughput for recall.
+
+    Args:
+        oversample: number of candidates rescored per result.
+        path: file of the full precision rows, None to keep them in memory.
+        block_size: number of rows compared to the queries at once.
+    """
+
+    def __init__(
+        self,
+        oversample: int = 10,
+        path: Optional[Union[str, Path]] = None,
+        block_size: int = 8192,
+    ):
+        if oversample < 1:
+            raise ValueError(f"oversample must be at least 1, got {oversample}")
+        super().__init__()
+        self.oversample = oversample
+        self.path = path
+        self.block_size = block_size
+        self.mean: Optional[np.ndarray] = None
+        self._dim: Optional[int] = None
+        self._full: Union[SimpleVectorIndex, DiskRows, None] = None
+
+    @property
+    def dim(self):
+        return self._dim
+
+    @property
+    def nbytes(self) -> int:
+        """Memory taken by the first stage, and by the full precision rows unless they are on disk."""
+        full = self._full._buffer.nbytes if isinstance(self._full, SimpleVectorIndex) else 0
+        return self._buffer.nbytes + full
+
+    @staticmethod
+    def _normalize(arr: np.ndarray) -> np.ndarray:
+        norm = np.linalg.norm(arr, axis=1)
+        if np.any(norm == 0):
+            raise ValueError("vector with norm 0 detected")
+        return (arr / norm[:, np.newaxis]).astype(np.float32, copy=False)
+
+    def train(self, sample: np.ndarray):
+        """Sets the `mean` that is subtracted from the (normalized) rows before taking their signs."""
+        self.mean = self._normalize(sample).mean(axis=0)
+
+    def _encode(self, rows: np.ndarray) -> np.ndarray:
+        bits = np.packbits(rows > self.mean, axis=1)
+        words = -(-bits.shape[1] // 8)
+        padded = np.zeros((len(bits), 8 * words), dtype=np.uint8)
+        padded[:, : bits.shape[1]] = bits
+        return padded.view(np.uint64)
+
+    def add(self, arr):
+        assert len(arr.shape) == 2
+        rows = self._normalize(arr)
+        if len(self) == 0:
+            self._dim = rows.shape[1]
+            self._buffer = np.empty((0, -(-self._dim // 64)), dtype=np.uint64)
+            if self.mean is None:
+                self.train(rows)
+            if self.path is None:
+                self._full = SimpleVectorIndex()
+            else:
+                self._full = DiskRows(self.path, self._dim)
+                if len(self._full) > 0:
+                    raise ValueError(f"{self.path} already has rows")
+        else:
+            assert rows.shape[1] == self.dim, "Dimensions do not match"
+        codes = self._encode(rows)
+        n = len(self)
+        self._reserve(n + len(rows), codes.shape[1], np.uint64)
+        self._buffer[n : n + len(rows)] = codes
+        self._size = n + len(rows)
+        self._full.add(rows)  # type: ignore
+
+    def _candidates(self, queries: np.ndarray, k: int) -> np.ndarray:
+        """Ids of the k rows closest to each of the normalized queries in Hamming distance."""
+        codes = self._encode(queries)
+        dists, ids = [], []
+        for start in range(0, len(self), self.block_size):
+            # word by word over a transposed block: summing over the few words of each row is much slower.
+            words = np.ascontiguousarray(self.rows[start : start + self.block_size].T)
+            hamming = np.zeros((len(queries), words.shape[1]), dtype=np.int16)
+            for w in range(len(words)):
+                hamming += _popcount(words[w][np.newaxis, :] ^ codes[:, w][:, np.newaxis])
+            d, i = topk(-hamming, min(k, words.shape[1]), axis=1)
+            dists.append(d)
+            ids.append(i + start)
+        if len(dists) == 1:
+            return ids[0]
+        _, i = topk(np.concatenate(dists, axis=1), k, axis=1)
+        return np.take_along_axis(np.concatenate(ids, axis=1), i, axis=1)
+
+    def search(self, queries: np.ndarray, limit: int):
+        batch_size, d = queries.shape
+        if len(self) == 0:
+            return (
+                np.empty((batch_size, 0), dtype=np.float32),
+                np.empty((batch_size, 0), dtype=np.int32),
+            )
+        assert d == self.dim, "Dimensions do not match"
+        queries = self._normalize(queries)
+        limit = min(limit, len(self))
+        candidates = self._candidates(queries, min(limit * self.oversample, len(self)))
+        # rows are read in ascending order, which keeps the reads of disk rows sequential.
+        unique, inverse = np.unique(candidates, return_inverse=True)
+        full = np.asarray(self._full.rows[unique])  # type: ignore
+        exact = np.einsum("bd,bkd->bk", queries, full[inverse.reshape(candidates.shape)])
+        s, i = topk(exact, limit, axis=1)
+        return s, np.take_along_axis(candidates, i, axis=1)
+
+    def __getstate__(self):
+        return {
+            "rows": self.rows,
+            "oversample": self.oversample,
+            "path": self.path,
+            "block_size": self.block_size,
+            "mean": self.mean,
+            "dim": self._dim,
+            "full": self._full,
+        }
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.oversample = state["oversample"]
+        self.path = state["path"]
+        self.block_size = state["block_size"]
+        self.mean = state["mean"]
+        self._dim = state["dim"]
+        self._full = state["full"]
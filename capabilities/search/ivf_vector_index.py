@@ -0,0 +1,347 @@
+import logging
+import math
+import threading
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from .simple_vector_index import SimpleVectorIndex, topk
+from .types import VectorIndex
+
+logger = logging.getLogger("capabilities.search")
+
+ASSIGN_BLOCK = 65536
+""" Number of rows assigned to their clusters at once when the clusters are fitted. """
+
+
+def kmeans(
+    rows: np.ndarray,
+    k: int,
+    rng: np.random.Generator,
+    iterations: int = 50,
+    batch_size: int = 4096,
+) -> np.ndarray:
+    """Mini-batch spherical k-means of normalized rows, returning `k` normalized centroids.
+
+    Each iteration assigns a random batch of rows to their most similar centroids and moves every centroid
+    towards the mean of its rows, with a step that decreases with the number of rows it was assigned so far.
+    """
+    centroids = rows[rng.choice(len(rows), size=k, replace=False)].astype(np.float32)
+    counts = np.zeros(k)
+    for _ in range(iterations):
+        batch = rows[rng.integers(len(rows), size=min(batch_size, len(rows)))]
+        assign = np.argmax(batch @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, batch)
+        batch_counts = np.bincount(assign, minlength=k)
+        counts += batch_counts
+        hit = batch_counts > 0
+        eta = (batch_counts[hit] / counts[hit])[:, np.newaxis]
+        centroids[hit] = (1 - eta) * centroids[hit] + eta * sums[hit] / batch_counts[hit][:, np.newaxis]
+        centroids /= np.maximum(np.linalg.norm(centroids, axis=1), 1e-12)[:, np.newaxis]
+    return centroids
+
+
+class InvertedList:
+    """Contiguous rows of one cluster of an `IVFVectorIndex`, and their ids in the index."""
+
+    def __init__(self, rows: np.ndarray, ids: np.ndarray):
+        self._rows = rows
+        self._ids = ids
+        self._size = len(ids)
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def rows(self) -> np.ndarray:
+        return self._rows[: self._size]
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self._ids[: self._size]
+
+    def append(self, rows: np.ndarray, ids: np.ndarray):
+        """Appends to the list, doubling its capacity when it is full."""
+        n = self._size + len(ids)
+        if n > len(self._ids):
+            capacity = max(n, 2 * len(self._ids))
+            rows_buffer = np.empty((capacity, self._rows.shape[1]), self._rows.dtype)
+            rows_buffer[: self._size] = self.rows
+            ids_buffer = np.empty(capacity, self._ids.dtype)
+            ids_buffer[: self._size] = self.ids
+            self._rows, self._ids = rows_buffer, ids_buffer
+        self._rows[self._size : n] = rows
+        self._ids[self._size : n] = ids
+        self._size = n
+
+
+def _group(
+    rows: np.ndarray, ids: np.ndarray, assign: np.ndarray, k: int
+) -> List[Tuple[int, np.ndarray, np.ndarray]]:
+    """Splits the rows and their ids by cluster, returning the non-empty `(cluster, rows, ids)` groups."""
+    order = np.argsort(assign, kind="stable")
+    bounds = np.cumsum(np.bincount(assign, minlength=k))
+    groups = []
+    for cluster, (start, end) in enumerate(zip(np.concatenate([[0], bounds[:-1]]), bounds)):
+        if end > start:
+            groups.append((cluster, rows[order[start:end]], ids[order[start:end]]))
+    return groups
+
+
+class IVFVectorIndex(VectorIndex):
+    """Approximate in-mem vector index with cosine similarity, using an inverted file of k-means clusters.
+
+    The rows are clustered around `n_lists` centroids (by default the square root of the number of rows)
+    fitted with mini-batch k-means, and each cluster's rows are stored contiguously. A search compares the
+    queries to the centroids and scans only the rows of the `nprobe` most similar clusters, probing more
+    clusters if they hold fewer than `limit` rows. Raising `nprobe` trades latency for recall.
+
+    Until the index holds `min_train_rows` rows, they are searched exhaustively.
+    New rows are added to the clusters of their nearest centroids. Once the index has grown by `retrain_factor`
+    since the last training, the clusters are fitted again on a background thread, if `background` is True,
+    and the rows are redistributed among new lists; searches and adds use the previous clusters in the meantime.
+
+    Args:
+        nprobe: number of clusters scanned per query.
+        n_lists: number of clusters, None to use the square root of the number of rows when training.
+        min_train_rows: number of rows at which the clusters are first fitted.
+        retrain_factor: growth of the index after which the clusters are fitted again, None to never refit.
+        train_size: maximum number of rows sampled to fit the clusters.
+        background: whether refits run on a background thread.
+        seed: seed of the sampling of the rows used to fit the clusters.
+    """
+
+    def __init__(
+        self,
+        nprobe: int = 8,
+        n_lists: Optional[int] = None,
+        min_train_rows: int = 4096,
+        retrain_factor: Optional[float] = 4.0,
+        train_size: int = 262144,
+        background: bool = True,
+        seed: Optional[int] = None,
+    ):
+        self.nprobe = nprobe
+        self.n_lists = n_lists
+        self.min_train_rows = min_train_rows
+        self.retrain_factor = retrain_factor
+        self.train_size = train_size
+        self.background = background
+        self.centroids: Optional[np.ndarray] = None
+        self.lists: List[InvertedList] = []
+        self._rng = np.random.default_rng(seed)
+        self._flat = SimpleVectorIndex()
+        """ Rows added before the clusters are first fitted. """
+        self._size = 0
+        self._trained_size = 0
+        self._lock = threading.RLock()
+        self._train_lock = threading.Lock()
+        """ Held by a fit, from the snapshot of the rows to the swap of the lists. """
+        self._training: Optional[threading.Thread] = None
+        self._fitting = False
+        """ Whether a fit started by `add` is running, so that concurrent adds don't start another. """
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def dim(self):
+        if self.centroids is not None:
+            return self.centroids.shape[1]
+        return self._flat.dim
+
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+
+    def _parts(self) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Views of the rows of the index and of their ids, list by list. Called with the lock held.
+
+        Rows are only appended to the lists (and to the flat rows), so the views stay valid as rows are added.
+        """
+        if not self.trained:
+            return [(self._flat.rows, np.arange(len(self._flat)))]
+        return [(lst.rows, lst.ids) for lst in self.lists]
+
+    def _fit(self, parts: List[Tuple[np.ndarray, np.ndarray]]) -> np.ndarray:
+        size = sum(len(ids) for _, ids in parts)
+        k = self.n_lists or max(1, round(math.sqrt(size)))
+        if size > self.train_size:
+            picks = np.sort(self._rng.choice(size, size=self.train_size, replace=False))
+            # the sampled positions in the concatenation of the parts, gathered part by part.
+            bounds = np.cumsum([0] + [len(ids) for _, ids in parts])
+            cuts = np.searchsorted(picks, bounds)
+            sample = np.concatenate(
+                [rows[picks[cuts[j] : cuts[j + 1]] - bounds[j]] for j, (rows, _) in enumerate(parts)]
+            )
+        else:
+            sample = np.concatenate([rows for rows, _ in parts])
+        return kmeans(sample, min(k, len(sample)), self._rng)
+
+    def _distribute(
+        self, parts: List[Tuple[np.ndarray, np.ndarray]], centroids: np.ndarray, lists: List[InvertedList]
+    ):
+        """Appends the rows of `parts` to the `lists` of their nearest `centroids`, a block at a time."""
+        for rows, ids in parts:
+            for start in range(0, len(ids), ASSIGN_BLOCK):
+                r, i = rows[start : start + ASSIGN_BLOCK], ids[start : start + ASSIGN_BLOCK]
+                for cluster, gr, gi in _group(r, i, self._assign(r, centroids), len(centroids)):
+                    lists[cluster].append(gr, gi)
+
+    def train(self):
+        """Fits the clusters to the rows of the index and redistributes the rows among them.
+
+        The rows are fitted and redistributed into new lists without the lock, so that searches and adds
+        carry on with the previous clusters; the lock is only taken to move the rows added meanwhile and to
+        swap the lists.
+        """
+        with self._train_lock:
+            with self._lock:
+                parts = self._parts()
+            centroids = self._fit(parts)
+            dim = centroids.shape[1]
+            lists = [InvertedList(np.empty((0, dim), np.float32), np.empty(0, np.int64)) for _ in centroids]
+            self._distribute(parts, centroids, lists)
+            size = sum(len(ids) for _, ids in parts)
+            with self._lock:
+                # rows added since the snapshot were appended after the snapshotted rows of each part.
+                added = [(rows[len(i) :], ids[len(i) :]) for (rows, ids), (_, i) in zip(self._parts(), parts)]
+                self._distribute(added, centroids, lists)
+                self.centroids, self.lists = centroids, lists
+                self._trained_size = size
+                self._flat = SimpleVectorIndex()
+            logger.debug(f"Fitted {len(centroids)} clusters to {size} rows.")
+
+    def _retrain(self):
+        try:
+            self.train()
+        except Exception:
+            logger.exception("Refitting the clusters of the vector index failed.")
+        finally:
+            with self._lock:
+                self._training = None
+                self._fitting = False
+
+    def wait(self):
+        """Waits for a background refit of the clusters to complete."""
+        training = self._training
+        if training is not None:
+            training.join()
+
+    @staticmethod
+    def _assign(rows: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        return np.argmax(rows @ centroids.T, axis=1)
+
+    def add(self, arr):
+        assert len(arr.shape) == 2
+        norm = np.linalg.norm(arr, axis=1)
+        if np.any(norm == 0):
+            raise ValueError("vector with norm 0 detected")
+        rows = (arr / norm[:, np.newaxis]).astype(np.float32)
+        with self._lock:
+            assert self.dim is None or rows.shape[1] == self.dim, "Dimensions do not match"
+            ids = np.arange(self._size, self._size + len(rows))
+            self._size += len(rows)
+            if not self.trained:
+                self._flat.add(rows)
+                fit = len(self._flat) >= self.min_train_rows
+            else:
+                self._distribute([(rows, ids)], self.centroids, self.lists)
+                fit = self.retrain_factor is not None and self._size >= self.retrain_factor * self._trained_size
+            if not fit or self._fitting:
+                return
+            self._fitting = True
+            # the first fit is synchronous, so that the index is trained once it holds `min_train_rows` rows.
+            if self.background and self.trained:
+                self._training = threading.Thread(target=self._retrain, name="ivf-retrain", daemon=True)
+                self._training.start()
+                return
+        try:
+            self.train()
+        finally:
+            with self._lock:
+                self._fitting = False
+
+    def _probes(
+        self, queries: np.ndarray, limit: int, centroids: np.ndarray, sizes: np.ndarray
+    ) -> List[np.ndarray]:
+        """The clusters to scan for each query: the `nprobe` nearest, and more until they hold `limit` rows.
+
+        `centroids` and the `sizes` of their lists are those of the search's snapshot, as a refit may
+        replace the index's clusters meanwhile.
+        """
+        order = np.argsort(-(queries @ centroids.T), axis=1)
+        probes = []
+        for o in order:
+            enough = np.searchsorted(np.cumsum(sizes[o]), limit) + 1
+            probes.append(o[: max(self.nprobe, enough)])
+        return probes
+
+    def search(self, queries: np.ndarray, limit: int):
+        batch_size, d = queries.shape
+        if len(self) == 0:
+            return (
+                np.empty((batch_size, 0), dtype=np.float32),
+                np.empty((batch_size, 0), dtype=np.int32),
+            )
+        assert d == self.dim, "Dimensions do not match"
+        with self._lock:
+            if not self.trained:
+                return self._flat.search(queries, min(limit, len(self)))
+            centroids, lists = self.centroids, self.lists
+            # the lists are only appended to, so views of their current rows are a consistent snapshot.
+            snapshot = [(lst.rows, lst.ids) for lst in lists]
+        sizes = np.array([len(row_ids) for _, row_ids in snapshot])
+        queries = (queries / np.linalg.norm(queries, axis=1)[:, np.newaxis]).astype(np.float32)
+        limit = min(limit, int(sizes.sum()))
+        probes = self._probes(queries, limit, centroids, sizes)
+        # queries probing the same cluster are scanned together.
+        by_cluster: dict = {}
+        for q, clusters in enumerate(probes):
+            for c in clusters:
+                by_cluster.setdefault(c, []).append(q)
+        sims: List[List[np.ndarray]] = [[] for _ in range(batch_size)]
+        ids: List[List[np.ndarray]] = [[] for _ in range(batch_size)]
+        for c, qs in by_cluster.items():
+            rows, row_ids = snapshot[c]
+            if len(row_ids) == 0:
+                continue
+            s = queries[qs] @ rows.T
+            for j, q in enumerate(qs):
+                sims[q].append(s[j])
+                ids[q].append(row_ids)
+        out_sims = np.empty((batch_size, limit), dtype=np.float32)
+        out_ids = np.empty((batch_size, limit), dtype=np.int64)
+        for q in range(batch_size):
+            s, i = topk(np.concatenate(sims[q]), limit)
+            out_sims[q] = s
+            out_ids[q] = np.concatenate(ids[q])[i]
+        return out_sims, out_ids
+
+    def __getstate__(self):
+        self.wait()
+        with self._lock:
+            return {
+                "params": (
+                    self.nprobe,
+                    self.n_lists,
+                    self.min_train_rows,
+                    self.retrain_factor,
+                    self.train_size,
+                    self.background,
+                ),
+                "centroids": self.centroids,
+                "lists": [(lst.rows, lst.ids) for lst in self.lists],
+                "flat": self._flat,
+                "size": self._size,
+                "trained_size": self._trained_size,
+            }
+
+    def __setstate__(self, state):
+        self.__init__(*state["params"])
+        self.centroids = state["centroids"]
+        self.lists = [InvertedList(rows, ids) for rows, ids in state["lists"]]
+        self._flat = state["flat"]
+        self._size = state["size"]
+        self._trained_size = state["trained_size"]
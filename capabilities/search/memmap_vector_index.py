@@ -0,0 +1,147 @@
+import json
+import os
+from pathlib import Path
+from typing import List, Union
+
+import numpy as np
+
+from .simple_vector_index import topk
+from .types import VectorIndex
+
+MANIFEST = "manifest.json"
+
+
+class MemmapVectorIndex(VectorIndex):
+    """On-disk vector index with cosine similarity, backed by memory-mapped segment files.
+
+    The normalized rows are stored in `directory` as segment files of `segment_size` rows each,
+    listed with their number of filled rows in a small json manifest. Rows are appended to the last (tail)
+    segment, which is allocated as a sparse file; a new tail is started when it is full.
+    Opening an index only reads the manifest and maps the segments, and searches run on the mapped pages,
+    so processes that open the same directory share a single copy of the rows in the page cache.
+    Pickling an index only pickles its directory.
+
+    There can be a single writer. Readers see the rows that were added before they opened the index,
+    or before their last `refresh`.
+
+    Args:
+        directory: location of the manifest and the segment files. Created if it doesn't exist.
+        segment_size: rows per segment file, used when the index is created.
+        dtype: storage type of the rows, used when the index is created.
+        readonly: open the segments read-only, eg in worker processes.
+    """
+
+    def __init__(
+        self,
+        directory: Union[str, Path],
+        segment_size: int = 2**20,
+        dtype: str = "float32",
+        readonly: bool = False,
+    ):
+        self.directory = Path(directory)
+        self.readonly = readonly
+        self._manifest = {"dim": None, "dtype": dtype, "segment_size": segment_size, "segments": []}
+        self._segments: List[np.memmap] = []
+        if (self.directory / MANIFEST).exists():
+            self.refresh()
+        elif readonly:
+            raise FileNotFoundError(f"no vector index in {self.directory}")
+        else:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    def refresh(self):
+        """Re-reads the manifest, to see the rows appended by the writer since the index was opened."""
+        self._manifest = json.loads((self.directory / MANIFEST).read_text())
+        # segments are mapped at their full size, so only the segments started since need to be mapped.
+        for segment in self._manifest["segments"][len(self._segments) :]:
+            self._segments.append(self._map(segment["file"]))
+
+    def _map(self, file: str) -> np.memmap:
+        mode = "r" if self.readonly else "r+"
+        shape = (self._manifest["segment_size"], self._manifest["dim"])
+        return np.memmap(self.directory / file, dtype=self._manifest["dtype"], mode=mode, shape=shape)
+
+    def _write_manifest(self):
+        # written to a temporary file and renamed, so that readers never see a partial manifest.
+        tmp = self.directory / f"{MANIFEST}.tmp"
+        tmp.write_text(json.dumps(self._manifest))
+        os.replace(tmp, self.directory / MANIFEST)
+
+    def _new_segment(self):
+        file = f"{len(self._segments):05d}.bin"
+        size = self._manifest["segment_size"] * self._manifest["dim"] * np.dtype(self._manifest["dtype"]).itemsize
+        with open(self.directory / file, "wb") as f:
+            # sparse: disk space is only used as rows are written.
+            f.truncate(size)
+        self._manifest["segments"].append({"file": file, "rows": 0})
+        self._segments.append(self._map(file))
+
+    def __len__(self):
+        return sum(s["rows"] for s in self._manifest["segments"])
+
+    @property
+    def dim(self):
+        return self._manifest["dim"]
+
+    @property
+    def segments(self) -> List[np.ndarray]:
+        """The filled rows of each segment, as views of the mapped files."""
+        return [m[: s["rows"]] for m, s in zip(self._segments, self._manifest["segments"])]
+
+    def add(self, arr):
+        if self.readonly:
+            raise PermissionError(f"vector index in {self.directory} is opened read-only")
+        assert len(arr.shape) == 2
+        norm = np.linalg.norm(arr, axis=1)
+        if np.any(norm == 0):
+            raise ValueError("vector with norm 0 detected")
+        if self.dim is None:
+            self._manifest["dim"] = arr.shape[1]
+        assert arr.shape[1] == self.dim, "Dimensions do not match"
+        segment_size = self._manifest["segment_size"]
+        written = 0
+        while written < len(arr):
+            if not self._segments or self._manifest["segments"][-1]["rows"] == segment_size:
+                self._new_segment()
+            tail = self._manifest["segments"][-1]
+            n = min(segment_size - tail["rows"], len(arr) - written)
+            rows = slice(tail["rows"], tail["rows"] + n)
+            np.divide(
+                arr[written : written + n],
+                norm[written : written + n, np.newaxis],
+                out=self._segments[-1][rows],
+                casting="unsafe",
+            )
+            self._segments[-1].flush()
+            tail["rows"] += n
+            written += n
+        self._write_manifest()
+
+    def search(self, queries: np.ndarray, limit: int):
+        batch_size, d = queries.shape
+        if len(self) == 0:
+            return (
+                np.empty((batch_size, 0), dtype=np.float32),
+                np.empty((batch_size, 0), dtype=np.int32),
+            )
+        assert d == self.dim, "Dimensions do not match"
+        queries = (queries / np.linalg.norm(queries, axis=1)[:, np.newaxis]).astype(np.float32)
+        limit = min(limit, len(self))
+        sims, ids = [], []
+        start = 0
+        for rows in self.segments:
+            if len(rows) > 0:
+                s, i = topk(queries @ rows.T, min(limit, len(rows)), axis=1)
+                sims.append(s)
+                ids.append(i + start)
+            start += len(rows)
+        if len(sims) == 1:
+            return sims[0], ids[0]
+        s, i = topk(np.concatenate(sims, axis=1), limit, axis=1)
+        return s, np.take_along_axis(np.concatenate(ids, axis=1), i, axis=1)
+
+    def __getstate__(self):
+        return {"directory": self.directory, "readonly": self.readonly}
+
+    def __setstate__(self, state):
+        self.__init__(state["directory"], readonly=state["readonly"])
@@ -6,6 +6,7 @@ from typing import Literal, Optional, Union
 import numpy as np
 from pydantic import BaseModel, BaseSettings, Field, SecretStr
 import tiktoken
+from capabilities.ratelimit import get_rate_limiter
 from .types import EmbeddingModel
 from .util import argbatch, cache
 from rich.progress import track
@@ -187,10 +188,16 @@ class OpenAIEmbeddingModel(EmbeddingModel):
         batches = argbatch(lengths, N)
         es = []
         its = track(batches) if len(batches) > 100 else batches
+        limiter = get_rate_limiter()
         for batch in its:
             ts = texts[batch.start : batch.stop]
-            responses = embeddings(EmbeddingRequest(model=self.model_name, input=ts))
-            new_es = np.array([r.embedding for r in responses.data])
+            request = EmbeddingRequest(model=self.model_name, input=ts)
+            if limiter is not None and embeddings.__cache_key__(request) not in cache:
+                # token counts are already known, and cached batches don't use any quota.
+                limiter.acquire(sum(lengths[batch.start : batch.stop]))
+            responses = embeddings(request)
+            # the api's embeddings are float32, float64 would only double the size of the index.
+            new_es = np.array([r.embedding for r in responses.data], dtype=np.float32)
             assert len(new_es) == len(ts)
             es.append(new_es)
         es = np.concatenate(es, axis=0)
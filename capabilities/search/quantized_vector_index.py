@@ -0,0 +1,164 @@
+from typing import Literal, Optional, get_args
+
+import numpy as np
+
+from .simple_vector_index import SimpleVectorIndex, topk
+
+Precision = Literal["float32", "float16", "int8"]
+
+
+class QuantizedVectorIndex(SimpleVectorIndex):
+    """In-mem vector index with cosine similarity over rows stored at reduced precision.
+
+    The normalized rows are stored as float32, float16 or int8 codes. int8 codes are mapped back to
+    `code * scale + offset` with a scale and offset per dimension, fitted to the rows once the index holds
+    `min_train_rows` rows (or to the sample given to `train`); until then the rows are kept as float32.
+    Later values outside of the fitted range are clipped.
+    Searches scan the compact rows in blocks of `block_size` rows, so the decoded rows never take more than a block.
+
+    If `rescore` is positive, full precision float32 copies of the rows are kept as well, and the
+    `rescore * limit` best matches of the compact rows are reranked with their exact similarities.
+
+    Args:
+        precision: storage type of the rows.
+        rescore: oversampling factor of the exact reranking, 0 to not keep full precision rows.
+        block_size: number of rows decoded at once during a search.
+        min_train_rows: number of rows the int8 scale and offset are fitted to, if `train` isn't called.
+    """
+
+    def __init__(
+        self,
+        precision: Precision = "int8",
+        rescore: int = 0,
+        block_size: int = 4096,
+        min_train_rows: int = 4096,
+    ):
+        if precision not in get_args(Precision):
+            raise ValueError(f"unsupported precision {precision!r}, expected one of {get_args(Precision)}")
+        super().__init__()
+        self.precision = precision
+        self.rescore = rescore
+        self.block_size = block_size
+        self.min_train_rows = min_train_rows
+        self.scale: Optional[np.ndarray] = None
+        self.offset: Optional[np.ndarray] = None
+        self._full: Optional[SimpleVectorIndex] = SimpleVectorIndex() if rescore > 0 else None
+
+    @property
+    def nbytes(self) -> int:
+        """Memory taken by the stored rows, including the full precision copies and unused capacity."""
+        full = self._full._buffer.nbytes if self._full is not None else 0
+        return self._buffer.nbytes + full
+
+    @staticmethod
+    def _normalize(arr: np.ndarray) -> np.ndarray:
+        norm = np.linalg.norm(arr, axis=1)
+        if np.any(norm == 0):
+            raise ValueError("vector with norm 0 detected")
+        return (arr / norm[:, np.newaxis]).astype(np.float32, copy=False)
+
+    @property
+    def quantized(self) -> bool:
+        """Whether the rows are stored at `precision`, rather than as float32 until the int8 codes are fitted."""
+        return self.precision != "int8" or self.scale is not None
+
+    def train(self, sample: np.ndarray):
+        """Fits the int8 scale and offset of each dimension to the range of the (normalized) sample rows.
+
+        Rows already in the index are encoded again with the new scale and offset.
+        """
+        rows = self._normalize(sample)
+        stored = self._decode(self.rows) if self.precision == "int8" and len(self) > 0 else None
+        low, high = rows.min(axis=0), rows.max(axis=0)
+        self.scale = np.maximum(high - low, 1e-6).astype(np.float32) / 255
+        self.offset = (low + 128 * self.scale).astype(np.float32)
+        if stored is not None:
+            self._buffer = self._encode(stored)
+
+    def _decode(self, codes: np.ndarray) -> np.ndarray:
+        if codes.dtype != np.int8:
+            return codes.astype(np.float32)
+        return codes * self.scale + self.offset
+
+    def _encode(self, rows: np.ndarray) -> np.ndarray:
+        if self.precision != "int8":
+            return rows.astype(self.precision)
+        if self.scale is None:
+            return rows
+        codes = np.rint((rows - self.offset) / self.scale)
+        return np.clip(codes, -128, 127).astype(np.int8)
+
+    def add(self, arr):
+        assert len(arr.shape) == 2
+        rows = self._normalize(arr)
+        if len(self) == 0:
+            self._buffer = np.empty((0, rows.shape[1]), dtype=self.precision if self.quantized else np.float32)
+        else:
+            assert rows.shape[1] == self.dim, "Dimensions do not match"
+        n = len(self)
+        self._reserve(n + len(rows), rows.shape[1], self._buffer.dtype)
+        self._buffer[n : n + len(rows)] = self._encode(rows)
+        self._size = n + len(rows)
+        if self._full is not None:
+            self._full.add(rows)
+        if not self.quantized and len(self) >= self.min_train_rows:
+            # fitted to all the rows so far, rather than to a first batch that may not span their range.
+            self.train(self.rows)
+
+    def _scan(self, queries: np.ndarray, k: int):
+        """The k best matches of the normalized queries over the compact rows, with approximate similarities."""
+        if self.precision == "int8" and self.quantized:
+            # q . (code * scale + offset) = (q * scale) . code + q . offset
+            weights = queries * self.scale
+            bias = (queries @ self.offset)[:, np.newaxis]
+        else:
+            weights, bias = queries, 0
+        sims, ids = [], []
+        for start in range(0, len(self), self.block_size):
+            block = self.rows[start : start + self.block_size].astype(np.float32, copy=False)
+            s, i = topk(weights @ block.T + bias, min(k, len(block)), axis=1)
+            sims.append(s)
+            ids.append(i + start)
+        if len(sims) == 1:
+            return sims[0], ids[0]
+        s, i = topk(np.concatenate(sims, axis=1), k, axis=1)
+        return s, np.take_along_axis(np.concatenate(ids, axis=1), i, axis=1)
+
+    def search(self, queries: np.ndarray, limit: int):
+        batch_size, d = queries.shape
+        if len(self) == 0:
+            return (
+                np.empty((batch_size, 0), dtype=np.float32),
+                np.empty((batch_size, 0), dtype=np.int32),
+            )
+        assert d == self.dim, "Dimensions do not match"
+        queries = self._normalize(queries)
+        limit = min(limit, len(self))
+        if self._full is None:
+            return self._scan(queries, limit)
+        _, candidates = self._scan(queries, min(limit * self.rescore, len(self)))
+        exact = np.einsum("bd,bkd->bk", queries, self._full.rows[candidates])
+        s, i = topk(exact, limit, axis=1)
+        return s, np.take_along_axis(candidates, i, axis=1)
+
+    def __getstate__(self):
+        return {
+            "rows": self.rows,
+            "precision": self.precision,
+            "rescore": self.rescore,
+            "block_size": self.block_size,
+            "min_train_rows": self.min_train_rows,
+            "scale": self.scale,
+            "offset": self.offset,
+            "full": self._full,
+        }
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.precision = state["precision"]
+        self.rescore = state["rescore"]
+        self.block_size = state["block_size"]
+        self.min_train_rows = state["min_train_rows"]
+        self.scale = state["scale"]
+        self.offset = state["offset"]
+        self._full = state["full"]
@@ -11,6 +11,7 @@ from .simple_vector_index import SimpleVectorIndex
 from .types import (
     Chunk,
     EmbeddingModel,
+    Passage,
     TextItem,
     VectorIndex,
     get_text,
@@ -67,6 +68,43 @@ def simple_chunker(
         )
 
 
+def split_passages(
+    text: str, item_id: str, max_tokens_per_passage: int, model: EmbeddingModel
+) -> list[Passage]:
+    """Splits a text into half-overlapping passages of at most max_tokens_per_passage tokens.
+
+    Each passage's `substring_range` locates it in `text`, so that the passages can be indexed
+    as separate items and the matching parts of the text recovered from the search results.
+
+    Args:
+        text: text to split.
+        item_id: id of the item that the text belongs to.
+        max_tokens_per_passage: Maximum number of tokens per passage.
+        model: EmbeddingModel's tokenizer is used to figure out how many tokens are in a passage.
+    """
+    tokens = model.tokenize(text)
+    if len(tokens) <= max_tokens_per_passage:
+        return [Passage(item_id=item_id, text=text, substring_range=range(len(text)))]
+    passages = []
+    offset, position = 0, 0
+    for window_start, window_end in argwindow(len(tokens), max_tokens_per_passage, 0.5):
+        # offsets are accumulated rather than detokenizing the whole prefix for every window.
+        offset += len(model.detokenize(tokens[position:window_start]))
+        position = window_start
+        offset_start = min(offset, len(text))
+        offset_end = min(
+            offset + len(model.detokenize(tokens[window_start:window_end])), len(text)
+        )
+        passages.append(
+            Passage(
+                item_id=item_id,
+                text=text[offset_start:offset_end],
+                substring_range=range(offset_start, offset_end),
+            )
+        )
+    return passages
+
+
 class ChunkMap:
     """Keeps track of the mappings between chunk_ids, ids, indexes."""
 
@@ -242,7 +280,8 @@ class SearchIndex(Generic[T], AbstractSearchIndex[T]):
 
             embedding_model = STEmbeddingModel()
         self.embedding_model = embedding_model
-        self.vector_index = vector_index or SimpleVectorIndex()
+        # an empty index is falsy (it has a __len__), so `or` would replace the given index.
+        self.vector_index = vector_index if vector_index is not None else SimpleVectorIndex()
         self._cmap = ChunkMap()
         self.items = {}
         if items is not None:
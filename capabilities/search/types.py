@@ -93,6 +93,27 @@ class TextItem(ABC):
         return NotImplemented
 
 
+@dataclass
+class Passage(TextItem):
+    """A contiguous part of a larger TextItem, indexed as an item of its own.
+
+    Used to search within a single long document: each passage is a separate item,
+    and `substring_range` locates it in the text of the original item.
+    """
+
+    item_id: str
+    text: str
+    substring_range: range
+
+    @property
+    def id(self) -> str:
+        r = self.substring_range
+        return f"{self.item_id}[{r.start}:{r.stop}]"
+
+    def get_text(self) -> str:
+        return self.text
+
+
 @functools.singledispatch
 def get_text(item) -> str:
     """Returns the embeddable text for the given item."""
@@ -1,9 +1,11 @@
+import functools
 import heapq
 import itertools
 import math
 from pathlib import Path
 import sys
 import tempfile
+import threading
 from typing import (
     Any,
     Callable,
@@ -15,9 +17,12 @@ from typing import (
     Union,
     overload,
     TypeVar,
+    TYPE_CHECKING,
 )
 from hashlib import blake2b
-from diskcache import Cache
+
+if TYPE_CHECKING:
+    from diskcache import Cache
 
 K = TypeVar("K")
 T = TypeVar("T")
@@ -25,7 +30,59 @@ U = TypeVar("U")
 V = TypeVar("V")
 
 
-cache = Cache(Path(tempfile.gettempdir()) / "capabilities" / "diskcache.db")
+class LazyCache:
+    """A `diskcache.Cache` that is only opened when it is first used, so that importing doesn't touch the disk."""
+
+    def __init__(self, directory: Union[str, Path]):
+        self.directory = directory
+        self._cache: Optional["Cache"] = None
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self) -> "Cache":
+        if self._cache is None:
+            with self._lock:
+                if self._cache is None:
+                    from diskcache import Cache
+
+                    self._cache = Cache(self.directory)
+        return self._cache
+
+    def __getattr__(self, name: str):
+        return getattr(self.cache, name)
+
+    def __contains__(self, key) -> bool:
+        return key in self.cache
+
+    def __getitem__(self, key):
+        return self.cache[key]
+
+    def __setitem__(self, key, value):
+        self.cache[key] = value
+
+    def memoize(self, *args, **kwargs):
+        """Like `diskcache.Cache.memoize`, the cache is opened when the decorated function is first called."""
+
+        def decorator(fn):
+            memoized = None
+
+            def get():
+                nonlocal memoized
+                if memoized is None:
+                    memoized = self.cache.memoize(*args, **kwargs)(fn)
+                return memoized
+
+            @functools.wraps(fn)
+            def wrapper(*a, **kw):
+                return get()(*a, **kw)
+
+            wrapper.__cache_key__ = lambda *a, **kw: get().__cache_key__(*a, **kw)  # type: ignore
+            return wrapper
+
+        return decorator
+
+
+cache = LazyCache(Path(tempfile.gettempdir()) / "capabilities" / "diskcache.db")
 
 
 def fst(x: Tuple[U, Any]) -> U:
@@ -0,0 +1,210 @@
+"""Local stand-in for the Blazon API, for tests and load tests of the client.
+
+The server answers `/blazon/structured` (and its `/batch` endpoint), `/blazon/documentqa` and `/blazon/summarize` with made-up
+but well-formed responses, after a configurable latency, and can inject errors and 429s.
+Requests with `"stream": true` can be answered with server-sent events.
+
+usage: python -m capabilities.standin [--port 8080] [--latency 0.05] [--error-rate 0.01] [--throttle-rate 0.01]
+"""
+
+import asyncio
+import json
+import math
+import random
+import threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple, Union
+
+from aiohttp import web
+
+Handler = Callable[[web.Request, Any], Awaitable[web.StreamResponse]]
+""" A custom handler of a path, given the request and its decoded json body. """
+
+Latency = Union[float, Callable[[random.Random], float]]
+""" A fixed latency in seconds, or a function drawing one from a random generator. """
+
+
+def uniform(low: float, high: float) -> Callable[[random.Random], float]:
+    """Latencies uniformly distributed between `low` and `high` seconds."""
+    return lambda rng: rng.uniform(low, high)
+
+
+def lognormal(median: float, sigma: float = 0.5) -> Callable[[random.Random], float]:
+    """Long-tailed latencies around `median` seconds, like those of model inference."""
+    return lambda rng: rng.lognormvariate(math.log(median), sigma)
+
+
+def fake_output(spec):
+    """Produces a value matching a flattened structured schema."""
+    if isinstance(spec, list):
+        return [fake_output(spec[0])]
+    elif isinstance(spec, dict):
+        return {k: fake_output(v) for k, v in spec.items()}
+    return {"string": "x", "bool": True, "float": 0.5, "int": 1}[spec]
+
+
+def _response(path: str, body: Any) -> Tuple[Any, Optional[str]]:
+    """The response to a request, and the text that is streamed when a stream is requested."""
+    if path == "/blazon/structured":
+        return {"output": fake_output(body["output_spec"])}, None
+    elif path == "/blazon/structured/batch":
+        return {"outputs": [fake_output(body["output_spec"]) for _ in body["inputs"]]}, None
+    elif path == "/blazon/documentqa":
+        answer = f"answer to {body['query']}"
+        return {"answer": answer}, answer
+    elif path == "/blazon/summarize":
+        summary = body["document"][:10]
+        return {"summary": summary, "score": 1.0}, summary
+    raise web.HTTPNotFound()
+
+
+class StandInServer:
+    """Local stand-in for the Blazon API, running on its own event loop thread.
+
+    Every request waits `latency` seconds, then fails with a 500 with probability `error_rate`,
+    or with a 429 carrying a `Retry-After: retry_after` header with probability `throttle_rate`.
+    If `stream_chunks` is positive, requests with `"stream": true` are answered with server-sent events:
+    `stream_chunks` deltas spread over the latency, then the result. Otherwise they get the plain json response.
+    `handlers[path]` overrides the response of a path.
+
+    Args:
+        latency: latency of each request, see `uniform` and `lognormal`.
+        error_rate: probability of a 500 response.
+        throttle_rate: probability of a 429 response.
+        retry_after: `Retry-After` of 429 responses in seconds, None to leave it out.
+        stream_chunks: number of deltas of a streamed response, 0 to not stream.
+        record: whether to keep the received `requests` and `request_headers`. Turn it off under load.
+        seed: seed of the random draws.
+    """
+
+    def __init__(
+        self,
+        latency: Latency = 0.0,
+        error_rate: float = 0.0,
+        throttle_rate: float = 0.0,
+        retry_after: Optional[float] = None,
+        stream_chunks: int = 0,
+        record: bool = True,
+        seed: Optional[int] = None,
+    ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.stream_chunks = stream_chunks
+        self.record = record
+        self.requests: List[Tuple[str, Any]] = []
+        self.request_headers: List[Dict[str, str]] = []
+        self.peers: Set[Any] = set()
+        self.handlers: Dict[str, Handler] = {}
+        self.port: Optional[int] = None
+        self._rng = random.Random(seed)
+        self._loop = asyncio.new_event_loop()
+        self._started = threading.Event()
+
+    def _latency(self) -> float:
+        if callable(self.latency):
+            return max(0.0, self.latency(self._rng))
+        return self.latency
+
+    async def _handle(self, request: web.Request):
+        body = await request.json()
+        if self.record:
+            self.requests.append((request.path, body))
+            self.request_headers.append(dict(request.headers))
+            self.peers.add(request.transport.get_extra_info("peername"))
+        handler = self.handlers.get(request.path)
+        if handler is not None:
+            return await handler(request, body)
+        result, text = _response(request.path, body)
+        delay = self._latency()
+        draw = self._rng.random()
+        streamed = body.get("stream") and text is not None and self.stream_chunks > 0
+        if streamed and draw >= self.error_rate + self.throttle_rate:
+            return await self._stream(request, result, text, delay)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if draw < self.error_rate:
+            return web.json_response({"error": "injected error"}, status=500)
+        if draw < self.error_rate + self.throttle_rate:
+            headers = {} if self.retry_after is None else {"Retry-After": f"{self.retry_after:g}"}
+            return web.json_response({"error": "rate limited"}, status=429, headers=headers)
+        return web.json_response(result)
+
+    async def _stream(self, request: web.Request, result: Any, text: str, delay: float):
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        n = self.stream_chunks
+        size = math.ceil(len(text) / n) or 1
+        for i in range(0, max(len(text), 1), size):
+            await asyncio.sleep(delay / n)
+            await resp.write(f"data: {json.dumps({'delta': text[i : i + size]})}\n\n".encode())
+        await resp.write(f"event: result\ndata: {json.dumps(result)}\n\n".encode())
+        await resp.write(b"data: [DONE]\n\n")
+        return resp
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("POST", "/{tail:.*}", self._handle)
+        return app
+
+    def _run(self, host: str, port: int):
+        asyncio.set_event_loop(self._loop)
+        self._runner = web.AppRunner(self.app())
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, host, port)
+        self._loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        self._started.set()
+        self._loop.run_forever()
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> "StandInServer":
+        """Starts serving on a background thread. Port 0 picks a free port."""
+        self._thread = threading.Thread(target=self._run, args=(host, port), daemon=True)
+        self._thread.start()
+        self._started.wait()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+
+def main(
+    port: int = 8080,
+    host: str = "127.0.0.1",
+    latency: float = 0.0,
+    latency_sigma: float = 0.0,
+    error_rate: float = 0.0,
+    throttle_rate: float = 0.0,
+    retry_after: Optional[float] = None,
+    stream_chunks: int = 4,
+    seed: Optional[int] = None,
+):
+    """Serves the stand-in in the foreground. A positive `latency_sigma` makes latencies lognormal around `latency`."""
+    server = StandInServer(
+        latency=lognormal(latency, latency_sigma) if latency > 0 and latency_sigma > 0 else latency,
+        error_rate=error_rate,
+        throttle_rate=throttle_rate,
+        retry_after=retry_after,
+        stream_chunks=stream_chunks,
+        record=False,
+        seed=seed,
+    )
+    web.run_app(server.app(), host=host, port=port)
+
+
+if __name__ == "__main__":
+    import fire
+
+    fire.Fire(main)
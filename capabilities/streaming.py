@@ -0,0 +1,141 @@
+import json
+from typing import Any, AsyncIterator, Callable, Iterator, List, Optional, Tuple
+
+Event = Tuple[str, Any]
+""" A parsed stream event: ("delta", text) for a text chunk or ("result", response) for the final response. """
+
+
+def _event_of(name: str, data: str) -> Optional[Event]:
+    if data == "[DONE]":
+        return None
+    try:
+        obj = json.loads(data)
+    except ValueError:
+        return ("delta", data)
+    if name == "result":
+        return ("result", obj)
+    if isinstance(obj, dict):
+        if "delta" in obj:
+            return ("delta", obj["delta"])
+        if "result" in obj:
+            return ("result", obj["result"])
+    return ("delta", data)
+
+
+class StreamParser:
+    """Incremental parser for streamed responses.
+
+    Supports server-sent events (`text/event-stream`) and newline-delimited json
+    (`application/x-ndjson`, or any other chunked response) where each event is either
+    `{"delta": "<text chunk>"}` or the final response, sent as an SSE event named `result`
+    or as `{"result": <response>}`. An SSE `data: [DONE]` line is ignored.
+    """
+
+    def __init__(self, content_type: str):
+        self.sse = "text/event-stream" in content_type
+        self._name = "message"
+        self._data: List[str] = []
+
+    def feed(self, line: str) -> Optional[Event]:
+        """Feeds one line (without its line terminator) and returns the completed event, if any."""
+        if not self.sse:
+            line = line.strip()
+            return _event_of("message", line) if line else None
+        if line == "":
+            if not self._data:
+                return None
+            event = _event_of(self._name, "\n".join(self._data))
+            self._name, self._data = "message", []
+            return event
+        if line.startswith(":"):
+            return None
+        field, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+        if field == "event":
+            self._name = value
+        elif field == "data":
+            self._data.append(value)
+        return None
+
+    def close(self) -> Optional[Event]:
+        """Flushes an event that wasn't terminated by a blank line."""
+        return self.feed("") if self.sse else None
+
+
+class TextStream:
+    """Iterator over the text chunks of a streamed capability response.
+
+    Once the stream is exhausted, `text` holds the concatenated chunks and `result` the final response,
+    as it would have been returned by the non-streaming call.
+    If the server didn't send a final response, `result` is built by `default_result` from the text.
+    """
+
+    def __init__(
+        self,
+        events: Iterator[Event],
+        default_result: Callable[[str], Any],
+    ):
+        self._events = events
+        self._default_result = default_result
+        self._chunks: List[str] = []
+        self.result: Any = None
+
+    @property
+    def text(self) -> str:
+        return "".join(self._chunks)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        for kind, value in self._events:
+            if kind == "delta":
+                self._chunks.append(value)
+                return value
+            self.result = value
+        if self.result is None:
+            self.result = self._default_result(self.text)
+        raise StopIteration
+
+
+class AsyncTextStream:
+    """Async version of `TextStream`."""
+
+    def __init__(
+        self,
+        events: AsyncIterator[Event],
+        default_result: Callable[[str], Any],
+    ):
+        self._events = events
+        self._default_result = default_result
+        self._chunks: List[str] = []
+        self.result: Any = None
+
+    @property
+    def text(self) -> str:
+        return "".join(self._chunks)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        async for kind, value in self._events:
+            if kind == "delta":
+                self._chunks.append(value)
+                return value
+            self.result = value
+        if self.result is None:
+            self.result = self._default_result(self.text)
+        raise StopAsyncIteration
+
+
+def result_events(result: Any, text_of: Callable[[Any], Optional[str]]) -> List[Event]:
+    """Events for a server that answered a stream request with a plain json response."""
+    events: List[Event] = []
+    text = text_of(result)
+    if text:
+        events.append(("delta", text))
+    events.append(("result", result))
+    return events
+
@@ -1,28 +1,44 @@
-import time
-import aiohttp
-import fire
+import functools
+import logging
+import math
 import os
-import requests
-import openai
-import random
-import tiktoken
+from typing import Optional
+from capabilities.ratelimit import get_rate_limiter
+from capabilities.retry import RetryPolicy
 
-ENCODER = tiktoken.get_encoding("p50k_base")
+logger = logging.getLogger("capabilities")
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoder():
+    """The tiktoken encoder used to count tokens, loaded on first use."""
+    import tiktoken
+
+    return tiktoken.get_encoding("p50k_base")
+
+
+def __getattr__(name):
+    # `ENCODER` used to be built at import time, it is now loaded when first accessed.
+    if name == "ENCODER":
+        return get_encoder()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def tokenize(contents):
-    return ENCODER.encode(contents)
+    return get_encoder().encode(contents)
 
 
 def detokenize(tokens):
-    return ENCODER.decode(tokens)
+    return get_encoder().decode(tokens)
 
 
 def get_chunks_tokenized(contents: str, max_len: int = 256, stride=None):
     if stride is None:
         stride = max_len
     tokens = tokenize(contents)
-    return [tokens[stride * i : stride * i + max_len] for i in range(len(tokens) // stride + 1)]
+    # the last window is the first one to reach the end of the tokens.
+    n_windows = max(0, math.ceil((len(tokens) - max_len) / stride)) + 1
+    return [tokens[stride * i : stride * i + max_len] for i in range(n_windows)]
 
 
 def get_tokenized_length(contents: str):
@@ -41,41 +57,14 @@ def retry_with_exponential_backoff(
     max_retries: int = 10,
     errors: tuple = (KeyError,),
 ):
-    """Retry a function with exponential backoff."""
-
-    def wrapper(*args, **kwargs):
-        # Initialize variables
-        num_retries = 0
-        delay = initial_delay
-
-        # Loop until a successful response or max_retries is hit or an exception is raised
-        while True:
-            try:
-                return func(*args, **kwargs)
-
-            # Retry on specified errors
-            except errors as e:
-                # Increment retries
-                num_retries += 1
-
-                # Check if max retries has been reached
-                if num_retries > max_retries:
-                    raise Exception(f"Maximum number of retries ({max_retries}) exceeded.")
-                print(
-                    f"[retry_with_exponential_backoff] retrying, num_retries={num_retries} max_retries={max_retries}"
-                )
-
-                # Increment the delay
-                delay *= exponential_base * (1 + jitter * random.random())
-
-                # Sleep for the delay
-                time.sleep(delay)
-
-            # Raise exceptions for any errors not specified
-            except Exception as e:
-                raise e
-
-    return wrapper
+    """Retry a function with exponential backoff, see `capabilities.retry.RetryPolicy`."""
+    return RetryPolicy(
+        max_retries=max_retries,
+        initial_delay=initial_delay,
+        exponential_base=exponential_base,
+        jitter=jitter,
+        errors=errors,
+    ).wrap(func)
 
 
 def retry_with_exponential_backoff_async(
@@ -84,41 +73,31 @@ def retry_with_exponential_backoff_async(
     exponential_base: float = 2,
     jitter: bool = True,
     max_retries: int = 10,
-    errors: tuple = (openai.error.RateLimitError,),
+    errors: Optional[tuple] = None,
 ):
-    """Retry a function with exponential backoff."""
-
+    """Retry a coroutine function with exponential backoff, sleeping without blocking the event loop.
+
+    `errors` defaults to openai's `RateLimitError`, imported on the first call.
+    See `capabilities.retry.RetryPolicy`.
+    """
+    policy = RetryPolicy(
+        max_retries=max_retries,
+        initial_delay=initial_delay,
+        exponential_base=exponential_base,
+        jitter=jitter,
+        errors=errors,
+    )
+    if errors is not None:
+        return policy.wrap(func)
+    wrapped = policy.wrap(func)
+
+    @functools.wraps(func)
     async def wrapper(*args, **kwargs):
-        # Initialize variables
-        num_retries = 0
-        delay = initial_delay
-
-        # Loop until a successful response or max_retries is hit or an exception is raised
-        while True:
-            try:
-                return await func(*args, **kwargs)
+        if policy.errors is None:
+            import openai
 
-            # Retry on specified errors
-            except errors as e:
-                # Increment retries
-                num_retries += 1
-
-                # Check if max retries has been reached
-                if num_retries > max_retries:
-                    raise Exception(f"Maximum number of retries ({max_retries}) exceeded.")
-                print(
-                    f"[retry_with_exponential_backoff] retrying, num_retries={num_retries} max_retries={max_retries}"
-                )
-
-                # Increment the delay
-                delay *= exponential_base * (1 + jitter * random.random())
-
-                # Sleep for the delay
-                time.sleep(delay)
-
-            # Raise exceptions for any errors not specified
-            except Exception as e:
-                raise e
+            policy.errors = (openai.error.RateLimitError,)
+        return await wrapped(*args, **kwargs)
 
     return wrapper
 
@@ -131,6 +110,9 @@ async def text_embed_async(prompt, session=None):
         "Authorization": f"Bearer {os.environ.get('OPENAI_API_KEY_EMBED')}",
     }
     payload = {"input": prompt, "model": "text-embedding-ada-002"}
+    limiter = get_rate_limiter()
+    if limiter is not None:
+        await limiter.acquire_async(limiter.cost(prompt))
 
     async with session.post(
         "https://api.openai.com/v1/embeddings", headers=headers, json=payload
@@ -140,9 +122,7 @@ async def text_embed_async(prompt, session=None):
         try:
             return result["data"][0]["embedding"]
         except KeyError as e:
-            print("[text_generate_async] BAD RESPONSE: ", result)
-            print(f"[text_generate_async] exception={e}")
-            print("[text_generate_async] BAD PROMPT: ", prompt)
+            logger.error(f"[text_embed_async] bad response {result} for prompt {prompt!r}, exception={e!r}")
             raise e
 
 
@@ -153,5 +133,10 @@ def text_embed(prompt):
         "Authorization": f"Bearer {os.environ.get('OPENAI_API_KEY_EMBED')}",
     }
     payload = {"input": prompt, "model": "text-embedding-ada-002"}
+    limiter = get_rate_limiter()
+    if limiter is not None:
+        limiter.acquire(limiter.cost(prompt))
+    import requests
+
     r = requests.post("https://api.openai.com/v1/embeddings", headers=headers, json=payload)
     return r.json()["data"][0]["embedding"]
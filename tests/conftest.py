@@ -0,0 +1,10 @@
+import pytest
+
+from capabilities.standin import StandInServer
+
+
+@pytest.fixture
+def stand_in():
+    server = StandInServer().start()
+    yield server
+    server.stop()
@@ -0,0 +1,105 @@
+import asyncio
+import threading
+import time
+
+from aiohttp import web
+import requests
+
+from capabilities import AdaptiveLimiter, CapabilitiesClient
+from capabilities.core import Summarize
+from capabilities.retry import RetryPolicy
+
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(response=response)
+
+
+def test_additive_increase_multiplicative_decrease():
+    limiter = AdaptiveLimiter(initial_limit=4, max_limit=8)
+    for _ in range(4):
+        limiter.acquire()
+        limiter.release(latency=0.1)
+    assert limiter.limit == 4 and limiter._limit > 4.9
+    limiter.acquire()
+    limiter.release(error=http_error(429))
+    assert limiter.limit == 2
+    # a burst of failures from the same window only cuts once.
+    limiter.acquire()
+    limiter.release(error=http_error(503))
+    assert limiter.limit == 2
+    assert limiter.stats.overloads == 2 and limiter.stats.decreases == 1
+    # other errors leave the limit alone.
+    limiter.acquire()
+    limiter.release(error=http_error(400))
+    assert limiter.limit == 2 and limiter.in_flight == 0
+
+
+def test_latency_spike_cuts_limit():
+    limiter = AdaptiveLimiter(initial_limit=8, latency_tolerance=2.0)
+    for _ in range(10):
+        limiter.acquire()
+        limiter.release(latency=0.01)
+    limiter._last_decrease = float("-inf")
+    limiter.acquire()
+    limiter.release(latency=0.5)
+    assert limiter.stats.spikes == 1
+    assert limiter.limit == 4
+
+
+def test_slots_are_shared_by_threads():
+    limiter = AdaptiveLimiter(initial_limit=2, max_limit=2)
+    state = {"in_flight": 0, "max": 0}
+    lock = threading.Lock()
+
+    def work():
+        with lock:
+            state["in_flight"] += 1
+            state["max"] = max(state["max"], state["in_flight"])
+        time.sleep(0.02)
+        with lock:
+            state["in_flight"] -= 1
+
+    threads = [threading.Thread(target=limiter.call, args=(work,)) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert state["max"] == 2
+    assert limiter.stats.calls == 8
+
+
+def test_batch_backs_off_on_429s(stand_in):
+    state = {"in_flight": 0, "max": 0, "n": 0}
+
+    async def handler(request, body):
+        state["n"] += 1
+        if state["in_flight"] >= 3:
+            return web.json_response({}, status=429)
+        state["in_flight"] += 1
+        state["max"] = max(state["max"], state["in_flight"])
+        await asyncio.sleep(0.02)
+        state["in_flight"] -= 1
+        return web.json_response({"summary": body["document"], "score": 1.0})
+
+    stand_in.handlers["/blazon/summarize"] = handler
+    limiter = AdaptiveLimiter(initial_limit=16)
+    client = CapabilitiesClient(
+        stand_in.url,
+        api_key="test",
+        retry=RetryPolicy(initial_delay=0.01, max_delay=0.05, max_retries=20),
+        concurrency_limiter=limiter,
+    )
+    summarize = Summarize(client=client)
+
+    async def main():
+        results = await summarize.run_many([f"doc {i}" for i in range(60)], concurrency=60)
+        await client.aclose()
+        return results
+
+    results = asyncio.run(main())
+    assert all(r.ok for r in results)
+    assert limiter.stats.overloads > 0
+    assert limiter.limit < 16
+    assert limiter.in_flight == 0
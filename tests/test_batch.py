@@ -0,0 +1,136 @@
+import asyncio
+import time
+
+from aiohttp import web
+from pydantic import BaseModel
+
+from capabilities import CapabilitiesClient, Capability, llm
+from capabilities.batch import REORDER_WINDOWS, amap_calls, map_calls
+from capabilities.retry import RetryPolicy
+
+
+class Row(BaseModel):
+    text: str
+
+
+def concurrency_tracking_handler(stand_in, delay=0.02):
+    state = {"in_flight": 0, "max": 0}
+
+    async def handler(request, body):
+        state["in_flight"] += 1
+        state["max"] = max(state["max"], state["in_flight"])
+        await asyncio.sleep(delay)
+        state["in_flight"] -= 1
+        text = body["input"]["text"]
+        if text == "bad":
+            return web.json_response({}, status=400)
+        return web.json_response({"output": {"text": text.upper()}})
+
+    stand_in.handlers["/blazon/structured"] = handler
+    return state
+
+
+def make_capability(stand_in):
+    client = CapabilitiesClient(
+        stand_in.url, api_key="test", retry=RetryPolicy(max_retries=0)
+    )
+    return Capability("blazon/structured", client=client)
+
+
+def test_map_ordered_with_failures(stand_in):
+    state = concurrency_tracking_handler(stand_in)
+    c = make_capability(stand_in)
+    texts = [f"row {i}" for i in range(20)]
+    texts[7] = "bad"
+    results = list(
+        c.map(
+            [{"input": Row(text=t)} for t in texts],
+            concurrency=4,
+            input_spec=Row,
+            output_spec=Row,
+            instructions="uppercase",
+        )
+    )
+    assert [r.index for r in results] == list(range(20))
+    assert not results[7].ok
+    assert all(r.output == Row(text=t.upper()) for r, t in zip(results, texts) if r.ok)
+    assert sum(r.ok for r in results) == 19
+    assert state["max"] <= 4
+
+
+def test_amap_as_completed(stand_in):
+    state = concurrency_tracking_handler(stand_in)
+    c = make_capability(stand_in)
+
+    async def main():
+        results = [
+            r
+            async for r in c.amap(
+                [(Row, Row, "uppercase", Row(text=str(i))) for i in range(30)],
+                concurrency=5,
+                ordered=False,
+            )
+        ]
+        ordered = await c.run_many(
+            [(Row, Row, "uppercase", Row(text=str(i))) for i in range(5)]
+        )
+        await c.get_client().aclose()
+        return results, ordered
+
+    results, ordered = asyncio.run(main())
+    assert sorted(r.index for r in results) == list(range(30))
+    assert all(r.unwrap() == Row(text=str(r.index)) for r in results)
+    assert [r.index for r in ordered] == list(range(5))
+    assert state["max"] <= 5
+    assert len(stand_in.peers) <= 5
+
+
+def test_ai_function_run_async_and_batch(stand_in):
+    client = CapabilitiesClient(
+        stand_in.url, api_key="test", retry=RetryPolicy(max_retries=0)
+    )
+
+    @llm(client=client)
+    def count_words(text: str, lower: bool = True) -> int:
+        """Counts the words in the text."""
+        ...
+
+    results = count_words.batch(["a b", ("c", False), {"text": "d"}], concurrency=2)
+    assert [r.unwrap() for r in results] == [1, 1, 1]
+    bodies = [body for _, body in stand_in.requests]
+    assert {"text": "c", "lower": False} in [b["input"] for b in bodies]
+    assert all(b["output_spec"] == {"output": "int"} for b in bodies)
+
+    async def main():
+        single = await count_words.run_async("hello")
+        many = await count_words.abatch([str(i) for i in range(10)], concurrency=3)
+        await client.aclose()
+        return single, many
+
+    single, many = asyncio.run(main())
+    assert single == 1
+    assert [r.index for r in many] == list(range(10))
+    assert all(r.ok for r in many)
+
+
+def test_ordered_map_does_not_stall_behind_slow_call():
+    finished = []
+
+    async def acall(i):
+        await asyncio.sleep(0.3 if i == 0 else 0.01)
+        finished.append(i)
+        return i
+
+    def call(i):
+        time.sleep(0.3 if i == 0 else 0.01)
+        finished.append(i)
+        return i
+
+    async def main():
+        return [r async for r in amap_calls(acall, range(12), concurrency=2)]
+
+    for run in [lambda: asyncio.run(main()), lambda: list(map_calls(call, range(12), concurrency=2))]:
+        finished.clear()
+        assert [r.unwrap() for r in run()] == list(range(12))
+        # the other calls ran while the first one was in flight, up to the reorder buffer.
+        assert finished.index(0) == 2 * REORDER_WINDOWS - 1
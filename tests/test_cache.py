@@ -0,0 +1,103 @@
+import asyncio
+import time
+
+import aiohttp
+from pydantic import BaseModel
+
+from capabilities import CapabilitiesClient, Capability, ResultCache
+from capabilities.cache import MISSING, payload_key
+
+
+class Row(BaseModel):
+    text: str
+
+
+def test_payload_key_is_canonical():
+    a = payload_key("/x", {"a": 1, "b": [1, 2], "c": {"d": "e", "f": None}})
+    b = payload_key("/x", {"c": {"f": None, "d": "e"}, "b": [1, 2], "a": 1})
+    assert a == b
+    assert a != payload_key("/y", {"a": 1, "b": [1, 2], "c": {"d": "e", "f": None}})
+
+
+def test_lru_eviction_and_ttl():
+    cache = ResultCache(max_size=2, ttl=0.05)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is MISSING
+    assert cache.stats.evictions == 1
+    time.sleep(0.06)
+    assert cache.get("a") is MISSING
+    assert cache.stats.hits == 1
+    assert cache.stats.misses == 2
+
+
+def test_disk_tier(tmp_path):
+    cache = ResultCache(max_size=1, directory=tmp_path)
+    cache.set("a", {"output": 1})
+    cache.set("b", {"output": 2})
+    assert cache.get("a") == {"output": 1}
+    assert cache.stats.disk_hits == 1
+    cache2 = ResultCache(directory=tmp_path)
+    assert cache2.get("b") == {"output": 2}
+
+
+def test_client_cache_skips_network(stand_in):
+    client = CapabilitiesClient(stand_in.url, api_key="test", cache=ResultCache())
+    c = Capability("blazon/structured", client=client)
+    for _ in range(3):
+        assert c(Row, Row, "copy", Row(text="a")) == Row(text="x")
+
+    async def main():
+        result = await c.run_async(Row, Row, "copy", Row(text="a"))
+        await client.aclose()
+        return result
+
+    assert asyncio.run(main()) == Row(text="x")
+    assert len(stand_in.requests) == 1
+    assert client.cache.stats.hits == 3
+    assert client.cache.stats.misses == 1
+
+
+def test_client_cache_is_keyed_by_headers(stand_in):
+    client = CapabilitiesClient(stand_in.url, api_key="test", cache=ResultCache())
+    payload = {"document": "a document"}
+    for tenant in ["a", "b", "a", "b"]:
+        client.post("blazon/summarize", payload, headers={"X-Tenant": tenant})
+    assert [h["X-Tenant"] for h in stand_in.request_headers] == ["a", "b"]
+
+    async def main():
+        async with aiohttp.ClientSession(headers={"X-Tenant": "c"}) as session:
+            for _ in range(2):
+                await client.apost("blazon/summarize", payload, session=session)
+        await client.apost("blazon/summarize", payload, headers={"X-Tenant": "a"})
+        await client.aclose()
+
+    asyncio.run(main())
+    assert [h["X-Tenant"] for h in stand_in.request_headers] == ["a", "b", "c"]
+    assert client.cache.stats.hits == 4
+
+
+def test_hits_are_copies(tmp_path):
+    cache = ResultCache(directory=tmp_path)
+    value = {"output": [1]}
+    cache.set("a", value)
+    value["output"].append(2)
+    hit = cache.get("a")
+    assert hit == {"output": [1]}
+    hit["output"].append(3)
+    assert cache.get("a") == {"output": [1]}
+    cache2 = ResultCache(directory=tmp_path)
+    cache2.get("a")["output"].append(4)
+    assert cache2.get("a") == {"output": [1]}
+
+
+def test_disk_hit_keeps_expiry(tmp_path):
+    ResultCache(ttl=0.2, directory=tmp_path).set("a", 1)
+    time.sleep(0.1)
+    cache = ResultCache(ttl=0.2, directory=tmp_path)
+    assert cache.get("a") == 1
+    time.sleep(0.15)
+    # expired 0.2 s after it was set, not 0.2 s after the disk hit.
+    assert cache.get("a") is MISSING
@@ -0,0 +1,57 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from pydantic import BaseModel
+
+from capabilities import CapabilitiesClient, Capability, llm
+
+
+class Row(BaseModel):
+    text: str
+
+
+class Label(BaseModel):
+    label: str
+    score: float
+
+
+def test_sync_calls_reuse_connection(stand_in):
+    client = CapabilitiesClient(stand_in.url, api_key="test")
+    c = Capability("blazon/structured", client=client)
+    for _ in range(5):
+        out = c(Row, Label, "label the row", Row(text="hi"))
+        assert out == Label(label="x", score=0.5)
+    assert len(stand_in.requests) == 5
+    assert len(stand_in.peers) == 1
+    client.close()
+
+
+def test_async_calls_reuse_session(stand_in):
+    client = CapabilitiesClient(stand_in.url, api_key="test", limit_per_host=2)
+
+    async def main():
+        c = Capability("blazon/summarize", client=client)
+        results = await asyncio.gather(
+            *[c.run_async(f"document {i}") for i in range(10)]
+        )
+        await client.aclose()
+        return results
+
+    results = asyncio.run(main())
+    assert [r["summary"] for r in results] == [f"document {i}"[:10] for i in range(10)]
+    assert len(stand_in.peers) <= 2
+
+
+def test_client_shared_across_threads(stand_in):
+    client = CapabilitiesClient(stand_in.url, api_key="test", pool_maxsize=4)
+
+    @llm(client=client)
+    def label(text: str) -> Label:
+        """Label the text."""
+        ...
+
+    with ThreadPoolExecutor(4) as ex:
+        results = list(ex.map(label, ["a"] * 20))
+    assert all(r == Label(label="x", score=0.5) for r in results)
+    assert len(stand_in.peers) <= 4
+    client.close()
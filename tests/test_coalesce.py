@@ -0,0 +1,229 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from aiohttp import web
+import pytest
+
+from capabilities import CapabilitiesClient
+from capabilities.coalesce import SingleFlight
+from capabilities.core import Summarize
+from capabilities.retry import DeadlineExceeded
+from capabilities.scheduler import Priority, scheduling
+
+
+def slow_summaries(stand_in, delay=0.2):
+    async def handler(request, body):
+        await asyncio.sleep(delay)
+        return web.json_response({"summary": body["document"][:10], "score": 1.0})
+
+    stand_in.handlers["/blazon/summarize"] = handler
+
+
+def test_threads_share_one_call(stand_in):
+    slow_summaries(stand_in)
+    client = CapabilitiesClient(stand_in.url, api_key="test")
+    summarize = Summarize(client=client)
+    barrier = threading.Barrier(8)
+
+    def call(_):
+        barrier.wait()
+        return summarize("a popular document")
+
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(call, range(8)))
+    assert all(r == {"summary": "a popular ", "score": 1.0} for r in results)
+    assert len(stand_in.requests) == 1
+    assert client.single_flight.stats.calls == 8
+    assert client.single_flight.stats.deduplicated == 7
+    assert len(client.single_flight) == 0
+
+
+def test_async_and_blocking_callers_share_one_call(stand_in):
+    slow_summaries(stand_in)
+    client = CapabilitiesClient(stand_in.url, api_key="test")
+    summarize = Summarize(client=client)
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        calls = [summarize.run_async("doc") for _ in range(4)]
+        calls.append(summarize.run_async("another doc"))
+        # a blocking caller on another thread joins the async call in flight.
+        calls.append(loop.run_in_executor(None, summarize, "doc"))
+        results = await asyncio.gather(*calls)
+        await client.aclose()
+        return results
+
+    results = asyncio.run(main())
+    assert results[4]["summary"] == "another do"
+    assert len(stand_in.requests) == 2
+    assert client.single_flight.stats.deduplicated == 4
+
+
+def test_cancelling_the_leader_keeps_the_call_for_others(stand_in):
+    slow_summaries(stand_in)
+    client = CapabilitiesClient(stand_in.url, api_key="test")
+    summarize = Summarize(client=client)
+
+    async def main():
+        leader = asyncio.ensure_future(summarize.run_async("doc"))
+        await asyncio.sleep(0.05)
+        follower = asyncio.ensure_future(summarize.run_async("doc"))
+        await asyncio.sleep(0.05)
+        leader.cancel()
+        result = await follower
+        await client.aclose()
+        return leader, result
+
+    leader, result = asyncio.run(main())
+    assert leader.cancelled()
+    assert result["summary"] == "doc"
+    assert len(stand_in.requests) == 1
+
+
+def test_errors_are_shared():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fail():
+        calls.append(1)
+        started.set()
+        release.wait()
+        raise ValueError("boom")
+
+    with ThreadPoolExecutor(2) as pool:
+        first = pool.submit(flight.call, "k", fail)
+        started.wait()
+        second = pool.submit(flight.call, "k", fail)
+        while flight.stats.calls < 2:
+            pass
+        release.set()
+        for f in (first, second):
+            with pytest.raises(ValueError):
+                f.result()
+    assert len(calls) == 1
+    # once the call has landed, the next one starts afresh.
+    release.set()
+    with pytest.raises(ValueError):
+        flight.call("k", fail)
+    assert len(calls) == 2
+
+
+def test_coalescing_can_be_disabled(stand_in):
+    slow_summaries(stand_in, delay=0.05)
+    client = CapabilitiesClient(stand_in.url, api_key="test", coalesce=False)
+    summarize = Summarize(client=client)
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(lambda _: summarize("doc"), range(4)))
+    assert client.single_flight is None
+    assert len(stand_in.requests) == 4
+
+
+def test_joiners_get_copies_and_rejoin():
+    flight = SingleFlight(rejoin=(TimeoutError,))
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fetch(fail):
+        calls.append(fail)
+        started.set()
+        release.wait()
+        if fail:
+            raise TimeoutError()
+        return {"output": [1]}
+
+    with ThreadPoolExecutor(3) as pool:
+        first = pool.submit(flight.call, "k", fetch, False)
+        started.wait()
+        others = [pool.submit(flight.call, "k", fetch, False) for _ in range(2)]
+        while flight.stats.calls < 3:
+            pass
+        release.set()
+        results = [first.result(), *(f.result() for f in others)]
+    assert results == [{"output": [1]}] * 3
+    assert len({id(r) for r in results}) == 3 and len(calls) == 1
+
+    # the leader's own error is raised to it, the joiner makes the call again.
+    started.clear()
+    release.clear()
+    with ThreadPoolExecutor(2) as pool:
+        first = pool.submit(flight.call, "k", fetch, True)
+        started.wait()
+        second = pool.submit(flight.call, "k", fetch, False)
+        while flight.stats.calls < 5:
+            pass
+        release.set()
+        with pytest.raises(TimeoutError):
+            first.result()
+        assert second.result() == {"output": [1]}
+    assert calls == [False, True, False]
+
+
+def test_priorities_are_not_coalesced(stand_in):
+    slow_summaries(stand_in, delay=0.1)
+    client = CapabilitiesClient(stand_in.url, api_key="test")
+    summarize = Summarize(client=client)
+
+    def call(priority):
+        with scheduling(priority=priority):
+            return summarize("doc")
+
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(call, [Priority.LOW, Priority.LOW, Priority.HIGH, Priority.HIGH]))
+    assert len(stand_in.requests) == 2
+    assert client.single_flight.stats.deduplicated == 2
+
+
+def test_headers_and_sessions_are_not_coalesced(stand_in):
+    slow_summaries(stand_in, delay=0.1)
+    client = CapabilitiesClient(stand_in.url, api_key="test")
+    payload = {"document": "doc"}
+
+    def call(tenant):
+        return client.post("blazon/summarize", payload, headers={"X-Tenant": tenant})
+
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(call, ["a", "a", "b", "b"]))
+    assert len(stand_in.requests) == 2
+    assert sorted(h["X-Tenant"] for h in stand_in.request_headers) == ["a", "b"]
+
+    async def main():
+        async with aiohttp.ClientSession() as session:
+            calls = [client.apost("blazon/summarize", payload, session=session) for _ in range(2)]
+            calls += [client.apost("blazon/summarize", payload) for _ in range(2)]
+            await asyncio.gather(*calls)
+        await client.aclose()
+
+    asyncio.run(main())
+    # the calls on the caller's session are made separately, the others share one call.
+    assert len(stand_in.requests) == 5
+
+
+def test_joiners_wait_until_their_deadline():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def slow():
+        release.wait(5)
+        return "done"
+
+    with ThreadPoolExecutor(1) as pool:
+        leader = pool.submit(flight.call, "k", slow)
+        while len(flight) == 0:
+            pass
+        with pytest.raises(DeadlineExceeded):
+            flight.call("k", slow, deadline=time.monotonic() + 0.05)
+
+        async def join():
+            return await flight.call_async("k", slow, deadline=time.monotonic() + 0.05)
+
+        with pytest.raises(DeadlineExceeded):
+            asyncio.run(join())
+        release.set()
+        assert leader.result() == "done"
+    assert flight.stats.deduplicated == 2
@@ -0,0 +1,141 @@
+import asyncio
+
+from aiohttp import web
+import numpy as np
+
+from capabilities import CapabilitiesClient
+from capabilities.core import DocumentQA
+from capabilities.search import EmbeddingModel, split_passages
+from capabilities.search.loader import Document
+from capabilities.search.util import digest
+
+DOCUMENT = " ".join(f"sentence number {i}." for i in range(2000))
+
+
+def tracking_handler(stand_in):
+    state = {"in_flight": 0, "max": 0}
+
+    async def handler(request, body):
+        state["in_flight"] += 1
+        state["max"] = max(state["max"], state["in_flight"])
+        await asyncio.sleep(0.01)
+        state["in_flight"] -= 1
+        return web.json_response({"answer": f"{len(body['document'])} chars"})
+
+    stand_in.handlers["/blazon/documentqa"] = handler
+    return state
+
+
+def test_windows_cover_document():
+    qa = DocumentQA(window_tokens=500, window_overlap=50)
+    ws = qa.windows(DOCUMENT)
+    assert len(ws) > 1
+    assert all(w in DOCUMENT for w in ws)
+    assert DOCUMENT.startswith(ws[0]) and DOCUMENT.endswith(ws[-1])
+
+
+def test_map_reduce(stand_in):
+    state = tracking_handler(stand_in)
+    client = CapabilitiesClient(stand_in.url, api_key="test")
+    qa = DocumentQA(client=client, window_tokens=500, window_overlap=50, window_concurrency=3)
+    n_windows = len(qa.windows(DOCUMENT))
+    answer = qa(DOCUMENT, "what is the last sentence?")
+    assert "chars" in answer["answer"]
+    assert len(stand_in.requests) == n_windows + 1
+    reduce_document = stand_in.requests[-1][1]["document"]
+    assert f"part {n_windows} of {n_windows}" in reduce_document
+    assert state["max"] <= 3
+
+    # short documents are still sent whole.
+    qa("short document", "?")
+    assert stand_in.requests[-1][1]["document"] == "short document"
+
+
+def test_map_reduce_async_custom_reduce(stand_in):
+    tracking_handler(stand_in)
+    client = CapabilitiesClient(stand_in.url, api_key="test")
+    qa = DocumentQA(client=client)
+
+    async def reduce(query, answers):
+        return {"answers": answers}
+
+    async def main():
+        result = await qa.map_reduce_async(
+            DOCUMENT, "?", window_tokens=1000, overlap=0, concurrency=2, reduce=reduce
+        )
+        await client.aclose()
+        return result
+
+    result = asyncio.run(main())
+    assert len(result["answers"]) == len(qa.windows(DOCUMENT, 1000, 0))
+    assert len(stand_in.requests) == len(result["answers"])
+
+
+class WordHashEmbeddingModel(EmbeddingModel):
+    """Bag-of-words embeddings over whitespace tokens, so that retrieval is deterministic and offline."""
+
+    max_tokens_per_item = None
+
+    def __init__(self, dim=4096):
+        self._dim = dim
+        self._vocabulary = {}
+        self.n_encoded = 0
+
+    def tokenize(self, text):
+        return [len(w) for w in text.split(" ")]
+
+    def detokenize(self, tokens):
+        return "".join("_" * t + " " for t in tokens)
+
+    def encode(self, texts):
+        self.n_encoded += len(texts)
+        x = np.full((len(texts), self._dim), 1e-3)
+        for i, text in enumerate(texts):
+            for w in text.split():
+                w = w.strip(".?")
+                x[i, self._vocabulary.setdefault(w, len(self._vocabulary))] += 1.0
+        return x
+
+
+def test_split_passages_ranges():
+    model = WordHashEmbeddingModel()
+    passages = split_passages(DOCUMENT, "doc", 64, model)
+    assert len(passages) > 1
+    assert passages[0].substring_range.start == 0
+    assert passages[-1].substring_range.stop == len(DOCUMENT)
+    for p in passages:
+        assert p.text == DOCUMENT[p.substring_range.start : p.substring_range.stop]
+    assert len(set(p.id for p in passages)) == len(passages)
+
+
+def test_ask_retrieved(stand_in):
+    model = WordHashEmbeddingModel()
+    client = CapabilitiesClient(stand_in.url, api_key="test")
+    qa = DocumentQA(client=client, retrieval_k=2, passage_tokens=64, embedding_model=model)
+    document = Document(text=DOCUMENT, doc_id="doc", location="", digest=digest(DOCUMENT))
+
+    qa(document, "which sentence has number 1234?")
+    body = stand_in.requests[-1][1]
+    assert "sentence number 1234." in body["document"]
+    assert len(body["document"]) < len(DOCUMENT) / 10
+    assert all(
+        DOCUMENT[start:stop] in body["document"] for start, stop in body["substring_ranges"]
+    )
+
+    # the index is cached by digest: later queries against the same text only embed the query.
+    n_encoded = model.n_encoded
+    asyncio.run(qa.run_async(DOCUMENT, "sentence number 42?"))
+    assert model.n_encoded == n_encoded + 1
+    assert "sentence number 42." in stand_in.requests[-1][1]["document"]
+    assert len(qa._indexes) == 1
+
+
+def test_retrieval_counts_tokens(stand_in):
+    model = WordHashEmbeddingModel()
+    client = CapabilitiesClient(stand_in.url, api_key="test")
+    qa = DocumentQA(client=client, retrieval_k=2, passage_tokens=64, embedding_model=model)
+    # far more characters than passage_tokens, but only 20 tokens: sent whole without an index.
+    document = " ".join(["abcdefghij"] * 20)
+    qa(document, "?")
+    assert stand_in.requests[-1][1]["document"] == document
+    assert model.n_encoded == 0 and len(qa._indexes) == 0
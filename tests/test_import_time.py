@@ -0,0 +1,42 @@
+import os
+import subprocess
+import sys
+
+import capabilities
+
+BENCHMARK = os.path.join(os.path.dirname(os.path.dirname(__file__)), "benchmarks", "bench_import.py")
+
+
+def test_import_budgets():
+    result = subprocess.run(
+        [sys.executable, BENCHMARK, "--repeat", "3"], capture_output=True, text=True
+    )
+    assert result.returncode == 0, result.stdout + result.stderr
+
+
+def test_lazy_exports():
+    assert set(capabilities.__all__) <= set(dir(capabilities))
+    assert capabilities.Capability is capabilities.core.Capability
+    try:
+        capabilities.DoesNotExist
+    except AttributeError:
+        pass
+    else:
+        raise AssertionError("unknown attributes should raise AttributeError")
+
+
+def test_lazy_disk_cache(tmp_path):
+    from capabilities.search.util import LazyCache
+
+    cache = LazyCache(tmp_path / "cache")
+    calls = []
+
+    @cache.memoize()
+    def double(x):
+        calls.append(x)
+        return 2 * x
+
+    assert not (tmp_path / "cache").exists()
+    assert double(2) == double(2) == 4
+    assert calls == [2]
+    assert double.__cache_key__(2) in cache
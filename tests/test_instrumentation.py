@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import random
+
+import pytest
+from aiohttp import web
+
+from capabilities import (
+    CapabilitiesClient,
+    HistogramAggregator,
+    Instrumentation,
+    ResultCache,
+    set_instrumentation,
+)
+from capabilities.core import Summarize
+from capabilities.instrumentation import Histogram, current_metrics, get_instrumentation
+from capabilities.retry import RetryPolicy
+
+
+class Recorder(Instrumentation):
+    def __init__(self):
+        self.calls = []
+
+    def record(self, metrics):
+        self.calls.append(metrics)
+
+
+def test_histogram_quantiles():
+    h = Histogram(relative_error=0.01)
+    values = [random.uniform(0.001, 10) for _ in range(10000)] + [0.0] * 100
+    for v in values:
+        h.add(v)
+    values.sort()
+    for q in (0.5, 0.95, 0.99):
+        exact = values[int(q * (len(values) - 1))]
+        assert h.quantile(q) == pytest.approx(exact, rel=0.03)
+    assert h.quantile(0.001) == 0.0
+    assert h.count == 10100
+
+
+def test_call_metrics(stand_in):
+    state = {"n": 0}
+
+    async def handler(request, body):
+        state["n"] += 1
+        if state["n"] == 1:
+            return web.json_response({}, status=503)
+        return web.json_response({"summary": body["document"], "score": 1.0})
+
+    stand_in.handlers["/blazon/summarize"] = handler
+    recorder = Recorder()
+    client = CapabilitiesClient(
+        stand_in.url,
+        api_key="test",
+        retry=RetryPolicy(initial_delay=0.01),
+        cache=ResultCache(),
+        instrumentation=recorder,
+    )
+    summarize = Summarize(client=client)
+    assert summarize("document")["summary"] == "document"
+    assert summarize("document")["summary"] == "document"
+    first, cached = recorder.calls
+    assert first.uri == "/blazon/summarize"
+    assert first.attempts == 2 and first.retries == 1
+    assert first.request_bytes > 0 and first.response_bytes > 0
+    assert 0 < first.ttfb_seconds <= first.latency_seconds
+    assert first.serialize_seconds > 0 and first.decode_seconds > 0
+    assert cached.cached and cached.attempts == 0
+    assert current_metrics() is None
+
+    async def main():
+        await summarize.run_async("async document")
+        await client.aclose()
+
+    asyncio.run(main())
+    metrics = recorder.calls[-1]
+    assert metrics.attempts == 1 and metrics.error is None
+    assert 0 < metrics.ttfb_seconds <= metrics.latency_seconds
+
+
+def test_aggregator_summary(stand_in):
+    aggregator = HistogramAggregator()
+    set_instrumentation(aggregator)
+    try:
+        client = CapabilitiesClient(stand_in.url, api_key="test", coalesce=False)
+        summarize = Summarize(client=client)
+        for i in range(20):
+            summarize(f"document {i}")
+    finally:
+        set_instrumentation(None)
+    assert not get_instrumentation().enabled
+    summary = aggregator.summary()["/blazon/summarize"]
+    assert summary["calls"] == 20 and summary["errors"] == 0
+    latency = summary["latency_seconds"]
+    assert latency["count"] == 20
+    assert 0 < latency["p50"] <= latency["p95"] <= latency["p99"]
+    assert summary["retries"]["p99"] == 0
+
+
+def test_failing_hook_does_not_fail_calls(stand_in, caplog):
+    class Broken(Instrumentation):
+        def record(self, metrics):
+            raise RuntimeError("broken exporter")
+
+    client = CapabilitiesClient(stand_in.url, api_key="test", instrumentation=Broken())
+    with caplog.at_level(logging.ERROR, logger="capabilities"):
+        assert Summarize(client=client)("document")["score"] == 1.0
+    assert "Broken.record failed" in caplog.text
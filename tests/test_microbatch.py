@@ -0,0 +1,134 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from capabilities import CapabilitiesClient, MicroBatcher, llm
+from capabilities.core import Structured
+from capabilities.microbatch import BatchItemError
+
+
+@dataclass
+class Row:
+    text: str
+    score: float
+
+
+def echo(items=None):
+    """A batch handler answering each input with its own text, failing the inputs in `items`."""
+
+    async def handler(request, body):
+        texts = [i["text"] for i in body["inputs"]]
+        errors = [f"bad {t}" if items and t in items else None for t in texts]
+        return web.json_response(
+            {"outputs": [{"text": t, "score": 1.0} for t in texts], "errors": errors}
+        )
+
+    return handler
+
+
+def test_concurrent_calls_are_batched(stand_in):
+    client = CapabilitiesClient(stand_in.url, api_key="test")
+    batcher = MicroBatcher(max_batch_size=8, max_wait=0.2)
+    structured = Structured(client=client, batcher=batcher)
+    with ThreadPoolExecutor(8) as pool:
+        outputs = list(
+            pool.map(lambda i: structured(Row, Row, "copy", Row(f"r{i}", i)), range(8))
+        )
+    assert outputs == [Row("x", 0.5)] * 8
+    assert [path for path, _ in stand_in.requests] == ["/blazon/structured/batch"]
+    body = stand_in.requests[0][1]
+    assert sorted(i["text"] for i in body["inputs"]) == [f"r{i}" for i in range(8)]
+    assert body["instructions"] == "copy" and "input" not in body
+    assert batcher.stats.batches == batcher.stats.full_batches == 1
+    assert batcher.stats.mean_batch_size == 8
+
+
+def test_outputs_are_demultiplexed(stand_in):
+    stand_in.handlers["/blazon/structured/batch"] = echo(items={"b"})
+
+    client = CapabilitiesClient(stand_in.url, api_key="test")
+
+    @llm(client=client, batcher=MicroBatcher(max_wait=0.05))
+    def parse(text: str) -> Row:
+        """Parses the row."""
+        ...
+
+    async def main():
+        try:
+            return await asyncio.gather(
+                *(parse.run_async(t) for t in "abc"), return_exceptions=True
+            )
+        finally:
+            await client.aclose()
+
+    a, b, c = asyncio.run(main())
+    assert (a, c) == (Row("a", 1.0), Row("c", 1.0))
+    assert isinstance(b, BatchItemError) and str(b) == "bad b"
+    assert len(stand_in.requests) == 1
+
+
+def test_batch_failure_reaches_every_caller(stand_in):
+    async def short(request, body):
+        return web.json_response({"outputs": []})
+
+    stand_in.handlers["/blazon/structured/batch"] = short
+    structured = Structured(
+        client=CapabilitiesClient(stand_in.url, api_key="test"), batcher=MicroBatcher(max_wait=0.1)
+    )
+    with ThreadPoolExecutor(3) as pool:
+        futures = [pool.submit(structured, Row, Row, "copy", Row("r", 0)) for _ in range(3)]
+        for f in futures:
+            with pytest.raises(ValueError, match="answered with 0 outputs"):
+                f.result()
+
+
+def test_batches_are_split_at_max_batch_size(stand_in):
+    stand_in.handlers["/blazon/structured/batch"] = echo()
+    batcher = MicroBatcher(max_batch_size=4, max_wait=0.1)
+    client = CapabilitiesClient(stand_in.url, api_key="test")
+    structured = Structured(client=client, batcher=batcher)
+
+    async def main():
+        try:
+            return await asyncio.gather(
+                *(structured.run_async(Row, Row, "copy", Row(str(i), 0)) for i in range(10))
+            )
+        finally:
+            await client.aclose()
+
+    outputs = asyncio.run(main())
+    assert [o.text for o in outputs] == [str(i) for i in range(10)]
+    assert sorted(len(body["inputs"]) for _, body in stand_in.requests) == [2, 4, 4]
+    assert (batcher.stats.batches, batcher.stats.full_batches) == (3, 2)
+
+
+def test_async_batches_are_per_session(stand_in):
+    stand_in.handlers["/blazon/structured/batch"] = echo()
+    batcher = MicroBatcher(max_wait=0.1)
+    client = CapabilitiesClient(stand_in.url, api_key="test")
+    structured = Structured(client=client, batcher=batcher)
+
+    async def main():
+        sessions = [aiohttp.ClientSession(headers={"X-Session": name}) for name in "ab"]
+        try:
+            return await asyncio.gather(
+                *(
+                    structured.run_async(Row, Row, "copy", Row(f"{i}", 0), session=sessions[i % 2])
+                    for i in range(6)
+                )
+            )
+        finally:
+            for session in sessions:
+                await session.close()
+
+    outputs = asyncio.run(main())
+    assert [o.text for o in outputs] == [str(i) for i in range(6)]
+    sent = {
+        h["X-Session"]: [i["text"] for i in body["inputs"]]
+        for h, (_, body) in zip(stand_in.request_headers, stand_in.requests)
+    }
+    assert sent == {"a": ["0", "2", "4"], "b": ["1", "3", "5"]}
@@ -0,0 +1,74 @@
+import asyncio
+import json
+
+import pytest
+from aiohttp import web
+from pydantic import BaseModel
+
+from capabilities import CapabilitiesClient, Capability
+from capabilities.payload import PayloadTemplate, compress, dumps, loads
+from capabilities.retry import RetryPolicy
+
+
+class Row(BaseModel):
+    text: str
+
+
+def test_template_matches_full_encoding():
+    static = {"input_spec": {"text": "string"}, "output_spec": ["int"], "instructions": "é"}
+    template = PayloadTemplate(static)
+    for value in [{"text": "a"}, [], None, "x"]:
+        assert json.loads(template.render(value)) == {**static, "input": value}
+    assert json.loads(PayloadTemplate({}).render(1)) == {"input": 1}
+    with pytest.raises(ValueError):
+        PayloadTemplate({"input": 1})
+
+
+def test_compress_roundtrip():
+    body = dumps({"document": "a" * 10000})
+    for encoding in ["gzip", "deflate", None]:
+        data = compress(body, encoding)
+        assert len(data) < len(body) or encoding is None
+    assert loads(body) == {"document": "a" * 10000}
+
+
+def test_large_documents_are_sent_gzipped(stand_in):
+    client = CapabilitiesClient(stand_in.url, api_key="test", compression="gzip")
+    document = "lorem ipsum " * 10000
+    c = Capability("blazon/document_qa", client=client)
+    assert c(document, "what?") == {"answer": "answer to what?"}
+    assert c("short", "what?") == {"answer": "answer to what?"}
+
+    async def main():
+        r = await c.run_async(document, "why?")
+        await client.aclose()
+        return r
+
+    assert asyncio.run(main()) == {"answer": "answer to why?"}
+    encodings = [h.get("Content-Encoding") for h in stand_in.request_headers]
+    assert encodings == ["gzip", None, "gzip"]
+    assert stand_in.requests[0][1]["document"] == document
+
+
+def test_falls_back_when_compression_rejected(stand_in):
+    async def no_gzip(request, body):
+        if request.headers.get("Content-Encoding"):
+            return web.json_response({}, status=415)
+        return web.json_response({"summary": "ok", "score": 1.0})
+
+    stand_in.handlers["/blazon/summarize"] = no_gzip
+    client = CapabilitiesClient(
+        stand_in.url, api_key="test", retry=RetryPolicy(max_retries=0), compression="gzip"
+    )
+    c = Capability("blazon/summarize", client=client)
+    for _ in range(3):
+        assert c("x" * 10000)["summary"] == "ok"
+    encodings = [h.get("Content-Encoding") for h in stand_in.request_headers]
+    assert encodings == ["gzip", None, None, None]
+
+
+def test_bodies_are_uncompressed_by_default(stand_in):
+    client = CapabilitiesClient(stand_in.url, api_key="test")
+    c = Capability("blazon/document_qa", client=client)
+    assert c("lorem ipsum " * 10000, "what?") == {"answer": "answer to what?"}
+    assert stand_in.request_headers[0].get("Content-Encoding") is None
@@ -0,0 +1,112 @@
+import asyncio
+import time
+from dataclasses import dataclass
+
+import pytest
+
+from capabilities import CapabilitiesClient, Pipeline, llm
+from capabilities.cache import ResultCache
+from capabilities.pipeline import PipelineError
+
+
+def sleeper(seconds, value):
+    def step(*args, **kwargs):
+        time.sleep(seconds)
+        return value
+
+    return step
+
+
+def test_independent_steps_run_concurrently():
+    p = Pipeline(inputs=["x"])
+    p.add("a", sleeper(0.1, 1), "x")
+    p.add("b", sleeper(0.1, 2), "x")
+    p.add("c", sleeper(0.05, 3), "a")
+    p.add("d", lambda a, b, c: a + b + c, "a", "b", c="c")
+    run = p.run(x=0)
+    assert run["d"] == 6
+    assert run.wall_seconds < 0.25
+    assert run.critical_path == ["a", "c", "d"]
+    assert run.critical_path_seconds == pytest.approx(0.15, abs=0.04)
+    assert "critical path" in run.report()
+
+
+def test_outputs_prune_and_cache_reuse():
+    calls = []
+
+    @dataclass
+    class Row:
+        text: str
+
+    def upper(row):
+        calls.append(row.text)
+        return Row(row.text.upper())
+
+    p = Pipeline(inputs=["row"], cache=ResultCache())
+    p.add("upper", upper, "row")
+    p.add("unused", sleeper(1.0, None), "row")
+    first = p.run(["upper"], row=Row("a"))["upper"]
+    assert first == Row("A")
+    # mutating an output doesn't change the cached one.
+    first.text = "changed"
+    run = p.run(["upper"], row=Row("a"))
+    assert run["upper"] == Row("A") and run.timings["upper"].cached
+    assert "unused" not in run.timings
+    p.run(["upper"], row=Row("b"))
+    assert calls == ["a", "b"]
+
+
+def test_cache_is_keyed_by_function_and_version():
+    cache = ResultCache()
+
+    def upper(text):
+        return text.upper()
+
+    def lower(text):
+        return text.lower()
+
+    outputs = []
+    for fn, version in [(upper, None), (lower, None), (upper, "2"), (upper, "2")]:
+        p = Pipeline(inputs=["text"], cache=cache)
+        p.add("out", fn, "text", version=version)
+        run = p.run(text="Ab")
+        outputs.append((run["out"], run.timings["out"].cached))
+    assert outputs == [("AB", False), ("ab", False), ("AB", False), ("AB", True)]
+
+
+def test_failures_and_validation():
+    p = Pipeline(inputs=["x"])
+    with pytest.raises(ValueError, match="unknown"):
+        p.add("a", abs, "y")
+    p.add("a", lambda x: 1 / x, "x")
+    p.add("b", abs, "a")
+    with pytest.raises(TypeError, match="missing inputs"):
+        p.run()
+    with pytest.raises(PipelineError, match="'a'") as e:
+        p.run(x=0)
+    assert isinstance(e.value.__cause__, ZeroDivisionError)
+    assert "b" not in e.value.run.results
+
+
+def test_run_async_with_ai_functions(stand_in):
+    client = CapabilitiesClient(stand_in.url, api_key="test")
+
+    @llm(client=client)
+    def count_words(text: str) -> int:
+        """Counts the words."""
+        ...
+
+    p = Pipeline(inputs=["text"])
+    p.add("count", count_words, "text")
+    p.add("double", lambda n: 2 * n, "count")
+
+    async def main():
+        try:
+            return await p.run_async(text="a b c")
+        finally:
+            await client.aclose()
+
+    run = asyncio.run(main())
+    assert run["double"] == 2
+    assert run.critical_path == ["count", "double"]
+    assert [path for path, _ in stand_in.requests] == ["/blazon/structured"]
@@ -0,0 +1,122 @@
+import asyncio
+import threading
+import time
+
+from aiohttp import web
+import pytest
+
+from capabilities import AdaptiveLimiter, CapabilitiesClient, RateLimiter, set_rate_limiter
+from capabilities.core import Summarize
+import capabilities.client
+from capabilities.ratelimit import TokenBucket
+from capabilities.retry import RetryPolicy
+
+
+def test_token_bucket_reservations():
+    bucket = TokenBucket(rate=10, capacity=2)
+    assert bucket.reserve(1) == 0
+    assert bucket.reserve(1) == 0
+    assert bucket.reserve(1) == pytest.approx(0.1, abs=0.01)
+    # reservations larger than the capacity wait for the debt to be refilled.
+    assert bucket.reserve(5) == pytest.approx(0.6, abs=0.01)
+
+
+def test_requests_and_tokens_per_minute():
+    limiter = RateLimiter(requests_per_minute=6000, burst_seconds=0.01)
+    start = time.monotonic()
+    for _ in range(11):
+        limiter.acquire()
+    assert time.monotonic() - start >= 0.09
+    assert limiter.stats.calls == 11
+    assert limiter.stats.delayed == 10
+
+    limiter = RateLimiter(tokens_per_minute=60000, burst_seconds=0.01, tokenizer=len)
+    assert limiter.cost(b"x" * 100) == 100
+    assert limiter.acquire(10) == 0
+    assert limiter.acquire(100) == pytest.approx(0.1, abs=0.01)
+    assert limiter.stats.tokens == 110
+    assert RateLimiter(requests_per_minute=60).cost("not counted") == 0
+
+
+def test_client_waits_on_limiter(stand_in):
+    limiter = RateLimiter(requests_per_minute=1200, burst_seconds=0.05, tokenizer=len)
+    client = CapabilitiesClient(stand_in.url, api_key="test", rate_limiter=limiter)
+    summarize = Summarize(client=client)
+    start = time.monotonic()
+    for i in range(5):
+        summarize(f"document {i}")
+    assert time.monotonic() - start >= 0.2
+    assert limiter.stats.calls == 5
+
+    async def main():
+        await asyncio.gather(*(summarize.run_async(f"async document {i}") for i in range(5)))
+        await client.aclose()
+
+    start = time.monotonic()
+    asyncio.run(main())
+    assert time.monotonic() - start >= 0.2
+    assert limiter.stats.calls == 10
+
+
+def test_process_wide_limiter(stand_in):
+    limiter = RateLimiter(requests_per_minute=600)
+    set_rate_limiter(limiter)
+    try:
+        client = CapabilitiesClient(stand_in.url, api_key="test")
+        Summarize(client=client)("document")
+    finally:
+        set_rate_limiter(None)
+    assert limiter.stats.calls == 1
+
+
+def test_rate_limit_wait_is_not_measured_as_latency(stand_in):
+    limiter = RateLimiter(requests_per_minute=600, burst_seconds=0.01)
+    adaptive = AdaptiveLimiter(initial_limit=4)
+    client = CapabilitiesClient(
+        stand_in.url, api_key="test", rate_limiter=limiter, concurrency_limiter=adaptive
+    )
+    summarize = Summarize(client=client)
+    for i in range(4):
+        summarize(f"document {i}")
+    assert limiter.stats.delayed == 3
+    # each call waited 0.1 s for the rate limiter, outside its concurrency slot.
+    assert adaptive.baseline_latency < 0.05
+    assert adaptive.stats.spikes == 0
+
+
+def test_tokens_are_counted_once_per_call_off_the_loop(stand_in, monkeypatch):
+    statuses = [503, 503]
+
+    async def handler(request, body):
+        if statuses:
+            return web.json_response({}, status=statuses.pop(0))
+        return web.json_response({"summary": body["document"], "score": 1.0})
+
+    stand_in.handlers["/blazon/summarize"] = handler
+    counted = []
+
+    def tokenizer(text):
+        counted.append(threading.get_ident())
+        return len(text)
+
+    limiter = RateLimiter(tokens_per_minute=10**9, tokenizer=tokenizer)
+    client = CapabilitiesClient(
+        stand_in.url, api_key="test", rate_limiter=limiter, retry=RetryPolicy(initial_delay=0.01)
+    )
+    summarize = Summarize(client=client)
+    summarize("document")
+    assert len(stand_in.requests) == 3 and len(counted) == 1
+    assert limiter.stats.calls == 3
+
+    # large bodies are tokenized on a worker thread rather than on the event loop.
+    monkeypatch.setattr(capabilities.client, "OFFLOAD_COMPRESSION_BYTES", 0)
+    statuses.extend([503, 503])
+
+    async def main():
+        await summarize.run_async("another document")
+        await client.aclose()
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(main())
+    assert len(stand_in.requests) == 6 and len(counted) == 2
+    assert counted[1] != loop_thread
@@ -0,0 +1,207 @@
+import asyncio
+import threading
+import time
+
+from aiohttp import web
+import pytest
+import requests
+
+from capabilities import CapabilitiesClient, Capability
+from capabilities.core import Summarize
+import capabilities.resilience
+from capabilities.resilience import CallPolicy, CircuitBreaker, CircuitOpenError, LatencyTracker
+from capabilities.retry import DeadlineExceeded, RetryError, RetryPolicy
+
+
+def summaries(stand_in, delays):
+    """Serves summaries, sleeping for the next of `delays` (then 0) before each response."""
+    delays = list(delays)
+
+    async def handler(request, body):
+        await asyncio.sleep(delays.pop(0) if delays else 0)
+        return web.json_response({"summary": body["document"], "score": 1.0})
+
+    stand_in.handlers["/blazon/summarize"] = handler
+
+
+def test_deadline(stand_in):
+    summaries(stand_in, [1.0, 1.0, 1.0])
+    client = CapabilitiesClient(stand_in.url, api_key="test", retry=RetryPolicy(initial_delay=0.01))
+    policy = CallPolicy(timeout=0.3)
+    summarize = Summarize(client=client, policy=policy)
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        summarize("doc")
+    assert time.monotonic() - start < 0.8
+
+    async def main():
+        try:
+            await summarize.run_async("doc")
+        finally:
+            await client.aclose()
+
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(main())
+    assert policy.stats.deadlines_exceeded == 2
+
+
+def test_attempt_timeout_is_retried(stand_in):
+    summaries(stand_in, [1.0])
+    client = CapabilitiesClient(stand_in.url, api_key="test", retry=RetryPolicy(initial_delay=0.01))
+    summarize = Summarize(client=client, policy=CallPolicy(timeout=5.0, attempt_timeout=0.2))
+    assert summarize("doc")["summary"] == "doc"
+    assert len(stand_in.requests) == 2
+
+
+def test_hedging(stand_in):
+    summaries(stand_in, [1.0])
+    client = CapabilitiesClient(stand_in.url, api_key="test")
+    policy = CallPolicy(hedge=True, hedge_after=0.05)
+    summarize = Summarize(client=client, policy=policy)
+    start = time.monotonic()
+    assert summarize("doc")["summary"] == "doc"
+    assert time.monotonic() - start < 0.8
+    assert policy.stats.hedges == 1 and policy.stats.hedge_wins == 1
+
+    summaries(stand_in, [1.0])
+
+    async def main():
+        try:
+            return await summarize.run_async("doc")
+        finally:
+            await client.aclose()
+
+    start = time.monotonic()
+    assert asyncio.run(main())["summary"] == "doc"
+    assert time.monotonic() - start < 0.8
+    assert policy.stats.hedges == 2 and policy.stats.hedge_wins == 2
+
+
+def test_hedging_is_skipped_when_the_executor_is_busy(stand_in, monkeypatch):
+    monkeypatch.setattr(capabilities.resilience, "_hedge_slots", threading.BoundedSemaphore(1))
+    summaries(stand_in, [0.3])
+    client = CapabilitiesClient(stand_in.url, api_key="test")
+    policy = CallPolicy(hedge=True, hedge_after=0.05)
+    summarize = Summarize(client=client, policy=policy)
+    assert summarize("doc")["summary"] == "doc"
+    # the first attempt took the only worker: it wasn't hedged, and answered after its full 0.3 s.
+    assert policy.stats.hedges == 0 and policy.stats.hedges_skipped == 1
+    assert len(stand_in.requests) == 1
+
+
+def test_hedge_delay_follows_latency_quantile():
+    tracker = LatencyTracker()
+    assert tracker.quantile(0.95) is None
+    for i in range(100):
+        tracker.add(i / 100)
+    assert tracker.quantile(0.95) == pytest.approx(0.95)
+
+    policy = CallPolicy(hedge=True, hedge_min_samples=10)
+    assert policy.hedge_delay("host") is None
+    for i in range(10):
+        policy.latencies("host").add(0.1)
+    assert policy.hedge_delay("host") == pytest.approx(0.1)
+    assert CallPolicy().hedge_delay("host") is None
+
+
+def test_circuit_breaker(stand_in):
+    state = {"status": 503}
+
+    async def handler(request, body):
+        if state["status"] != 200:
+            return web.json_response({}, status=state["status"])
+        return web.json_response({"summary": body["document"], "score": 1.0})
+
+    stand_in.handlers["/blazon/summarize"] = handler
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=0.2)
+    client = CapabilitiesClient(stand_in.url, api_key="test", retry=RetryPolicy(max_retries=0))
+    summarize = Summarize(client=client, policy=CallPolicy(breaker=breaker))
+    for _ in range(3):
+        with pytest.raises(RetryError):
+            summarize("doc")
+    with pytest.raises(CircuitOpenError):
+        summarize("doc")
+    assert len(stand_in.requests) == 3
+    assert breaker.state(client.url("").split("/")[2]) == "open"
+    assert breaker.stats.opened == 1 and breaker.stats.rejected == 1
+
+    time.sleep(0.25)
+    state["status"] = 200
+    assert summarize("doc")["summary"] == "doc"
+    assert breaker.stats.opened == 1
+    # client errors don't count against the backend.
+    state["status"] = 400
+    for _ in range(5):
+        with pytest.raises(Exception):
+            summarize("doc")
+    state["status"] = 200
+    assert summarize("doc")["summary"] == "doc"
+
+
+def test_breaker_counts_calls_not_attempts(stand_in):
+    async def handler(request, body):
+        return web.json_response({}, status=503)
+
+    stand_in.handlers["/blazon/summarize"] = handler
+    breaker = CircuitBreaker()
+    retry = RetryPolicy(initial_delay=0.001)
+    assert retry.max_retries + 1 > breaker.failure_threshold
+    client = CapabilitiesClient(stand_in.url, api_key="test", retry=retry)
+    summarize = Summarize(client=client, policy=CallPolicy(breaker=breaker))
+    # every retry of a single call fails, and the call still gives up on its retries.
+    with pytest.raises(RetryError):
+        summarize("doc")
+    assert len(stand_in.requests) == retry.max_retries + 1
+
+    async def main():
+        try:
+            await summarize.run_async("doc")
+        finally:
+            await client.aclose()
+
+    with pytest.raises(RetryError):
+        asyncio.run(main())
+    assert len(stand_in.requests) == 2 * (retry.max_retries + 1)
+    assert breaker.state(client.url("").split("/")[2]) == "closed" and breaker.stats.opened == 0
+
+
+def test_breaker_ignores_errors_without_a_response():
+    def http_error(status):
+        response = requests.Response()
+        response.status_code = status
+        return requests.HTTPError(response=response)
+
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    for error in [http_error(503), ValueError("caller bug"), DeadlineExceeded("dropped"), http_error(503)]:
+        breaker.before_call("k")
+        breaker.record("k", error)
+    # the errors without a response neither reset the count of failures nor close the circuit.
+    assert breaker.state("k") == "open"
+    time.sleep(0.06)
+    breaker.before_call("k")
+    breaker.record("k", DeadlineExceeded("dropped"))
+    assert breaker.state("k") == "half_open"
+    # the trial was released, so another one is let through.
+    breaker.before_call("k")
+    breaker.record("k", http_error(404))
+    assert breaker.state("k") == "closed"
+
+
+def test_registry_policies(stand_in):
+    client = CapabilitiesClient(stand_in.url, api_key="test")
+    c = Capability("blazon/summarize", client=client)
+    assert c._capability.policy is Capability("blazon/summarize")._capability.policy
+    assert c._capability.policy.timeout is not None
+    assert c._capability.policy.breaker is not None
+    assert c("document")["summary"] == "document"
+
+
+def test_capability_policy_overrides_the_registry(stand_in):
+    summaries(stand_in, [1.0, 1.0, 1.0])
+    client = CapabilitiesClient(stand_in.url, api_key="test", retry=RetryPolicy(initial_delay=0.01))
+    policy = CallPolicy(timeout=0.3)
+    c = Capability("blazon/summarize", client=client, policy=policy)
+    assert c._capability.policy is policy and c._capability.client is client
+    with pytest.raises(DeadlineExceeded):
+        c("doc")
+    assert policy.stats.deadlines_exceeded == 1
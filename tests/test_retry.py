@@ -0,0 +1,110 @@
+import asyncio
+import time
+
+import pytest
+import requests
+from aiohttp import web
+from pydantic import BaseModel
+
+from capabilities import CapabilitiesClient, Capability
+from capabilities.retry import RetryError, RetryPolicy, is_retryable, last_attempts
+
+
+class Row(BaseModel):
+    text: str
+
+
+def http_error(status, headers=None):
+    resp = requests.Response()
+    resp.status_code = status
+    resp.headers.update(headers or {})
+    return requests.HTTPError(response=resp)
+
+
+def test_is_retryable():
+    assert is_retryable(http_error(429))
+    assert is_retryable(http_error(503))
+    assert is_retryable(requests.ConnectionError())
+    assert not is_retryable(http_error(400))
+    assert not is_retryable(http_error(404))
+    assert not is_retryable(KeyError())
+
+
+def test_delay_full_jitter_and_retry_after():
+    policy = RetryPolicy(initial_delay=1.0, exponential_base=2.0, max_delay=5.0)
+    for retry in range(6):
+        assert 0 <= policy.delay(retry) <= min(5.0, 2.0**retry)
+    assert policy.delay(0, http_error(429, {"Retry-After": "3"})) >= 3.0
+    assert policy.delay(0, http_error(429, {"Retry-After": "300"})) == 5.0
+
+
+def test_does_not_retry_client_errors():
+    calls = []
+
+    def f():
+        calls.append(1)
+        raise http_error(400)
+
+    policy = RetryPolicy(initial_delay=0)
+    with pytest.raises(requests.HTTPError):
+        policy.call(f)
+    assert len(calls) == 1
+    assert policy.stats.retries == 0
+
+
+def test_gives_up_after_max_retries():
+    policy = RetryPolicy(max_retries=3, initial_delay=0)
+
+    def f():
+        raise http_error(500)
+
+    with pytest.raises(RetryError) as info:
+        policy.call(f)
+    assert info.value.attempts == 4
+    assert policy.stats.retries == 3
+    assert policy.stats.failures == 1
+
+
+def test_async_retry_does_not_block_loop():
+    policy = RetryPolicy(max_retries=1, initial_delay=0.2, jitter=False)
+    ticks = []
+    attempts = []
+
+    async def flaky():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise http_error(503)
+        return "ok"
+
+    async def ticker():
+        for _ in range(4):
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.05)
+
+    async def main():
+        return await asyncio.gather(policy.call_async(flaky), ticker())
+
+    result, _ = asyncio.run(main())
+    assert result == "ok"
+    assert len(ticks) == 4 and len(attempts) == 2
+    # the ticker kept running while the retry was backing off.
+    assert sum(attempts[0] < t < attempts[1] for t in ticks) >= 2
+
+
+def test_client_retries_structured(stand_in):
+    failures = []
+
+    async def flaky(request, body):
+        if len(failures) < 2:
+            failures.append(1)
+            return web.json_response({}, status=503, headers={"Retry-After": "0"})
+        return web.json_response({"output": {"text": "ok"}})
+
+    stand_in.handlers["/blazon/structured"] = flaky
+    policy = RetryPolicy(initial_delay=0.01)
+    client = CapabilitiesClient(stand_in.url, api_key="test", retry=policy)
+    c = Capability("blazon/structured", client=client)
+    assert c(Row, Row, "copy", Row(text="x")) == Row(text="ok")
+    assert last_attempts() == 3
+    assert policy.stats.retries == 2
+    client.close()
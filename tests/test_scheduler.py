@@ -0,0 +1,156 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+
+from capabilities import CapabilitiesClient, Priority, Scheduler, scheduling
+from capabilities.core import Summarize
+from capabilities.retry import DeadlineExceeded
+
+
+async def admitted_order(scheduler, calls):
+    """Queues `calls` of (name, priority, tenant) behind a held slot and returns the order they start in."""
+    order = []
+
+    async def call(name, priority, tenant):
+        with scheduling(priority=priority, tenant=tenant):
+            await scheduler.call_async(asyncio.sleep, 0, name)
+        order.append(name)
+
+    await scheduler.acquire_async()
+    tasks = []
+    for c in calls:
+        tasks.append(asyncio.ensure_future(call(*c)))
+        await asyncio.sleep(0)
+    assert scheduler.queued() == len(calls)
+    scheduler.release()
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_higher_priority_first():
+    scheduler = Scheduler(max_in_flight=1)
+    calls = [
+        ("low", Priority.LOW, "a"),
+        ("normal", Priority.NORMAL, "a"),
+        ("high 1", Priority.HIGH, "a"),
+        ("high 2", Priority.HIGH, "a"),
+    ]
+    order = asyncio.run(admitted_order(scheduler, calls))
+    assert order == ["high 1", "high 2", "normal", "low"]
+    assert scheduler.stats.started_by_priority[Priority.LOW] == 1
+    assert scheduler.in_flight == 0
+
+
+def test_tenants_share_fairly():
+    scheduler = Scheduler(max_in_flight=1)
+    calls = [(f"a{i}", Priority.LOW, "a") for i in range(4)]
+    calls += [(f"b{i}", Priority.LOW, "b") for i in range(2)]
+    order = asyncio.run(admitted_order(scheduler, calls))
+    assert order == ["a0", "b0", "a1", "b1", "a2", "a3"]
+
+
+def test_late_calls_are_dropped_unsent():
+    scheduler = Scheduler(max_in_flight=1)
+    scheduler.call(lambda: None)
+    scheduler.expected_latency = 1.0
+    sent = []
+    with scheduling(timeout=0.5):
+        with pytest.raises(DeadlineExceeded):
+            scheduler.call(sent.append, "late")
+    with scheduling(timeout=5):
+        scheduler.call(sent.append, "in time")
+    assert sent == ["in time"]
+
+    async def main():
+        # a queued call is dropped once it can no longer finish in time.
+        scheduler.expected_latency = 0.05
+        await scheduler.acquire_async()
+        with scheduling(timeout=0.1):
+            with pytest.raises(DeadlineExceeded):
+                await scheduler.call_async(asyncio.sleep, 0)
+        assert scheduler.queued() == 0
+        scheduler.release()
+
+    asyncio.run(main())
+    assert scheduler.stats.dropped == 2
+    assert scheduler.in_flight == 0
+
+
+def test_slot_granted_as_the_wait_times_out_is_kept():
+    scheduler = Scheduler(max_in_flight=1)
+    time_out = scheduler._time_out
+
+    def granted_then_time_out(w):
+        # the holder releases its slot to the waiter between its timeout and the timeout's handling,
+        # and the waiter still fits before its deadline.
+        scheduler.expected_latency = 0.0
+        scheduler.release()
+        time_out(w)
+
+    scheduler._time_out = granted_then_time_out
+    in_flight = []
+
+    async def main():
+        await scheduler.acquire_async()
+        scheduler.expected_latency = 0.05
+        with scheduling(timeout=0.1):
+            await scheduler.call_async(lambda: asyncio.sleep(0, in_flight.append(scheduler.in_flight)))
+
+    scheduler.acquire()
+    scheduler.expected_latency = 0.05
+    with scheduling(timeout=0.1):
+        scheduler.call(lambda: in_flight.append(scheduler.in_flight))
+    assert scheduler.in_flight == 0
+    asyncio.run(main())
+    # each call ran in the slot it was granted, and released it once.
+    assert in_flight == [1, 1]
+    assert scheduler.in_flight == 0 and scheduler.stats.dropped == 0
+
+
+def test_cancelled_waiter_gives_up_its_place():
+    scheduler = Scheduler(max_in_flight=1)
+
+    async def main():
+        await scheduler.acquire_async()
+        task = asyncio.ensure_future(scheduler.call_async(asyncio.sleep, 0))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert scheduler.queued() == 0
+        scheduler.release()
+        await scheduler.call_async(asyncio.sleep, 0)
+
+    asyncio.run(main())
+    assert scheduler.in_flight == 0
+
+
+def test_single_calls_overtake_batches(stand_in):
+    received = []
+
+    async def handler(request, body):
+        received.append(body["document"])
+        await asyncio.sleep(0.02)
+        return web.json_response({"summary": body["document"], "score": 1.0})
+
+    stand_in.handlers["/blazon/summarize"] = handler
+    scheduler = Scheduler(max_in_flight=2)
+    client = CapabilitiesClient(stand_in.url, api_key="test", scheduler=scheduler)
+    summarize = Summarize(client=client)
+
+    async def main():
+        batch = asyncio.ensure_future(
+            summarize.run_many([f"batch {i}" for i in range(10)], concurrency=10)
+        )
+        await asyncio.sleep(0.03)
+        await summarize.run_async("interactive")
+        results = await batch
+        await client.aclose()
+        return results
+
+    results = asyncio.run(main())
+    assert all(r.ok for r in results)
+    assert received.index("interactive") < 6
+    assert scheduler.stats.started_by_priority[Priority.HIGH] == 1
+    assert scheduler.stats.started_by_priority[Priority.LOW] == 10
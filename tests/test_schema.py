@@ -0,0 +1,98 @@
+from dataclasses import dataclass, field
+from typing import Optional
+
+import dacite
+import pytest
+from pydantic import BaseModel
+
+from capabilities.core import _of_dict, _to_dict, flatten_model, of_dict, to_dict
+
+
+@dataclass
+class Leaf:
+    name: str
+    weight: float
+    tags: list[str]
+
+
+@dataclass
+class Tree:
+    root: Leaf
+    leaves: list[Leaf]
+    depth: int = 0
+
+
+@dataclass
+class WithOptional:
+    note: Optional[str]
+
+
+class Model(BaseModel):
+    trees: list[Tree]
+    flag: bool
+
+
+TREE = {
+    "root": {"name": "r", "weight": 1, "tags": []},
+    "leaves": [{"name": str(i), "weight": i / 2, "tags": ["a", "b"]} for i in range(5)],
+    "depth": 3,
+}
+
+
+@pytest.mark.parametrize(
+    "t,d",
+    [
+        (Tree, TREE),
+        (list[Tree], [TREE, TREE]),
+        (Model, {"trees": [TREE], "flag": True}),
+        (list[list[int]], [[1, 2], [3]]),
+        (list, [1, "a"]),
+        (WithOptional, {"note": None}),
+        (Tree, {k: v for k, v in TREE.items() if k != "depth"}),
+    ],
+)
+def test_of_dict_matches_reference(t, d):
+    assert of_dict(t, d) == _of_dict(t, d)
+
+
+@pytest.mark.parametrize(
+    "t,d",
+    [
+        (Tree, {**TREE, "depth": "deep"}),
+        (Tree, {"root": TREE["root"]}),
+        (list[Leaf], [{"name": 1, "weight": 1.0, "tags": []}]),
+        (list[int], ["a"]),
+        (set, []),
+    ],
+)
+def test_of_dict_errors_match_reference(t, d):
+    with pytest.raises(Exception) as expected:
+        _of_dict(t, d)
+    with pytest.raises(type(expected.value)) as actual:
+        of_dict(t, d)
+    assert str(actual.value) == str(expected.value)
+
+
+def test_of_dict_dacite_error_type():
+    with pytest.raises(dacite.WrongTypeError):
+        of_dict(Tree, {**TREE, "depth": "deep"})
+
+
+def test_to_dict_matches_reference():
+    tree = of_dict(Tree, TREE)
+    model = of_dict(Model, {"trees": [TREE], "flag": False})
+    for obj in [tree, [tree, tree], model, {"a": [model]}, "x", 1, 2.0, True]:
+        assert to_dict(obj) == _to_dict(obj)
+    with pytest.raises(TypeError, match="unsupported datatype"):
+        to_dict({1, 2})
+
+
+def test_flatten_model_cached():
+    assert flatten_model(Tree) is flatten_model(Tree)
+    assert flatten_model(Tree) == {
+        "root": {"name": "string", "weight": "float", "tags": ["string"]},
+        "leaves": [{"name": "string", "weight": "float", "tags": ["string"]}],
+        "depth": "int",
+    }
+    with pytest.raises(TypeError, match="unsupported datatype"):
+        flatten_model(WithOptional)
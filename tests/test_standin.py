@@ -0,0 +1,50 @@
+import random
+import time
+
+import pytest
+import requests
+
+from capabilities import CapabilitiesClient, Capability
+from capabilities.retry import RetryError, RetryPolicy
+from capabilities.standin import StandInServer, lognormal, uniform
+
+
+def test_latency_distributions():
+    rng = random.Random(0)
+    assert all(0.1 <= uniform(0.1, 0.2)(rng) <= 0.2 for _ in range(100))
+    draws = sorted(lognormal(0.05, 0.5)(rng) for _ in range(1001))
+    assert draws[500] == pytest.approx(0.05, rel=0.15)
+
+
+def test_injected_errors_and_throttling():
+    with StandInServer(throttle_rate=1.0, retry_after=0.01, latency=0.05) as server:
+        resp = requests.post(f"{server.url}/blazon/summarize", json={"document": "d"})
+        assert resp.status_code == 429
+        assert resp.headers["Retry-After"] == "0.01"
+        assert resp.elapsed.total_seconds() >= 0.05
+    with StandInServer(error_rate=1.0, record=False) as server:
+        client = CapabilitiesClient(
+            server.url, api_key="test", retry=RetryPolicy(max_retries=1, initial_delay=0.01)
+        )
+        with pytest.raises(RetryError):
+            Capability("blazon/summarize", client=client)("d")
+        assert server.requests == []
+    with StandInServer(error_rate=0.3, seed=0) as server:
+        client = CapabilitiesClient(
+            server.url, api_key="test", retry=RetryPolicy(initial_delay=0.01)
+        )
+        summarize = Capability("blazon/summarize", client=client)
+        assert all(r.ok for r in summarize.map([f"doc {i}" for i in range(20)]))
+        assert client.retry.stats.retries > 0
+
+
+def test_streams_deltas():
+    with StandInServer(latency=0.08, stream_chunks=4) as server:
+        client = CapabilitiesClient(server.url, api_key="test")
+        stream = Capability("blazon/summarize", client=client).stream("a long enough document")
+        start = time.monotonic()
+        first = next(stream)
+        assert time.monotonic() - start < 0.07
+        chunks = [first, *stream]
+        assert len(chunks) == 4
+        assert "".join(chunks) == stream.result["summary"] == "a long eno"
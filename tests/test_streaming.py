@@ -0,0 +1,123 @@
+import asyncio
+import json
+import time
+
+from aiohttp import web
+
+from capabilities import CapabilitiesClient, Capability, Instrumentation
+from capabilities.instrumentation import current_metrics
+from capabilities.streaming import StreamParser
+
+WORDS = ["the ", "quick ", "brown ", "fox"]
+
+
+class Recorder(Instrumentation):
+    def __init__(self):
+        self.calls = []
+
+    def record(self, metrics):
+        self.calls.append(metrics)
+
+
+def sse_handler(delay):
+    async def handler(request, body):
+        assert body["stream"] is True
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        for w in WORDS:
+            await resp.write(f"data: {json.dumps({'delta': w})}\n\n".encode())
+            await asyncio.sleep(delay)
+        result = {"summary": "".join(WORDS), "score": 0.9}
+        await resp.write(f"event: result\ndata: {json.dumps(result)}\n\n".encode())
+        await resp.write(b"data: [DONE]\n\n")
+        return resp
+
+    return handler
+
+
+async def ndjson_handler(request, body):
+    resp = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await resp.prepare(request)
+    for w in WORDS:
+        await resp.write((json.dumps({"delta": w}) + "\n").encode())
+    return resp
+
+
+def test_parser_sse_multiline_and_comments():
+    parser = StreamParser("text/event-stream")
+    lines = [": keepalive", "data: plain", "data: text", "", "event: result", 'data: {"a": 1}', ""]
+    events = [e for e in map(parser.feed, lines) if e is not None]
+    assert events == [("delta", "plain\ntext"), ("result", {"a": 1})]
+
+
+def test_summarize_stream(stand_in):
+    stand_in.handlers["/blazon/summarize"] = sse_handler(delay=0.1)
+    client = CapabilitiesClient(stand_in.url, api_key="test")
+    c = Capability("blazon/summarize", client=client)
+    start = time.monotonic()
+    stream = c.stream("a long document")
+    first = next(stream)
+    time_to_first_chunk = time.monotonic() - start
+    rest = list(stream)
+    assert [first, *rest] == WORDS
+    assert time_to_first_chunk < 0.3
+    assert stream.text == "".join(WORDS)
+    assert stream.result == {"summary": "".join(WORDS), "score": 0.9}
+
+
+def test_document_qa_astream(stand_in):
+    stand_in.handlers["/blazon/documentqa"] = ndjson_handler
+    client = CapabilitiesClient(stand_in.url, api_key="test")
+    c = Capability("blazon/document_qa", client=client)
+
+    async def main():
+        stream = c.astream("doc", "query")
+        chunks = [chunk async for chunk in stream]
+        await client.aclose()
+        return chunks, stream.result
+
+    chunks, result = asyncio.run(main())
+    assert chunks == WORDS
+    assert result == {"answer": "".join(WORDS)}
+
+
+def test_stream_falls_back_to_json(stand_in):
+    client = CapabilitiesClient(stand_in.url, api_key="test")
+    stream = Capability("blazon/summarize", client=client).stream("0123456789abc")
+    assert list(stream) == ["0123456789"]
+    assert stream.result == {"summary": "0123456789", "score": 1.0}
+
+
+def test_streams_are_instrumented(stand_in):
+    async def slow_first_chunk(request, body):
+        resp = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await resp.prepare(request)
+        await asyncio.sleep(0.2)
+        for w in WORDS:
+            await resp.write((json.dumps({"delta": w}) + "\n").encode())
+        return resp
+
+    stand_in.handlers["/blazon/documentqa"] = slow_first_chunk
+    recorder = Recorder()
+    client = CapabilitiesClient(stand_in.url, api_key="test", instrumentation=recorder)
+    c = Capability("blazon/document_qa", client=client)
+    assert list(c.stream("doc", "query")) == WORDS
+    # a stream that is dropped early is recorded without an error.
+    stream = c.stream("doc", "query")
+    next(stream)
+    del stream
+
+    async def main():
+        chunks = [chunk async for chunk in c.astream("doc", "query")]
+        await client.aclose()
+        return chunks
+
+    assert asyncio.run(main()) == WORDS
+    assert len(recorder.calls) == 3
+    for metrics in recorder.calls:
+        assert metrics.uri == "/blazon/documentqa" and metrics.attempts == 1
+        # the headers came at once, the first chunk 0.2 s later.
+        assert 0.2 <= metrics.ttfb_seconds <= metrics.latency_seconds
+        assert metrics.request_bytes > 0 and metrics.serialize_seconds > 0
+        assert metrics.error is None
+    assert current_metrics() is None
@@ -1,5 +1,37 @@
-from capabilities.search import SimpleVectorIndex, topk
+import pickle
+import threading
+
+from capabilities.search import (
+    BinaryVectorIndex,
+    EmbeddingModel,
+    IVFVectorIndex,
+    MemmapVectorIndex,
+    Passage,
+    QuantizedVectorIndex,
+    SearchIndex,
+    SimpleVectorIndex,
+    topk,
+)
+from capabilities.search.ivf_vector_index import kmeans
+from capabilities.search.binary_vector_index import _popcount, _popcount_bytes
 import numpy as np
+import pytest
+
+
+def exact_neighbours(rows, queries, limit):
+    """Similarities and ids of the `limit` nearest rows of each query, from an exact index."""
+    exact = SimpleVectorIndex()
+    exact.add(rows.copy())
+    return exact.search(queries, limit)
+
+
+def recall_at_k(ids, exact_ids):
+    """Fraction of the exact ids found in the ids of each query, averaged over the queries."""
+    return np.mean([len(set(a) & set(b)) / len(b) for a, b in zip(ids, exact_ids)])
+
+
+def pickled(index):
+    return pickle.loads(pickle.dumps(index))
 
 
 def test_topk1():
@@ -38,3 +70,301 @@ def test_simple_vector_index():
     assert sim.shape == (10, 2)
     assert np.all(i[:, 1] == 10)
     np.testing.assert_almost_equal(sim[0, 1], 1.0 / np.sqrt(10))
+
+
+def test_simple_vector_index_grows_in_place():
+    rng = np.random.default_rng(0)
+    batches = [rng.normal(size=(7, 4)).astype(np.float32) for _ in range(20)]
+    index = SimpleVectorIndex()
+    capacities = set()
+    for batch in batches:
+        original = batch.copy()
+        index.add(batch)
+        np.testing.assert_array_equal(batch, original)
+        capacities.add(index.capacity)
+    assert len(index) == 140 and index.capacity == 224
+    assert len(capacities) == 6
+    expected = np.concatenate(batches)
+    expected /= np.linalg.norm(expected, axis=1, keepdims=True)
+    assert index.rows.dtype == np.float32
+    np.testing.assert_allclose(index.rows, expected, rtol=1e-6)
+    restored = pickled(index)
+    assert len(restored) == 140 and restored.dim == 4
+    np.testing.assert_array_equal(restored.search(expected[:3], 1)[1][:, 0], [0, 1, 2])
+    index.compact()
+    assert index.capacity == 140
+    np.testing.assert_allclose(index.rows, expected, rtol=1e-6)
+    index.add(batches[0])
+    assert len(index) == 147 and index.capacity == 280
+
+
+@pytest.mark.parametrize("precision", ["float32", "float16", "int8"])
+def test_quantized_vector_index(precision):
+    rng = np.random.default_rng(0)
+    rows = rng.normal(size=(500, 32))
+    index = QuantizedVectorIndex(precision, block_size=128, min_train_rows=200)
+    for batch in np.split(rows, 5):
+        index.add(batch)
+    assert len(index) == 500 and index.dim == 32 and index.rows.dtype == precision
+    queries = rows[:20] + rng.normal(scale=0.3, size=(20, 32))
+    sim, i = index.search(queries, limit=10)
+    exact_sim, exact_i = exact_neighbours(rows, queries, 10)
+    assert i.shape == (20, 10)
+    np.testing.assert_array_equal(i[:, 0], np.arange(20))
+    np.testing.assert_allclose(sim, exact_sim, atol=0.05)
+    assert recall_at_k(i, exact_i) >= 0.8
+
+
+def test_quantized_vector_index_fits_after_min_train_rows():
+    rng = np.random.default_rng(3)
+    rows = rng.normal(size=(3001, 32))
+    index = QuantizedVectorIndex("int8", min_train_rows=2000)
+    # a single row doesn't span the range of the others, which would all be clipped.
+    index.add(rows[:1])
+    for batch in np.split(rows[1:], 6):
+        assert index.rows.dtype == (np.int8 if len(index) >= 2000 else np.float32)
+        index.add(batch)
+    assert index.rows.dtype == np.int8 and len(index) == 3001
+    queries = rows[:20] + rng.normal(scale=0.3, size=(20, 32))
+    i = index.search(queries, limit=10)[1]
+    exact_i = exact_neighbours(rows, queries, 10)[1]
+    assert recall_at_k(i, exact_i) >= 0.8
+
+
+def test_quantized_vector_index_rescoring():
+    rng = np.random.default_rng(1)
+    rows = rng.normal(size=(1000, 16))
+    index = QuantizedVectorIndex("int8", rescore=4, min_train_rows=1000)
+    index.add(rows)
+    queries = rng.normal(size=(10, 16))
+    sim, i = index.search(queries, limit=5)
+    exact_sim, exact_i = exact_neighbours(rows, queries, 5)
+    np.testing.assert_array_equal(i, exact_i)
+    np.testing.assert_allclose(sim, exact_sim, rtol=1e-5)
+    assert index.nbytes == 1000 * 16 * (1 + 4)
+    restored = pickled(index)
+    np.testing.assert_array_equal(restored.search(queries, limit=5)[1], exact_i)
+
+
+class LetterEmbeddingModel(EmbeddingModel):
+    """Letter counts, so that texts with the same letters are nearest neighbours."""
+
+    max_tokens_per_item = None
+
+    def tokenize(self, text):
+        return list(text.encode())
+
+    def detokenize(self, tokens):
+        return bytes(tokens).decode()
+
+    def encode(self, texts):
+        x = np.full((len(texts), 26), 1e-3)
+        for i, text in enumerate(texts):
+            for c in text:
+                if c.isalpha():
+                    x[i, ord(c.lower()) - ord("a")] += 1
+        return x
+
+
+def test_quantized_vector_index_in_search_index():
+    letters = np.random.default_rng(2).choice(list("abcdefghij"), size=(300, 6))
+    words = [Passage(f"w{i}", "".join(w), range(6)) for i, w in enumerate(letters)]
+    index = SearchIndex(
+        embedding_model=LetterEmbeddingModel(),
+        vector_index=QuantizedVectorIndex("int8", rescore=4),
+    )
+    for i in range(0, 300, 50):
+        index.update(words[i : i + 50])
+    assert isinstance(index.vector_index, QuantizedVectorIndex) and len(index.vector_index) == 300
+    result = index.search(words[123].text, limit=3)[0]
+    assert sorted(result.get_text()) == sorted(words[123].text)
+
+
+@pytest.mark.parametrize("on_disk", [False, True])
+def test_binary_vector_index(tmp_path, on_disk):
+    rng = np.random.default_rng(2)
+    rows = rng.normal(size=(2000, 96)) + 0.5
+    index = BinaryVectorIndex(oversample=20, path=tmp_path / "rows.f32" if on_disk else None, block_size=512)
+    for batch in np.split(rows, 4):
+        index.add(batch)
+    assert len(index) == 2000 and index.dim == 96
+    assert index.rows.shape == (2000, 2) and index.rows.dtype == np.uint64
+    assert index.nbytes == (2000 * 16 if on_disk else 2000 * (16 + 96 * 4))
+    queries = rows[:10] + rng.normal(scale=0.5, size=(10, 96))
+    sim, i = index.search(queries, limit=10)
+    exact_sim, exact_i = exact_neighbours(rows, queries, 10)
+    np.testing.assert_array_equal(i[:, 0], np.arange(10))
+    assert recall_at_k(i, exact_i) >= 0.7
+    found = i == exact_i
+    np.testing.assert_allclose(sim[found], exact_sim[found], rtol=1e-5)
+    restored = pickled(index)
+    np.testing.assert_array_equal(restored.search(queries, limit=10)[1], i)
+    # rescoring every row is exact.
+    restored.oversample = 200
+    np.testing.assert_array_equal(restored.search(queries, limit=10)[1], exact_i)
+
+
+def test_popcount():
+    words = np.array([[0, 1, 2**64 - 1]], dtype=np.uint64)
+    assert _popcount(words).tolist() == [[0, 1, 64]]
+    assert _popcount_bytes(words).tolist() == [[0, 1, 64]]
+
+
+def test_memmap_vector_index(tmp_path):
+    rng = np.random.default_rng(3)
+    rows = rng.normal(size=(250, 8))
+    index = MemmapVectorIndex(tmp_path / "index", segment_size=100)
+    assert len(index) == 0 and index.dim is None
+    index.add(rows[:30])
+    reader = MemmapVectorIndex(tmp_path / "index", readonly=True)
+    for batch in np.split(rows[30:], [70, 150]):
+        index.add(batch)
+    assert [len(s) for s in index.segments] == [100, 100, 50]
+    assert sorted(p.name for p in (tmp_path / "index").iterdir()) == [
+        "00000.bin",
+        "00001.bin",
+        "00002.bin",
+        "manifest.json",
+    ]
+    queries = rng.normal(size=(5, 8))
+    exact_sim, exact_i = exact_neighbours(rows, queries, 7)
+    np.testing.assert_array_equal(index.search(queries, 7)[1], exact_i)
+    np.testing.assert_allclose(index.search(queries, 7)[0], exact_sim, rtol=1e-5)
+
+    assert len(reader) == 30
+    reader.refresh()
+    assert len(reader) == 250
+    np.testing.assert_array_equal(reader.search(queries, 7)[1], exact_i)
+    with pytest.raises(PermissionError):
+        reader.add(rows)
+
+    reopened = pickled(index)
+    assert len(pickle.dumps(index)) < 1000
+    assert isinstance(reopened.segments[0], np.memmap)
+    reopened.add(rows[:1])
+    assert len(reopened) == 251 and [len(s) for s in reopened.segments] == [100, 100, 51]
+    assert reopened.search(rows[:1], 2)[1][0].tolist() in ([0, 250], [250, 0])
+
+
+def clustered(rng, n_rows, dim, n_clusters):
+    centers = rng.normal(size=(n_clusters, dim))
+    return centers[rng.integers(n_clusters, size=n_rows)] + rng.normal(scale=0.3, size=(n_rows, dim))
+
+
+def test_kmeans_finds_clusters():
+    rng = np.random.default_rng(4)
+    centers = np.eye(8)[:4]
+    rows = np.repeat(centers, 50, axis=0) + rng.normal(scale=0.05, size=(200, 8))
+    rows /= np.linalg.norm(rows, axis=1, keepdims=True)
+    centroids = kmeans(rows.astype(np.float32), 8, rng)
+    assert np.allclose(np.linalg.norm(centroids, axis=1), 1, atol=1e-5)
+    # every cluster has a centroid.
+    assert np.all(np.max(centroids @ centers.T, axis=0) > 0.95)
+
+
+def test_ivf_vector_index():
+    rng = np.random.default_rng(5)
+    rows = clustered(rng, 3000, 16, 30)
+    index = IVFVectorIndex(nprobe=4, min_train_rows=500, retrain_factor=None, seed=0)
+    index.add(rows[:400])
+    assert not index.trained
+    np.testing.assert_array_equal(index.search(rows[:3], 5)[1], exact_neighbours(rows[:400], rows[:3], 5)[1])
+    for batch in np.split(rows[400:], 13):
+        index.add(batch)
+    assert index.trained and len(index.lists) == 24 and len(index) == 3000
+    assert sum(len(lst) for lst in index.lists) == 3000
+    assert sorted(np.concatenate([lst.ids for lst in index.lists])) == list(range(3000))
+    queries = rows[:50] + rng.normal(scale=0.1, size=(50, 16))
+    sim, i = index.search(queries, limit=10)
+    exact_sim, exact_i = exact_neighbours(rows, queries, 10)
+    np.testing.assert_array_equal(i[:, 0], np.arange(50))
+    assert recall_at_k(i, exact_i) >= 0.9
+    # probing every list is exact.
+    index.nprobe = len(index.lists)
+    np.testing.assert_array_equal(index.search(queries, limit=10)[1], exact_i)
+    restored = pickled(index)
+    np.testing.assert_array_equal(restored.search(queries, limit=10)[1], exact_i)
+
+
+@pytest.mark.parametrize("background", [False, True])
+def test_ivf_vector_index_retrains(background):
+    rng = np.random.default_rng(6)
+    rows = clustered(rng, 2000, 8, 10)
+    index = IVFVectorIndex(min_train_rows=100, retrain_factor=4, background=background, seed=0)
+    index.add(rows[:100])
+    assert len(index.lists) == 10
+    index.add(rows[100:1000])
+    index.wait()
+    assert len(index.lists) == 32 and index._trained_size == 1000
+    index.add(rows[1000:])
+    assert sorted(np.concatenate([lst.ids for lst in index.lists])) == list(range(2000))
+    np.testing.assert_array_equal(index.search(rows[:5], 1)[1][:, 0], np.arange(5))
+    # fewer rows in the probed lists than the limit: more lists are probed.
+    index.nprobe = 1
+    assert index.search(rows[:2], 500)[1].shape == (2, 500)
+
+
+def test_ivf_vector_index_search_uses_its_snapshot():
+    rng = np.random.default_rng(8)
+    rows = clustered(rng, 1000, 8, 10)
+    index = IVFVectorIndex(min_train_rows=100, retrain_factor=2, background=False, seed=0)
+    index.add(rows[:100])
+    assert len(index.lists) == 10
+    probes = index._probes
+
+    def refit_meanwhile(*args):
+        # the clusters are refitted between the snapshot of the search and its probes.
+        index._probes = probes
+        index.add(rows[100:])
+        assert len(index.lists) == 32
+        return probes(*args)
+
+    index._probes = refit_meanwhile
+    sim, i = index.search(rows[:3], 200)
+    assert i.shape == (3, 100) and i.max() < 100
+    np.testing.assert_array_equal(i[:, 0], np.arange(3))
+
+
+def test_ivf_vector_index_adds_and_searches_during_a_refit():
+    rng = np.random.default_rng(9)
+    rows = clustered(rng, 1100, 8, 10)
+    index = IVFVectorIndex(min_train_rows=100, retrain_factor=None, seed=0)
+    index.add(rows[:100])
+    index.add(rows[100:1000])
+    assert len(index.lists) == 10
+    distribute = index._distribute
+    results = []
+
+    def meanwhile(*args):
+        index._distribute = distribute
+        # the rows are redistributed without the lock: other threads can search and add.
+        worker = threading.Thread(
+            target=lambda: results.append((index.search(rows[:2], 1)[1], index.add(rows[1000:])))
+        )
+        worker.start()
+        worker.join(timeout=10)
+        return distribute(*args)
+
+    index._distribute = meanwhile
+    index.train()
+    assert len(results) == 1 and results[0][0][:, 0].tolist() == [0, 1]
+    assert len(index.lists) == 32 and len(index) == 1100 and index._trained_size == 1000
+    # the rows added during the refit were moved to the new lists.
+    assert sorted(np.concatenate([lst.ids for lst in index.lists])) == list(range(1100))
+    index.nprobe = len(index.lists)
+    queries = rows[1000:1010]
+    np.testing.assert_array_equal(index.search(queries, 5)[1], exact_neighbours(rows, queries, 5)[1])
+
+
+def test_ivf_vector_index_in_search_index():
+    letters = np.random.default_rng(7).choice(list("abcdefghij"), size=(300, 6))
+    words = [Passage(f"w{i}", "".join(w), range(6)) for i, w in enumerate(letters)]
+    index = SearchIndex(
+        embedding_model=LetterEmbeddingModel(),
+        vector_index=IVFVectorIndex(min_train_rows=100, seed=0),
+    )
+    for i in range(0, 300, 50):
+        index.update(words[i : i + 50])
+    assert index.vector_index.trained and len(index) == 300
+    result = index.search(words[123].text, limit=3)[0]
+    assert sorted(result.get_text()) == sorted(words[123].text)